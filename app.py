@@ -1,221 +1,251 @@
-from flask import Flask, jsonify, send_from_directory, request
+from flask import Blueprint, Flask, Response, current_app, jsonify, request
 from flask_cors import CORS
+import config
 from config import DATABASE_URL
-from models import db
-from models.user import User
-from models.scooter import Scooter
-from models.ride import Ride
+from models import db, repository, storage
+from models.telemetry import telemetry_store
+import hashlib
+import hmac
+import logging
+import math
 import os
-import requests
-from datetime import datetime
+import signal
+import sys
 import time
-from sqlalchemy import text
+from services.ingest import telemetry_ingestor, parse_tst100_payload
+from services.geo_index import fleet_index
+from services.fleet_stream import VersionedCache, stream_scooters
+from services.commands import FAILED, command_dispatcher
+from services.rides import RideConflict, ride_engine
+from services.geofence import geofence
+from services.analytics import fleet_analytics
+from services.assets import tma_assets
+from services.metrics import CONTENT_TYPE, metrics, registry, samples
+from utils import logs
+from utils.telegram import verify_init_data
+import migrations
 
 # Определяем корневую папку проекта
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-app = Flask(__name__, static_folder=os.path.join(BASE_DIR, 'static'))
-CORS(app, origins=["*"], allow_headers=["*"], supports_credentials=True)
-app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+bp = Blueprint('main', __name__)
+logger = logging.getLogger(__name__)
 
-# ——— FLESPI TOKEN ———
-FLESPI_TOKEN = os.getenv('FLESPI_TOKEN', 'YOUR_FLESPI_TOKEN_HERE')
-
-def send_command_to_tst100(device_id, command):
+def send_command_to_tst100(imei, command):
     """
-    Отправляет команду на TST100 через Flespi
+    Ставит команду для TST100 в очередь отправки через Flespi.
     command: 'sclockctrl 0' (разблокировать) или 'sclockctrl 1' (заблокировать)
-    device_id: ID устройства в Flespi (например, 7738860)
+    imei: IMEI трекера, ID устройства в Flespi находит реестр устройств
+    Возвращает CommandTicket — по нему можно узнать состояние доставки.
     """
-    if FLESPI_TOKEN == 'YOUR_FLESPI_TOKEN_HERE':
-        print("⚠️ FLESPI_TOKEN не установлен в переменных окружения")
-        return False
-
-    # ✅ Правильный URL: через Device ID
-    url = f"https://flespi.io/gw/devices/{device_id}/commands/send"
-    
-    payload = {
-        "commands": [command]  # Команда
-    }
-    
-    headers = {
-        "Authorization": f"FlespiToken {FLESPI_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    
-    try:
-        response = requests.post(url, json=payload, headers=headers)
-        print(f"Команда '{command}' отправлена. Ответ: {response.status_code}")
-        
-        if response.status_code == 200:
-            print("✅ Команда успешно отправлена в Flespi")
-        else:
-            print(f"❌ Ошибка: {response.text}")
-        
-        return response.status_code == 200
-    except Exception as e:
-        print(f"❌ Ошибка отправки команды: {e}")
-        return False
-
-db.init_app(app)
+    return command_dispatcher.submit(imei, command)
 
-def init_db():
-    for i in range(5):
-        try:
-            with app.app_context():
-                db.create_all()
-
-                # ——— ДОБАВИТЬ КОЛОНКИ ВРУЧНУЮ ———
-                conn = db.engine.connect()
-
-                # Проверим, есть ли колонка speed
-                try:
-                    conn.execute(text("SELECT speed FROM scooter LIMIT 1;"))
-                except Exception:
-                    print("Добавляем колонку speed...")
-                    conn.execute(text("ALTER TABLE scooter ADD COLUMN speed NUMERIC DEFAULT 0.0;"))
-
-                # Проверим, есть ли odometer
-                try:
-                    conn.execute(text("SELECT odometer FROM scooter LIMIT 1;"))
-                except Exception:
-                    print("Добавляем колонку odometer...")
-                    conn.execute(text("ALTER TABLE scooter ADD COLUMN odometer INTEGER DEFAULT 0;"))
-
-                # last_seen
-                try:
-                    conn.execute(text("SELECT last_seen FROM scooter LIMIT 1;"))
-                except Exception:
-                    print("Добавляем колонку last_seen...")
-                    conn.execute(text("ALTER TABLE scooter ADD COLUMN last_seen DATETIME;"))
-
-                conn.commit()
-                print("✅ Таблицы обновлены")
-
-                # ——— ДОБАВИТЬ РЕАЛЬНЫЙ САМОКАТ ———
-                existing = Scooter.query.filter_by(imei="350544507678012").first()
-                if not existing:
-                    real_scooter = Scooter(
-                        imei="350544507678012",
-                        lat=54.828638,
-                        lng=55.866863,
-                        battery=91,
-                        speed=6.0,
-                        odometer=3024291,
-                        status="available"
-                    )
-                    db.session.add(real_scooter)
-                    db.session.commit()
-                    print("✅ Реальный самокат добавлен")
-
-            return
-        except Exception as e:
-            print(f"[{i+1}/5] Ошибка инициализации: {e}")
-            time.sleep(5)
-    raise RuntimeError("Не удалось создать таблицы в SQLite")
-
-init_db()
-
-@app.route('/')
+def create_app(overrides=None):
+    """
+    Фабрика приложения. В БД при старте не ходит: схему обновляют миграции
+    (flask --app app db-upgrade), индексы и кэши загружаются при первом обращении.
+    """
+    app = Flask(__name__, static_folder=os.path.join(BASE_DIR, 'static'))
+    CORS(app, origins=["*"], allow_headers=["*"], supports_credentials=True)
+    app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.from_object(config)
+    if overrides:
+        app.config.update(overrides)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', storage.engine_options(
+        app.config['SQLALCHEMY_DATABASE_URI'], app.config
+    ))
+
+    logs.setup_logging(app.config['LOG_LEVEL'], app.config['LOG_FORMAT'], app.config['LOG_QUEUE_SIZE'])
+
+    db.init_app(app)
+    storage.init_app(app)
+    metrics.init_app(app)
+    migrations.init_app(app)
+    telemetry_ingestor.init_app(app)
+    telemetry_store.init_app(app)
+    telemetry_ingestor.add_listener(telemetry_store.append_many)
+    fleet_index.init_app(app)
+    telemetry_ingestor.add_listener(fleet_index.on_telemetry)
+    command_dispatcher.init_app(app)
+    telemetry_ingestor.add_listener(command_dispatcher.on_telemetry)
+    ride_engine.init_app(app)
+    telemetry_ingestor.add_listener(ride_engine.on_telemetry)
+    geofence.init_app(app, send_command=send_command_to_tst100)
+    telemetry_ingestor.add_listener(geofence.on_telemetry)
+    fleet_analytics.init_app(app)
+    telemetry_ingestor.add_listener(fleet_analytics.on_telemetry)
+    tma_assets.init_app(app, os.path.join(BASE_DIR, 'static', 'tma'))
+    _register_collectors()
+
+    app.register_blueprint(bp)
+    return app
+
+def _register_collectors():
+    """Статистика сервисов в /metrics: снимается в момент опроса."""
+    registry.add_collector('ingest', _collect_ingest)
+    registry.add_collector('commands', _collect_commands)
+    registry.add_collector('fleet', lambda: [
+        ('fleet_index_scooters', 'gauge', "Самокатов в индексе парка", {(): len(fleet_index)}),
+        ('fleet_index_version', 'gauge', "Версия индекса парка", {(): fleet_index.version}),
+    ])
+    registry.add_collector('geofence', lambda: [
+        ('geofence_zones', 'gauge', "Загруженные геозоны", {(): geofence.stats()['zones']}),
+    ])
+    registry.add_collector('logs', lambda: [
+        ('log_records_dropped_total', 'counter', "Записи лога, отброшенные при переполнении очереди",
+         {(): logs.dropped()}),
+    ])
+
+def _collect_ingest():
+    stats = telemetry_ingestor.stats()
+    return [
+        ('ingest_messages_total', 'counter', "Сообщения телеметрии вебхука",
+         samples(stats, 'result', ('accepted', 'rejected', 'dropped', 'unknown_imei'))),
+        ('ingest_events_total', 'counter', "Пачки, записанные самокаты, ошибки и повторы записи",
+         samples(stats, 'event', ('batches', 'written', 'errors', 'retries', 'lost', 'listener_errors'))),
+        ('ingest_queue_depth', 'gauge', "Сообщений в очереди записи", {(): stats['queue_depth']}),
+        ('ingest_queue_capacity', 'gauge', "Ёмкость очереди записи", {(): stats['queue_capacity']}),
+    ]
+
+def _collect_commands():
+    stats = command_dispatcher.stats()
+    return [
+        ('flespi_commands_total', 'counter', "Команды на трекеры по итогам",
+         samples(stats, 'state', ('queued', 'coalesced', 'superseded', 'sent', 'acked', 'failed', 'retries'))),
+        ('flespi_commands_pending', 'gauge', "Команды в очереди и ждущие подтверждения",
+         samples(stats, 'state', ('pending', 'awaiting_ack'))),
+    ]
+
+@bp.route('/')
 def index():
     return "<h1>Добро пожаловать в Whoosh API!</h1>"
 
-@app.route('/tma')
+@bp.route('/tma')
 def tma_index():
-    try:
-        return send_from_directory(
-            os.path.join(BASE_DIR, 'static', 'tma'),
-            'index.html'
-        )
-    except Exception as e:
-        return f"Ошибка загрузки TMA: {str(e)}", 500
+    return tma_assets.response('index.html') or ("TMA не найдено", 404)
 
-@app.route('/tma/assets/images/<path:filename>')
-def serve_image(filename):
-    return send_from_directory(os.path.join(BASE_DIR, 'static', 'tma', 'assets', 'images'), filename)
+@bp.route('/tma/<path:filename>')
+def tma_asset(filename):
+    """Ассеты Mini App из памяти: сжатые, с ETag; имена с хэшем — immutable."""
+    return tma_assets.response(filename) or (jsonify({"error": "Not found"}), 404)
 
-@app.route('/api/tst100/webhook', methods=['POST'])
+@bp.route('/api/tst100/webhook', methods=['POST'])
 def tst100_webhook():
     try:
-        data = request.get_json()
-        print("ПОЛУЧЕННЫЙ JSON:", data)
-
-        # Извлечение IMEI (в TST100 это поле 'ident')
-        imei = data.get('ident')
-        if not imei:
-            print("❌ IMEI не найден в JSON (поле 'ident')")
-            return jsonify({"error": "IMEI not found"}), 400
-
-        # Извлечение координат
-        position = data.get('position', {})
-        lat = position.get('latitude')
-        lng = position.get('longitude')
-        speed = position.get('speed')
-        altitude = position.get('altitude')
-
-        # Извлечение других данных
-        battery_level = data.get('scooter.battery.level') or data.get('battery.level')
-        voltage = data.get('external.powersource.voltage') or data.get('internal.battery.voltage')
-        odometer = data.get('vehicle.mileage')  # в км
-        lock_status = data.get('lock.status')
-        ignition_status = data.get('engine.ignition.status')
-        remaining_mileage = data.get('predicted.remaining.mileage')
-
-        # Поиск самоката в БД
-        scooter = Scooter.query.filter_by(imei=imei).first()
-        if scooter:
-            # Обновляем данные
-            if lat is not None:
-                scooter.lat = lat
-            if lng is not None:
-                scooter.lng = lng
-            if battery_level is not None:
-                scooter.battery = int(battery_level)
-            if speed is not None:
-                scooter.speed = float(speed)
-            if odometer is not None:
-                scooter.odometer = int(odometer * 1000)  # км → метры (если в БД хранится в метрах)
-            scooter.last_seen = datetime.utcnow()
-
-            # Обновляем статус (можно добавить логику)
-            if lock_status is not None:
-                scooter.status = 'locked' if lock_status else 'available'
-            elif ignition_status is not None and not ignition_status:
-                scooter.status = 'offline'
-
-            db.session.commit()
-            print(f"✅ Самокат {scooter.id} обновлён:")
-            print(f"   - Координаты: {lat}, {lng}")
-            print(f"   - Заряд: {battery_level}%")
-            print(f"   - Скорость: {speed} km/h")
-            print(f"   - Пробег: {odometer} km")
-            return jsonify({"status": "ok", "scooter_id": scooter.id}), 200
-        else:
-            print(f"❌ Самокат с IMEI {imei} не найден в БД")
-            return jsonify({"error": f"Scooter with IMEI {imei} not found"}), 404
+        data = request.get_json(silent=True)
+        if data is None:
+            return jsonify({"error": "JSON body required"}), 400
+
+        try:
+            messages = parse_tst100_payload(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        if telemetry_ingestor.mode == 'queue':
+            # Только кладём в очередь — запись в БД делает фоновый поток пачками
+            if not telemetry_ingestor.submit(messages):
+                return jsonify({"error": "Ingest queue is full"}), 503, {'Retry-After': '1'}
+            return jsonify({"status": "queued", "accepted": len(messages)}), 200
+
+        # Синхронный режим: пишем в потоке запроса
+        written = telemetry_ingestor.write_batch(messages)
+        if len(messages) == 1:
+            imei = messages[0]['imei']
+            if imei not in written:
+                return jsonify({"error": f"Scooter with IMEI {imei} not found"}), 404
+            return jsonify({"status": "ok", "scooter_id": written[imei]}), 200
+        return jsonify({"status": "ok", "written": len(written)}), 200
 
     except Exception as e:
-        print("❌ Ошибка вебхука:", str(e))
+        logger.exception("Ошибка вебхука")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/rent/<int:scooter_id>', methods=['POST'])
-def rent_scooter(scooter_id):
+@bp.route('/api/tst100/ingest/stats')
+def ingest_stats():
+    return jsonify(telemetry_ingestor.stats())
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus."""
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+@bp.route('/api/scooters/<int:scooter_id>/history')
+def scooter_history(scooter_id):
+    imei = repository.scooter_imei(scooter_id)
+    if imei is None:
+        return jsonify({"error": "Scooter not found"}), 404
     try:
-        scooter = Scooter.query.get_or_404(scooter_id)
+        end = float(request.args.get('to', time.time()))
+        start = float(request.args.get('from', end - 3600))
+        tier = request.args.get('tier')
+        points = telemetry_store.query(imei, start, end, tier=tier)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"scooter_id": scooter_id, "imei": imei, "points": points})
+
+def _ride_json(ride):
+    if ride is None:
+        return None
+    return {
+        "id": ride.id,
+        "status": ride.status,
+        "start_time": ride.start_time.isoformat() if ride.start_time else None,
+        "end_time": ride.end_time.isoformat() if ride.end_time else None,
+        "distance_km": ride.distance_km,
+        "cost": ride.cost,
+    }
 
-        if scooter.status != 'available':
-            return jsonify({"success": False, "message": "Самокат недоступен для аренды"}), 400
+def _current_user():
+    """
+    Пользователь Mini App. С TELEGRAM_BOT_TOKEN — только по подписанному
+    initData (заголовок X-Telegram-Init-Data или init_data в теле),
+    PermissionError — подписи нет или она неверна. Без токена — по telegram_id
+    из тела или X-Telegram-User-Id, иначе гостевой пользователь (telegram_id = 0);
+    ValueError — telegram_id не число.
+    """
+    data = request.get_json(silent=True) or {}
+    bot_token = current_app.config['TELEGRAM_BOT_TOKEN']
+    if bot_token:
+        init_data = request.headers.get('X-Telegram-Init-Data') or data.get('init_data')
+        try:
+            user = verify_init_data(init_data, bot_token, current_app.config['TELEGRAM_INIT_DATA_MAX_AGE'])
+        except ValueError as e:
+            raise PermissionError(str(e))
+        return repository.get_or_create_user(int(user['id']))
 
-        # Изменяем статус
-        scooter.status = 'in_use'
-        db.session.commit()
+    telegram_id = data.get('telegram_id') or request.headers.get('X-Telegram-User-Id') or 0
+    try:
+        telegram_id = int(telegram_id)
+    except (TypeError, ValueError):
+        raise ValueError("telegram_id must be an integer")
+    return repository.get_or_create_user(telegram_id)
+
+def _user_error(error):
+    status = 401 if isinstance(error, PermissionError) else 400
+    return jsonify({"success": False, "message": str(error)}), status
 
-        # Отправляем команду разблокировки в TST100
-        # ✅ Используем Device ID из Flespi (найди его в панели)
-        success = send_command_to_tst100(device_id=7738860, command="sclockctrl 0")
-        if success:
-            message = "Самокат успешно арендован и разблокирован"
+@bp.route('/api/rent/<int:scooter_id>', methods=['POST'])
+def rent_scooter(scooter_id):
+    try:
+        try:
+            user = _current_user()
+        except (PermissionError, ValueError) as e:
+            return _user_error(e)
+
+        # Атомарно: самокат available → in_use и новая поездка
+        try:
+            ride, imei = ride_engine.start(scooter_id, user.id)
+        except RideConflict as e:
+            if not repository.scooter_exists(scooter_id):
+                return jsonify({"success": False, "message": "Самокат не найден"}), 404
+            return jsonify({"success": False, "message": str(e)}), 400
+        fleet_index.upsert(scooter_id, status='in_use')
+
+        # Отправляем команду разблокировки в TST100 (асинхронно)
+        ticket = send_command_to_tst100(imei, "sclockctrl 0")
+        if ticket.state != FAILED:
+            message = "Самокат арендован, команда разблокировки отправляется"
         else:
             message = "Самокат арендован, но не удалось отправить команду разблокировки"
 
@@ -223,30 +253,39 @@ def rent_scooter(scooter_id):
             "success": True,
             "message": message,
             "scooter": {
-                "id": scooter.id,
-                "status": scooter.status
-            }
+                "id": scooter_id,
+                "status": 'in_use'
+            },
+            "ride": _ride_json(ride),
+            "command": ticket.to_dict()
         }), 200
 
     except Exception as e:
+        db.session.rollback()
+        logger.exception("Ошибка аренды", extra={'scooter_id': scooter_id, 'route': request.path})
         return jsonify({"success": False, "message": str(e)}), 500
 
-@app.route('/api/end_rent/<int:scooter_id>', methods=['POST'])
+@bp.route('/api/end_rent/<int:scooter_id>', methods=['POST'])
 def end_rent_scooter(scooter_id):
     try:
-        scooter = Scooter.query.get_or_404(scooter_id)
-
-        if scooter.status != 'in_use':
-            return jsonify({"success": False, "message": "Самокат не находится в аренде"}), 400
-
-        # Изменяем статус
-        scooter.status = 'available'
-        db.session.commit()
+        try:
+            user = _current_user()
+        except (PermissionError, ValueError) as e:
+            return _user_error(e)
 
-        # Отправляем команду блокировки в TST100
-        success = send_command_to_tst100(device_id=7738860, command="sclockctrl 1")
-        if success:
-            message = "Аренда успешно завершена и самокат заблокирован"
+        # Атомарно: самокат in_use у этого пользователя → available, поездка закрывается
+        try:
+            ride, imei = ride_engine.finish(scooter_id, user.id)
+        except RideConflict as e:
+            if not repository.scooter_exists(scooter_id):
+                return jsonify({"success": False, "message": "Самокат не найден"}), 404
+            return jsonify({"success": False, "message": str(e)}), 400
+        fleet_index.upsert(scooter_id, status='available')
+
+        # Отправляем команду блокировки в TST100 (асинхронно)
+        ticket = send_command_to_tst100(imei, "sclockctrl 1")
+        if ticket.state != FAILED:
+            message = "Аренда завершена, команда блокировки отправляется"
         else:
             message = "Аренда завершена, но не удалось отправить команду блокировки"
 
@@ -254,36 +293,187 @@ def end_rent_scooter(scooter_id):
             "success": True,
             "message": message,
             "scooter": {
-                "id": scooter.id,
-                "status": scooter.status
-            }
+                "id": scooter_id,
+                "status": 'available'
+            },
+            "ride": _ride_json(ride),
+            "command": ticket.to_dict()
         }), 200
 
     except Exception as e:
+        db.session.rollback()
+        logger.exception("Ошибка аренды", extra={'scooter_id': scooter_id, 'route': request.path})
         return jsonify({"success": False, "message": str(e)}), 500
 
-@app.route('/api/scooters')
+def _floats(value, count, name):
+    parts = value.split(',')
+    if len(parts) != count:
+        raise ValueError(f"{name} must have {count} comma-separated numbers")
+    numbers = tuple(float(p) for p in parts)
+    # float() принимает nan и inf, а сетка индекса на них падает
+    if not all(math.isfinite(n) for n in numbers):
+        raise ValueError(f"{name} must be finite numbers")
+    return numbers
+
+def _check_lat_lng(lat, lng, name):
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError(f"{name} is out of range (lat -90..90, lng -180..180)")
+
+def _bbox(value):
+    """bbox=west,south,east,north → (min_lng, min_lat, max_lng, max_lat)."""
+    west, south, east, north = _floats(value, 4, 'bbox')
+    _check_lat_lng(south, west, 'bbox')
+    _check_lat_lng(north, east, 'bbox')
+    return west, south, east, north
+
+def _near(value):
+    lat, lng = _floats(value, 2, 'near')
+    _check_lat_lng(lat, lng, 'near')
+    return lat, lng
+
+def _scooter_filters(args):
+    """Общие фильтры /api/scooters и /api/scooters/stream."""
+    return {
+        'bbox': _bbox(args['bbox']) if args.get('bbox') else None,
+        'statuses': set(args['status'].split(',')) if args.get('status') else None,
+        'min_battery': int(args['min_battery']) if args.get('min_battery') else None,
+    }
+
+_scooters_cache = VersionedCache()
+
+@bp.route('/api/commands/<int:ticket_id>')
+def command_status(ticket_id):
+    """
+    Состояние команды на трекер: queued → sending → sent → acked
+    (или failed / superseded). ?wait=сек — подождать отправки.
+    """
+    ticket = command_dispatcher.get(ticket_id)
+    if ticket is None:
+        return jsonify({"error": "Command not found"}), 404
+    wait = min(request.args.get('wait', 0, type=float), 10.0)
+    if wait > 0:
+        ticket.wait(wait)
+    return jsonify(ticket.to_dict())
+
+@bp.route('/api/commands/stats')
+def command_stats():
+    return jsonify(command_dispatcher.stats())
+
+@bp.route('/api/scooters')
 def get_scooters():
+    """
+    Список самокатов из индекса в памяти.
+    Параметры: bbox=west,south,east,north | near=lat,lng&radius=м,
+    status=available,in_use, min_battery, limit, offset.
+    Поддерживает If-None-Match: пока ответ для области не менялся, отвечаем 304.
+    """
     try:
-        # Возвращаем только реальный самокат
-        scooter = Scooter.query.filter_by(imei="350544507678012").first()
-        if scooter:
-            result = [{
-                'id': scooter.id,
-                'imei': scooter.imei,
-                'lat': scooter.lat,
-                'lng': scooter.lng,
-                'battery': scooter.battery,
-                'status': scooter.status,
-                'speed': scooter.speed,
-                'odometer': scooter.odometer
-            }]
-        else:
-            result = []
-        return jsonify(result)
+        args = request.args
+        filters = _scooter_filters(args)
+        near = _near(args['near']) if args.get('near') else None
+        radius = _floats(args.get('radius', '1000'), 1, 'radius')[0]
+        if radius < 0:
+            raise ValueError("radius must not be negative")
+        radius = min(radius, current_app.config['SCOOTERS_MAX_RADIUS'])
+        limit = min(int(args.get('limit', current_app.config['SCOOTERS_PAGE_SIZE'])), current_app.config['SCOOTERS_MAX_PAGE_SIZE'])
+        offset = max(int(args.get('offset', 0)), 0)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+
+    try:
+        fleet_index.ensure_loaded()
+        version = fleet_index.version
+        key = request.query_string
+        cached = _scooters_cache.get(key, version)
+        if cached is None:
+            total, result = fleet_index.search(
+                near=near, radius=radius, limit=limit, offset=offset, **filters
+            )
+            body = current_app.json.dumps(result)
+            # ETag — от содержимого ответа, а не от версии всего парка:
+            # пока в области ничего не поменялось, опрос получает 304
+            etag = hashlib.sha1(f"{total}:{body}".encode()).hexdigest()[:20]
+            cached = (body, str(total), etag)
+            _scooters_cache.put(key, version, cached)
+        body, total, etag = cached
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+        if etag in request.if_none_match:
+            return Response(status=304, headers=headers)
+        headers['X-Total-Count'] = total
+        return Response(body, mimetype='application/json', headers=headers)
     except Exception as e:
+        logger.exception("Ошибка /api/scooters")
         return f"Ошибка API: {str(e)}", 500
 
+@bp.route('/api/zones')
+def get_zones():
+    """Активные геозоны в GeoJSON (FeatureCollection) для карты."""
+    return jsonify({
+        "type": "FeatureCollection",
+        "features": [zone.to_feature() for zone in geofence.zones()],
+    })
+
+@bp.route('/api/geofence/events')
+def geofence_events():
+    """Последние события входа/выхода из геозон: ?since=<id события>&limit=."""
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', 500, type=int), 5000)
+    return jsonify(geofence.events_since(since, limit))
+
+@bp.route('/api/geofence/stats')
+def geofence_stats():
+    return jsonify(geofence.stats())
+
+@bp.route('/api/admin/analytics')
+def admin_analytics():
+    """
+    Панель аналитики: разряд батарей, остаток хода, загрузка по часам,
+    спрос. Только предрасчитанные агрегаты (?hours= — глубина загрузки).
+    Доступ — по ADMIN_TOKEN в заголовке Authorization: Bearer <токен>.
+    """
+    admin_token = current_app.config['ADMIN_TOKEN']
+    if not admin_token:
+        return jsonify({"success": False, "message": "Admin panel is disabled"}), 403
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode(), admin_token.encode()):
+        return jsonify({"success": False, "message": "Invalid admin token"}), 401
+    hours = min(request.args.get('hours', 48, type=int), 24 * 31)
+    return jsonify(fleet_analytics.dashboard(hours=hours))
+
+@bp.route('/api/scooters/stream')
+def scooters_stream():
+    """
+    Поток изменений парка (Server-Sent Events) для области bbox.
+    При переподключении EventSource присылает Last-Event-ID — отдаём только дельту.
+    """
+    try:
+        filters = _scooter_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query: {e}"}), 400
+
+    fleet_index.ensure_loaded()
+    since = request.headers.get('Last-Event-ID') or request.args.get('since')
+    stream = stream_scooters(
+        fleet_index, since=since,
+        heartbeat=current_app.config['SCOOTERS_STREAM_HEARTBEAT'],
+        min_interval=current_app.config['SCOOTERS_STREAM_MIN_INTERVAL'],
+        max_duration=current_app.config['SCOOTERS_STREAM_MAX_DURATION'],
+        **filters,
+    )
+    return Response(stream, mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+app = create_app()
+
 if __name__ == '__main__':
+    # Единственный процесс — он же применяет миграции перед стартом
+    with app.app_context():
+        migrations.upgrade(db.engine)
+    # Railway останавливает процесс SIGTERM'ом, а на нём atexit не срабатывает:
+    # превращаем сигнал в обычный выход, чтобы очереди и сегменты телеметрии
+    # успели сброситься на диск
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     port = int(os.environ.get("PORT", 8080))
-    app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port, debug=False, threaded=True)
\ No newline at end of file
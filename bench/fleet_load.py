@@ -0,0 +1,377 @@
+"""
+Нагрузочный тест: синтетический парк TST100 + аренды + опрос карты.
+
+    python -m bench.fleet_load --trackers 500 --rate 0.2 --duration 30
+    python -m bench.fleet_load --compare bench/results/<прошлый>.json
+
+По умолчанию поднимает приложение в этом же процессе на временной SQLite
+и локальную заглушку Flespi; --url направляет нагрузку на уже запущенный
+сервер. На нём должен быть заведён синтетический парк (IMEI с IMEI_BASE):
+трекеры и арендаторы работают только с ним, а аренды, которые шлют команды
+через настоящий Flespi сервера, включаются явно флагом --allow-rides.
+Результат (пропускная способность, p50/p95/p99 по эндпоинтам) печатается
+и сохраняется в JSON в bench/results/ для сравнения между коммитами.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import requests
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(BASE_DIR, 'bench', 'results')
+
+# Туймазы — центр синтетического парка
+CENTER = (54.6046, 53.7066)
+SPREAD = 0.03
+IMEI_BASE = 860000000000000
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+class Recorder:
+    """Задержки и коды ответов по эндпоинтам."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, status):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            self.statuses[endpoint][status] += 1
+
+    def summary(self, elapsed):
+        result = {}
+        for endpoint in sorted(self.latencies):
+            values = sorted(self.latencies[endpoint])
+            statuses = dict(self.statuses[endpoint])
+            errors = sum(n for status, n in statuses.items() if status == 'error' or int(status) >= 500)
+            result[endpoint] = {
+                'requests': len(values),
+                'errors': errors,
+                'rps': round(len(values) / elapsed, 2),
+                'p50_ms': round(percentile(values, 50) * 1000, 3),
+                'p95_ms': round(percentile(values, 95) * 1000, 3),
+                'p99_ms': round(percentile(values, 99) * 1000, 3),
+                'max_ms': round(values[-1] * 1000, 3),
+                'statuses': {str(k): v for k, v in sorted(statuses.items(), key=str)},
+            }
+        return result
+
+
+def timed(recorder, endpoint, session, method, url, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=30, **kwargs)
+        status = response.status_code
+    except requests.RequestException:
+        response, status = None, 'error'
+    recorder.record(endpoint, time.perf_counter() - started, status)
+    return response
+
+
+# ——— Источники нагрузки ———
+
+def flespi_message(imei, state, now):
+    """Сообщение в формате Flespi, как его шлёт TST100."""
+    state['lat'] += random.uniform(-0.0002, 0.0002)
+    state['lng'] += random.uniform(-0.0002, 0.0002)
+    state['battery'] = max(0, state['battery'] - random.choice((0, 0, 0, 1)))
+    state['mileage'] += random.uniform(0, 0.02)
+    return {
+        'ident': imei,
+        'timestamp': now,
+        'position': {
+            'latitude': round(state['lat'], 6),
+            'longitude': round(state['lng'], 6),
+            'speed': round(random.uniform(0, 25), 1),
+            'altitude': 120,
+        },
+        'scooter.battery.level': state['battery'],
+        'external.powersource.voltage': 41.5,
+        'vehicle.mileage': round(state['mileage'], 3),
+        'lock.status': state['locked'],
+        'engine.ignition.status': True,
+        'predicted.remaining.mileage': round(state['battery'] * 0.4, 1),
+    }
+
+
+def run_trackers(base_url, recorder, imeis, rate, batch, stop):
+    """Группа трекеров одного потока: каждый шлёт rate сообщений в секунду."""
+    session = requests.Session()
+    states = {
+        imei: {
+            'lat': CENTER[0] + random.uniform(-SPREAD, SPREAD),
+            'lng': CENTER[1] + random.uniform(-SPREAD, SPREAD),
+            'battery': random.randint(20, 100),
+            'mileage': random.uniform(0, 3000),
+            # Самокаты стоят запертыми, как после завершения аренды
+            'locked': True,
+        }
+        for imei in imeis
+    }
+    interval = 1.0 / (rate * len(imeis)) * batch
+    next_at = time.perf_counter()
+    while not stop.is_set():
+        now = time.time()
+        messages = [flespi_message(imei, states[imei], now) for imei in random.sample(imeis, min(batch, len(imeis)))]
+        timed(recorder, 'POST /api/tst100/webhook', session, 'POST', base_url + '/api/tst100/webhook',
+              json=messages if batch > 1 else messages[0])
+        next_at += interval
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            stop.wait(delay)
+        else:
+            # Не успеваем — не копим долг, фиксируем реальную скорость
+            next_at = time.perf_counter()
+
+
+def run_rider(base_url, recorder, scooter_ids, ride_seconds, stop, telegram_id):
+    session = requests.Session()
+    while not stop.is_set():
+        scooter_id = random.choice(scooter_ids)
+        response = timed(recorder, 'POST /api/rent', session, 'POST',
+                         f"{base_url}/api/rent/{scooter_id}", json={'telegram_id': telegram_id})
+        if response is None or response.status_code != 200:
+            stop.wait(0.05)
+            continue
+        stop.wait(ride_seconds)
+        timed(recorder, 'POST /api/end_rent', session, 'POST',
+              f"{base_url}/api/end_rent/{scooter_id}", json={'telegram_id': telegram_id})
+
+
+def run_poller(base_url, recorder, interval, stop):
+    """Клиент карты: опрашивает свою область с If-None-Match, как браузер."""
+    session = requests.Session()
+    lat = CENTER[0] + random.uniform(-SPREAD, SPREAD)
+    lng = CENTER[1] + random.uniform(-SPREAD, SPREAD)
+    bbox = f"{lng - 0.01},{lat - 0.006},{lng + 0.01},{lat + 0.006}"
+    etag = None
+    while not stop.is_set():
+        headers = {'If-None-Match': etag} if etag else {}
+        response = timed(recorder, 'GET /api/scooters', session, 'GET',
+                         f"{base_url}/api/scooters?bbox={bbox}", headers=headers)
+        if response is not None and response.status_code == 200:
+            etag = response.headers.get('ETag')
+        stop.wait(interval)
+
+
+# ——— Локальный стенд ———
+
+def start_local_server(trackers, workdir):
+    """Приложение на временной SQLite + заглушка Flespi, в этом процессе."""
+    sys.path.insert(0, BASE_DIR)
+    from werkzeug.serving import make_server
+
+    import app as app_module
+    import migrations
+    from models import db
+    from utils.flespi_stub import FlespiStub
+
+    stub = FlespiStub(latency=0.05).start()
+    imeis = [str(IMEI_BASE + i) for i in range(trackers)]
+    app = app_module.create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'TELEMETRY_DIR': os.path.join(workdir, 'telemetry'),
+        'FLESPI_URL': stub.url,
+        'FLESPI_TOKEN': 'bench',
+        'FLESPI_DEVICE_IDS': {imei: 1000000 + i for i, imei in enumerate(imeis)},
+    })
+    with app.app_context():
+        migrations.upgrade(db.engine, log=lambda message: None)
+        db.session.execute(db.text("DELETE FROM scooter"))
+        db.session.execute(
+            db.text("INSERT INTO scooter (imei, lat, lng, battery, speed, odometer, status) "
+                    "VALUES (:imei, :lat, :lng, 100, 0, 0, 'available')"),
+            [{
+                'imei': imei,
+                'lat': CENTER[0] + random.uniform(-SPREAD, SPREAD),
+                'lng': CENTER[1] + random.uniform(-SPREAD, SPREAD),
+            } for imei in imeis],
+        )
+        db.session.commit()
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server, stub
+
+
+def fetch_scooters(base_url):
+    scooters, offset = [], 0
+    while True:
+        page = requests.get(f"{base_url}/api/scooters?limit=5000&offset={offset}", timeout=30).json()
+        scooters.extend(page)
+        if len(page) < 5000:
+            return scooters
+        offset += len(page)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# ——— Отчёт ———
+
+def print_report(result):
+    print(f"\nКоммит {result['commit']}, {result['duration_s']} с, параметры: {json.dumps(result['params'])}")
+    print(f"{'эндпоинт':32} {'запросов':>9} {'ошибок':>7} {'rps':>9} {'p50 мс':>9} {'p95 мс':>9} {'p99 мс':>9}")
+    for endpoint, stats in result['endpoints'].items():
+        print(f"{endpoint:32} {stats['requests']:>9} {stats['errors']:>7} {stats['rps']:>9} "
+              f"{stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+    if result.get('ingest'):
+        ingest = result['ingest']
+        print(f"ingest: принято {ingest.get('accepted')}, записано {ingest.get('written')}, "
+              f"отклонено {ingest.get('rejected')}, в очереди {ingest.get('queue_depth')}")
+
+
+def compare(result, baseline, threshold):
+    """Сравнение с прошлым прогоном. Возвращает список регрессий."""
+    regressions = []
+    print(f"\nСравнение с {baseline.get('commit')} ({baseline.get('timestamp')}):")
+    for endpoint, stats in result['endpoints'].items():
+        old = baseline.get('endpoints', {}).get(endpoint)
+        if not old:
+            continue
+        for key, worse_if_higher in (('p95_ms', True), ('p99_ms', True), ('rps', False)):
+            if not old[key]:
+                continue
+            change = (stats[key] - old[key]) / old[key] * 100
+            marker = ''
+            if (change > threshold if worse_if_higher else change < -threshold):
+                marker = '  ❌ регрессия'
+                regressions.append((endpoint, key, change))
+            print(f"  {endpoint:32} {key:7} {old[key]:>10} → {stats[key]:>10} ({change:+.1f}%){marker}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест парка TST100")
+    parser.add_argument('--url', help="адрес запущенного сервера (по умолчанию — локальный стенд)")
+    parser.add_argument('--trackers', type=int, default=200, help="число трекеров")
+    parser.add_argument('--rate', type=float, default=0.2, help="сообщений в секунду на трекер")
+    parser.add_argument('--batch', type=int, default=1, help="сообщений в одном POST (Flespi шлёт массивы)")
+    parser.add_argument('--tracker-threads', type=int, default=8)
+    parser.add_argument('--riders', type=int, default=10, help="параллельных арендаторов")
+    parser.add_argument('--allow-rides', action='store_true',
+                        help="с --url: разрешить аренды (сервер отправит команды через свой Flespi)")
+    parser.add_argument('--ride-seconds', type=float, default=1.0)
+    parser.add_argument('--pollers', type=int, default=20, help="клиентов карты")
+    parser.add_argument('--poll-interval', type=float, default=1.0)
+    parser.add_argument('--duration', type=float, default=20.0, help="длительность, сек")
+    parser.add_argument('--output', help="куда сохранить JSON (по умолчанию bench/results/)")
+    parser.add_argument('--compare', help="JSON прошлого прогона для сравнения")
+    parser.add_argument('--threshold', type=float, default=20.0, help="допустимое ухудшение, %%")
+    args = parser.parse_args(argv)
+
+    if args.url and args.riders and not args.allow_rides:
+        parser.error("с --url аренды отправляют команды через Flespi целевого сервера: "
+                     "добавьте --allow-rides или --riders 0")
+
+    server = stub = None
+    workdir = None
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        workdir = tempfile.mkdtemp(prefix='fleet-bench-')
+        base_url, server, stub = start_local_server(args.trackers, workdir)
+
+    # Только синтетический парк: настоящие самокаты не получают ни телеметрию, ни аренды
+    synthetic = {str(IMEI_BASE + i) for i in range(args.trackers)}
+    fleet = [scooter for scooter in fetch_scooters(base_url) if scooter.get('imei') in synthetic]
+    if not fleet:
+        parser.error(f"на {base_url} нет синтетического парка: заведите самокаты "
+                     f"с IMEI {IMEI_BASE}…{IMEI_BASE + args.trackers - 1}")
+    imeis = sorted(scooter['imei'] for scooter in fleet)
+    scooter_ids = [scooter['id'] for scooter in fleet]
+    if len(imeis) < args.trackers:
+        print(f"На сервере {len(imeis)} из {args.trackers} синтетических самокатов — нагружаем их")
+
+    recorder = Recorder()
+    stop = threading.Event()
+    threads = []
+    groups = [imeis[i::args.tracker_threads] for i in range(args.tracker_threads)]
+    for group in filter(None, groups):
+        threads.append(threading.Thread(target=run_trackers, args=(base_url, recorder, group, args.rate, args.batch, stop)))
+    for i in range(args.riders):
+        threads.append(threading.Thread(target=run_rider, args=(base_url, recorder, scooter_ids, args.ride_seconds, stop, 500000 + i)))
+    for _ in range(args.pollers):
+        threads.append(threading.Thread(target=run_poller, args=(base_url, recorder, args.poll_interval, stop)))
+
+    print(f"Нагрузка на {base_url}: {len(imeis)} трекеров × {args.rate}/с, "
+          f"{args.riders} арендаторов, {args.pollers} клиентов карты, {args.duration} с")
+    started = time.perf_counter()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=35)
+    elapsed = time.perf_counter() - started
+
+    ingest = None
+    try:
+        ingest = requests.get(base_url + '/api/tst100/ingest/stats', timeout=10).json()
+    except (requests.RequestException, ValueError):
+        pass
+
+    result = {
+        'commit': git_commit(),
+        'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'target': args.url or 'local',
+        'duration_s': round(elapsed, 2),
+        'params': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'compare', 'url', 'allow_rides')},
+        'endpoints': recorder.summary(elapsed),
+        'ingest': ingest,
+    }
+    print_report(result)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{result['commit'] or 'nogit'}.json")
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    print(f"\nРезультат сохранён: {output}")
+
+    if server is not None:
+        server.shutdown()
+        stub.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(result, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
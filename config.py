@@ -1,7 +1,117 @@
+import json
 import os
 
-# Принудительно используем SQLite
-DATABASE_URL = 'sqlite:///scooters.db'
+# ——— ХРАНИЛИЩЕ ———
+# По умолчанию SQLite. DATABASE_URL из окружения Railway намеренно не читаем,
+# чтобы PostgreSQL не включился сам; для перехода задайте STORAGE_URL.
+DATABASE_URL = os.getenv('STORAGE_URL', 'sqlite:///scooters.db')
+if DATABASE_URL.startswith('postgres://'):
+    DATABASE_URL = 'postgresql://' + DATABASE_URL[len('postgres://'):]
 
-# Чтобы PostgreSQL не использовался, даже если в переменных окружения
-# DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///scooters.db')
\ No newline at end of file
+# SQLite: WAL + ожидание блокировки вместо мгновенного "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+
+# PostgreSQL: пул соединений и таймауты
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', 5))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', 5000))
+
+# ——— ПРИЁМ ТЕЛЕМЕТРИИ TST100 ———
+# queue — вебхук кладёт сообщения в очередь, фоновый поток пишет пачками
+# sync — запись прямо в потоке запроса (как раньше)
+INGEST_MODE = os.getenv('INGEST_MODE', 'queue')
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 10000))
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 500))
+INGEST_IDLE_TIMEOUT = float(os.getenv('INGEST_IDLE_TIMEOUT', 0.5))
+# reject — при переполнении отвечаем 503 (Flespi повторит), drop_oldest — вытесняем старые
+INGEST_OVERFLOW = os.getenv('INGEST_OVERFLOW', 'reject')
+# Повторы пачки при временной ошибке БД (пауза удваивается с каждой попыткой)
+INGEST_RETRY_ATTEMPTS = int(os.getenv('INGEST_RETRY_ATTEMPTS', 5))
+INGEST_RETRY_BACKOFF = float(os.getenv('INGEST_RETRY_BACKOFF', 0.5))
+
+# ——— ИСТОРИЯ ТЕЛЕМЕТРИИ ———
+# Каталог сегментов (по умолчанию instance/telemetry)
+TELEMETRY_DIR = os.getenv('TELEMETRY_DIR')
+# Срок хранения уровней в секундах: raw, 1m, 15m
+TELEMETRY_RETENTION = {
+    'raw': int(os.getenv('TELEMETRY_RETENTION_RAW', 2 * 86400)),
+    '1m': int(os.getenv('TELEMETRY_RETENTION_1M', 30 * 86400)),
+    '15m': int(os.getenv('TELEMETRY_RETENTION_15M', 365 * 86400)),
+}
+
+# ——— ИНДЕКС ПАРКА ДЛЯ /api/scooters ———
+FLEET_INDEX_CELL_DEG = float(os.getenv('FLEET_INDEX_CELL_DEG', 0.01))
+SCOOTERS_PAGE_SIZE = int(os.getenv('SCOOTERS_PAGE_SIZE', 500))
+SCOOTERS_MAX_PAGE_SIZE = 5000
+SCOOTERS_MAX_RADIUS = 50000.0
+
+# ——— ПОТОК ИЗМЕНЕНИЙ /api/scooters/stream ———
+SCOOTERS_STREAM_HEARTBEAT = float(os.getenv('SCOOTERS_STREAM_HEARTBEAT', 15))
+SCOOTERS_STREAM_MIN_INTERVAL = float(os.getenv('SCOOTERS_STREAM_MIN_INTERVAL', 1))
+SCOOTERS_STREAM_MAX_DURATION = float(os.getenv('SCOOTERS_STREAM_MAX_DURATION', 600))
+
+# ——— FLESPI ———
+FLESPI_TOKEN = os.getenv('FLESPI_TOKEN', 'YOUR_FLESPI_TOKEN_HERE')
+# Можно указать локальную заглушку, например http://127.0.0.1:9000
+FLESPI_URL = os.getenv('FLESPI_URL', 'https://flespi.io')
+FLESPI_TIMEOUT = (
+    float(os.getenv('FLESPI_CONNECT_TIMEOUT', 3.05)),
+    float(os.getenv('FLESPI_READ_TIMEOUT', 10)),
+)
+FLESPI_POOL_SIZE = int(os.getenv('FLESPI_POOL_SIZE', 10))
+# Известные IMEI → ID устройства в Flespi (остальные ищутся через API и кэшируются)
+FLESPI_DEVICE_IDS = json.loads(os.getenv('FLESPI_DEVICE_IDS', '{"350544507678012": 7738860}'))
+COMMAND_WORKERS = int(os.getenv('COMMAND_WORKERS', 4))
+COMMAND_MAX_ATTEMPTS = int(os.getenv('COMMAND_MAX_ATTEMPTS', 4))
+COMMAND_BACKOFF = float(os.getenv('COMMAND_BACKOFF', 0.5))
+
+# ——— TELEGRAM MINI APP ———
+# Токен бота: с ним аренда принимает только подписанный initData Mini App.
+# Без токена (разработка, нагрузочный тест) пользователь берётся из telegram_id
+TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', '')
+TELEGRAM_INIT_DATA_MAX_AGE = int(os.getenv('TELEGRAM_INIT_DATA_MAX_AGE', 86400))
+
+# ——— ТАРИФ И УЧЁТ ПОЕЗДОК ———
+RIDE_START_FEE = float(os.getenv('RIDE_START_FEE', 50))
+RIDE_PRICE_PER_MINUTE = float(os.getenv('RIDE_PRICE_PER_MINUTE', 7))
+RIDE_MIN_STEP_M = float(os.getenv('RIDE_MIN_STEP_M', 3))
+RIDE_MAX_SPEED_KMH = float(os.getenv('RIDE_MAX_SPEED_KMH', 60))
+
+# ——— ГЕОЗОНЫ ———
+GEOFENCE_CELL_DEG = float(os.getenv('GEOFENCE_CELL_DEG', 0.005))
+# Как часто сверять зоны в БД с загруженными (flask zones-load в другом процессе)
+GEOFENCE_RELOAD_INTERVAL = float(os.getenv('GEOFENCE_RELOAD_INTERVAL', 60))
+# Команды по событиям геозон для самокатов в поездке (0 — только события)
+GEOFENCE_ENFORCE = os.getenv('GEOFENCE_ENFORCE', '1') == '1'
+GEOFENCE_DEFAULT_SPEED = int(os.getenv('GEOFENCE_DEFAULT_SPEED', 25))
+# Команда ограничения скорости зависит от прошивки контроллера самоката
+# (например, 'scsetmaxspeed {speed}'); пока не задана, скорость не ограничиваем
+GEOFENCE_SPEED_COMMAND = os.getenv('GEOFENCE_SPEED_COMMAND', '')
+
+# ——— АНАЛИТИКА ПАРКА ———
+# Пересчёт агрегатов в процессе сервера раз в N секунд (0 — только flask analytics-run)
+ANALYTICS_INTERVAL = float(os.getenv('ANALYTICS_INTERVAL', 300))
+# Глубина первого расчёта разряда батареи (не больше срока хранения raw)
+ANALYTICS_BACKFILL = float(os.getenv('ANALYTICS_BACKFILL', 86400))
+ANALYTICS_CELL_DEG = float(os.getenv('ANALYTICS_CELL_DEG', 0.005))
+# Часы суток для спроса считаются по местному времени
+ANALYTICS_UTC_OFFSET_HOURS = int(os.getenv('ANALYTICS_UTC_OFFSET_HOURS', 5))
+# Токен панели /api/admin/analytics (заголовок Authorization: Bearer ...);
+# пока не задан, панель закрыта
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+# ——— СТАТИКА MINI APP ———
+# Пересобирать кэш ассетов при изменении файлов (для разработки)
+ASSETS_RELOAD = os.getenv('ASSETS_RELOAD', '0') == '1'
+
+# ——— ЛОГИ И МЕТРИКИ ———
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+# json — одна строка JSON на запись, text — для чтения глазами
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# Записи сверх очереди отбрасываются, запрос на выводе не ждёт
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_SLOW_REQUEST_MS = float(os.getenv('LOG_SLOW_REQUEST_MS', 1000))
@@ -0,0 +1,40 @@
+"""Исходные таблицы user, scooter, ride (на уже существующих БД ничего не меняет)."""
+import sqlalchemy as sa
+
+
+def upgrade(conn):
+    metadata = sa.MetaData()
+    sa.Table(
+        'user', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('telegram_id', sa.BigInteger, unique=True, nullable=False),
+        sa.Column('phone', sa.String(20)),
+        sa.Column('card_token', sa.String(255)),
+        sa.Column('balance', sa.Float),
+        sa.Column('created_at', sa.DateTime),
+    )
+    sa.Table(
+        'scooter', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('imei', sa.String(15), unique=True, nullable=False),
+        sa.Column('lat', sa.Float),
+        sa.Column('lng', sa.Float),
+        sa.Column('battery', sa.Integer),
+        sa.Column('speed', sa.Float),
+        sa.Column('odometer', sa.BigInteger),
+        sa.Column('status', sa.String(20)),
+        sa.Column('current_user_id', sa.Integer, sa.ForeignKey('user.id')),
+        sa.Column('last_seen', sa.DateTime),
+    )
+    sa.Table(
+        'ride', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('user_id', sa.Integer, sa.ForeignKey('user.id'), nullable=False),
+        sa.Column('scooter_id', sa.Integer, sa.ForeignKey('scooter.id'), nullable=False),
+        sa.Column('start_time', sa.DateTime),
+        sa.Column('end_time', sa.DateTime),
+        sa.Column('distance_km', sa.Float),
+        sa.Column('cost', sa.Float),
+        sa.Column('status', sa.String(20)),
+    )
+    metadata.create_all(conn, checkfirst=True)
@@ -0,0 +1,15 @@
+"""Колонки speed, odometer, last_seen в старых таблицах scooter."""
+import sqlalchemy as sa
+
+COLUMNS = (
+    ('speed', 'FLOAT DEFAULT 0.0'),
+    ('odometer', 'BIGINT DEFAULT 0'),
+    ('last_seen', 'TIMESTAMP'),
+)
+
+
+def upgrade(conn):
+    existing = {column['name'] for column in sa.inspect(conn).get_columns('scooter')}
+    for name, ddl in COLUMNS:
+        if name not in existing:
+            conn.execute(sa.text(f"ALTER TABLE scooter ADD COLUMN {name} {ddl}"))
@@ -0,0 +1,8 @@
+"""Индекс для поиска активной поездки самоката."""
+import sqlalchemy as sa
+
+
+def upgrade(conn):
+    conn.execute(sa.text(
+        "CREATE INDEX IF NOT EXISTS ix_ride_scooter_status ON ride (scooter_id, status)"
+    ))
@@ -0,0 +1,24 @@
+"""Реальный самокат с TST100."""
+import sqlalchemy as sa
+
+IMEI = '350544507678012'
+
+
+def upgrade(conn):
+    exists = conn.execute(
+        sa.text("SELECT 1 FROM scooter WHERE imei = :imei"), {'imei': IMEI}
+    ).first()
+    if exists:
+        return
+    conn.execute(sa.text(
+        "INSERT INTO scooter (imei, lat, lng, battery, speed, odometer, status) "
+        "VALUES (:imei, :lat, :lng, :battery, :speed, :odometer, :status)"
+    ), {
+        'imei': IMEI,
+        'lat': 54.828638,
+        'lng': 55.866863,
+        'battery': 91,
+        'speed': 6.0,
+        'odometer': 3024291,
+        'status': 'available',
+    })
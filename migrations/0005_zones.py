@@ -0,0 +1,16 @@
+"""Геозоны: парковки, запретные для езды и зоны ограничения скорости."""
+import sqlalchemy as sa
+
+
+def upgrade(conn):
+    metadata = sa.MetaData()
+    sa.Table(
+        'zone', metadata,
+        sa.Column('id', sa.Integer, primary_key=True),
+        sa.Column('name', sa.String(100)),
+        sa.Column('kind', sa.String(20), nullable=False),
+        sa.Column('geometry', sa.Text, nullable=False),
+        sa.Column('speed_limit', sa.Integer),
+        sa.Column('active', sa.Boolean, nullable=False, server_default=sa.true()),
+    )
+    metadata.create_all(conn, checkfirst=True)
@@ -0,0 +1,63 @@
+"""Колонки для аналитики (остаток хода, место начала поездки) и таблицы агрегатов."""
+import sqlalchemy as sa
+
+COLUMNS = (
+    ('scooter', 'remaining_mileage', 'FLOAT'),
+    ('ride', 'start_lat', 'FLOAT'),
+    ('ride', 'start_lng', 'FLOAT'),
+)
+
+
+def upgrade(conn):
+    inspector = sa.inspect(conn)
+    for table, name, ddl in COLUMNS:
+        existing = {column['name'] for column in inspector.get_columns(table)}
+        if name not in existing:
+            conn.execute(sa.text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+    metadata = sa.MetaData()
+    sa.Table(
+        'analytics_state', metadata,
+        sa.Column('job', sa.String(50), primary_key=True),
+        sa.Column('watermark', sa.Float, nullable=False),
+        sa.Column('updated_at', sa.DateTime, nullable=False),
+    )
+    sa.Table(
+        'agg_battery_drain', metadata,
+        sa.Column('scooter_id', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('ride_drop', sa.Float, nullable=False),
+        sa.Column('ride_hours', sa.Float, nullable=False),
+        sa.Column('idle_drop', sa.Float, nullable=False),
+        sa.Column('idle_hours', sa.Float, nullable=False),
+        sa.Column('drain_per_hour', sa.Float, index=True),
+    )
+    sa.Table(
+        'agg_utilization_hourly', metadata,
+        sa.Column('hour_start', sa.BigInteger, primary_key=True, autoincrement=False),
+        sa.Column('ride_seconds', sa.Float, nullable=False),
+        sa.Column('rides_started', sa.Integer, nullable=False),
+        sa.Column('fleet_size', sa.Integer, nullable=False),
+        sa.Column('utilization', sa.Float, nullable=False),
+    )
+    sa.Table(
+        'agg_demand_cell', metadata,
+        sa.Column('cell_x', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('cell_y', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('rides', sa.Integer, nullable=False, index=True),
+    )
+    sa.Table(
+        'agg_demand_hour', metadata,
+        sa.Column('hour', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('rides', sa.Integer, nullable=False),
+    )
+    sa.Table(
+        'agg_remaining_mileage', metadata,
+        sa.Column('bucket_km', sa.Integer, primary_key=True, autoincrement=False),
+        sa.Column('scooters', sa.Integer, nullable=False),
+    )
+    sa.Table(
+        'agg_summary', metadata,
+        sa.Column('key', sa.String(50), primary_key=True),
+        sa.Column('value', sa.Float),
+    )
+    metadata.create_all(conn, checkfirst=True)
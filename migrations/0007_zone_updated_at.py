@@ -0,0 +1,8 @@
+"""Время изменения геозоны — по нему сервер замечает зоны, загруженные из CLI."""
+import sqlalchemy as sa
+
+
+def upgrade(conn):
+    existing = {column['name'] for column in sa.inspect(conn).get_columns('zone')}
+    if 'updated_at' not in existing:
+        conn.execute(sa.text("ALTER TABLE zone ADD COLUMN updated_at TIMESTAMP"))
@@ -0,0 +1,106 @@
+"""
+Версионные миграции схемы БД.
+
+Каждая миграция — файл NNNN_name.py с функцией upgrade(conn); применённые
+версии записываются в таблицу schema_version. Миграции запускаются один раз
+отдельной командой (flask --app app db-upgrade) или процессом-лидером,
+а не при импорте приложения.
+"""
+import importlib
+import os
+import re
+from datetime import datetime
+
+import click
+import sqlalchemy as sa
+
+_VERSION_FILE = re.compile(r'^(\d{4})_(\w+)\.py$')
+_PG_LOCK_KEY = 7738001
+
+schema_version = sa.Table(
+    'schema_version', sa.MetaData(),
+    sa.Column('version', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('name', sa.String(100), nullable=False),
+    sa.Column('applied_at', sa.DateTime, nullable=False),
+)
+
+
+def discover():
+    """Список (версия, имя, модуль) по порядку версий."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    result = []
+    for filename in sorted(os.listdir(directory)):
+        match = _VERSION_FILE.match(filename)
+        if match:
+            module = importlib.import_module(f"{__name__}.{filename[:-3]}")
+            result.append((int(match.group(1)), match.group(2), module))
+    return result
+
+
+def applied_versions(conn):
+    if not sa.inspect(conn).has_table(schema_version.name):
+        return set()
+    return set(conn.execute(sa.select(schema_version.c.version)).scalars())
+
+
+def _lock(conn):
+    """Не даёт двум процессам применять миграции одновременно."""
+    if conn.dialect.name == 'postgresql':
+        conn.execute(sa.text("SELECT pg_advisory_xact_lock(:key)"), {'key': _PG_LOCK_KEY})
+    else:
+        # Первая запись в транзакции SQLite берёт блокировку на запись до коммита
+        conn.execute(schema_version.update().where(sa.false()).values(name=''))
+
+
+def upgrade(engine, target=None, log=print):
+    """Применяет недостающие миграции (до target включительно). Возвращает их версии."""
+    migrations = [m for m in discover() if target is None or m[0] <= target]
+    with engine.connect() as conn:
+        done = applied_versions(conn)
+    pending = [m for m in migrations if m[0] not in done]
+    if not pending:
+        return []
+
+    with engine.begin() as conn:
+        schema_version.create(conn, checkfirst=True)
+
+    applied = []
+    for version, name, module in pending:
+        with engine.begin() as conn:
+            _lock(conn)
+            # Пока ждали блокировку, миграцию мог применить другой процесс
+            if version in applied_versions(conn):
+                continue
+            module.upgrade(conn)
+            conn.execute(schema_version.insert().values(
+                version=version, name=name, applied_at=datetime.utcnow()
+            ))
+        applied.append(version)
+        log(f"✅ Миграция {version:04d}_{name} применена")
+    return applied
+
+
+def status(engine):
+    """Список (версия, имя, применена ли)."""
+    with engine.connect() as conn:
+        done = applied_versions(conn)
+    return [(version, name, version in done) for version, name, _ in discover()]
+
+
+def init_app(app):
+    """Регистрирует команды flask db-upgrade и flask db-status."""
+    from models import db
+
+    @app.cli.command('db-upgrade')
+    @click.option('--target', type=int, default=None, help="Применить миграции до этой версии")
+    def db_upgrade(target):
+        """Применить миграции схемы БД."""
+        applied = upgrade(db.engine, target=target)
+        if not applied:
+            click.echo("Схема БД актуальна")
+
+    @app.cli.command('db-status')
+    def db_status():
+        """Показать применённые и ожидающие миграции."""
+        for version, name, done in status(db.engine):
+            click.echo(f"{'✅' if done else '⏳'} {version:04d}_{name}")
@@ -0,0 +1,9 @@
+"""python -m migrations — применить миграции к БД из config.py."""
+from app import app
+from migrations import upgrade
+from models import db
+
+if __name__ == '__main__':
+    with app.app_context():
+        if not upgrade(db.engine):
+            print("Схема БД актуальна")
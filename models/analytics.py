@@ -0,0 +1,108 @@
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+
+from . import db
+
+# Таблицы предрасчитанной аналитики парка (создаются миграцией 0006).
+# Их пишет только фоновое задание services/analytics.py, а панель
+# администратора читает их целиком или по первичному ключу.
+
+analytics_state = db.Table(
+    'analytics_state',
+    sa.Column('job', sa.String(50), primary_key=True),
+    sa.Column('watermark', sa.Float, nullable=False),
+    sa.Column('updated_at', sa.DateTime, nullable=False),
+)
+
+agg_battery_drain = db.Table(
+    'agg_battery_drain',
+    sa.Column('scooter_id', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('ride_drop', sa.Float, nullable=False),
+    sa.Column('ride_hours', sa.Float, nullable=False),
+    sa.Column('idle_drop', sa.Float, nullable=False),
+    sa.Column('idle_hours', sa.Float, nullable=False),
+    sa.Column('drain_per_hour', sa.Float, index=True),
+)
+
+agg_utilization_hourly = db.Table(
+    'agg_utilization_hourly',
+    sa.Column('hour_start', sa.BigInteger, primary_key=True, autoincrement=False),
+    sa.Column('ride_seconds', sa.Float, nullable=False),
+    sa.Column('rides_started', sa.Integer, nullable=False),
+    sa.Column('fleet_size', sa.Integer, nullable=False),
+    sa.Column('utilization', sa.Float, nullable=False),
+)
+
+agg_demand_cell = db.Table(
+    'agg_demand_cell',
+    sa.Column('cell_x', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('cell_y', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('rides', sa.Integer, nullable=False, index=True),
+)
+
+agg_demand_hour = db.Table(
+    'agg_demand_hour',
+    sa.Column('hour', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('rides', sa.Integer, nullable=False),
+)
+
+agg_remaining_mileage = db.Table(
+    'agg_remaining_mileage',
+    sa.Column('bucket_km', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('scooters', sa.Integer, nullable=False),
+)
+
+agg_summary = db.Table(
+    'agg_summary',
+    sa.Column('key', sa.String(50), primary_key=True),
+    sa.Column('value', sa.Float),
+)
+
+
+def upsert(table, rows, add=(), replace=()):
+    """
+    INSERT ... ON CONFLICT (первичный ключ) DO UPDATE одной командой:
+    колонки add прибавляются к старым значениям, replace — перезаписываются.
+    """
+    if not rows:
+        return
+    dialect = db.session.get_bind().dialect.name
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    statement = insert(table)
+    values = {name: table.c[name] + statement.excluded[name] for name in add}
+    values.update({name: statement.excluded[name] for name in replace})
+    keys = [column.name for column in table.primary_key.columns]
+    db.session.execute(statement.on_conflict_do_update(index_elements=keys, set_=values), rows)
+
+
+def get_watermark(job):
+    return db.session.execute(
+        sa.select(analytics_state.c.watermark).where(analytics_state.c.job == job)
+    ).scalar()
+
+
+def advance_watermark(job, old, new, now):
+    """
+    Compare-and-set отметки задания: False, если её уже сдвинул
+    параллельный запуск (тогда его агрегаты уже учтены и наш нужно откатить).
+    """
+    if old is None:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(analytics_state.insert().values(job=job, watermark=new, updated_at=now))
+            return True
+        except sa.exc.IntegrityError:
+            return False
+    result = db.session.execute(
+        analytics_state.update()
+        .where(analytics_state.c.job == job, analytics_state.c.watermark == old)
+        .values(watermark=new, updated_at=now)
+    )
+    return result.rowcount == 1
+
+
+def job_states():
+    return {
+        job: {'watermark': watermark, 'updated_at': updated_at.isoformat() + 'Z'}
+        for job, watermark, updated_at in db.session.execute(sa.select(analytics_state)).all()
+    }
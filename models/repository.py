@@ -0,0 +1,215 @@
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy import bindparam, case, func, select, update
+from sqlalchemy.exc import IntegrityError
+
+from . import db
+from .ride import Ride
+from .scooter import Scooter
+from .user import User
+from .zone import Zone
+
+# Горячие запросы приложения. Массовые обновления пишутся по-разному
+# для бэкендов: в SQLite executemany дешёв (всё в процессе), а в PostgreSQL
+# это круг по сети на строку, поэтому там один UPDATE ... FROM (VALUES ...).
+
+_scooter = Scooter.__table__
+_ride = Ride.__table__
+_zone = Zone.__table__
+
+TELEMETRY_COLUMNS = (
+    ('lat', sa.Float),
+    ('lng', sa.Float),
+    ('battery', sa.Integer),
+    ('speed', sa.Float),
+    ('odometer', sa.BigInteger),
+    ('status', sa.String),
+    ('remaining_mileage', sa.Float),
+    ('last_seen', sa.DateTime),
+)
+
+RIDE_PROGRESS_COLUMNS = (
+    ('distance_km', sa.Float),
+    ('cost', sa.Float),
+)
+
+
+def _is_postgres():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def _telemetry_values(source):
+    """
+    SET для телеметрии: пустые значения не затирают старые.
+    source(name, type_) — типизированное выражение нового значения.
+    """
+    values = {}
+    for name, type_ in TELEMETRY_COLUMNS:
+        new = source(name, type_)
+        if name == 'last_seen':
+            values[name] = new
+        elif name == 'status':
+            # Статус арендованного самоката меняет только движок поездок
+            values[name] = case(
+                (_scooter.c.status == 'in_use', _scooter.c.status),
+                else_=func.coalesce(new, _scooter.c.status),
+            )
+        else:
+            values[name] = func.coalesce(new, _scooter.c[name])
+    return values
+
+
+_TELEMETRY_EXECUTEMANY = (
+    update(_scooter)
+    .where(_scooter.c.id == bindparam('b_id'))
+    .values(_telemetry_values(lambda name, type_: bindparam('b_' + name, type_=type_)))
+)
+
+_RIDE_PROGRESS_EXECUTEMANY = (
+    update(_ride)
+    .where(_ride.c.id == bindparam('b_id'), _ride.c.status == 'active')
+    .values({name: bindparam('b_' + name, type_=type_) for name, type_ in RIDE_PROGRESS_COLUMNS})
+)
+
+
+def _values_table(name, columns, rows):
+    """(VALUES ...) AS name(id, ...) для UPDATE ... FROM в PostgreSQL."""
+    table = sa.values(
+        sa.column('id', sa.Integer),
+        *(sa.column(column, type_) for column, type_ in columns),
+        name=name,
+    )
+    return table.data([tuple(row[key] for key in ('id',) + tuple(c for c, _ in columns)) for row in rows])
+
+
+def bulk_update_telemetry(rows):
+    """
+    Обновляет самокаты пачкой. rows — словари id + TELEMETRY_COLUMNS
+    (None — не менять). Коммит делает вызывающий.
+    """
+    if not rows:
+        return
+    if _is_postgres():
+        source = _values_table('v', TELEMETRY_COLUMNS, rows)
+        db.session.execute(
+            update(_scooter)
+            .where(_scooter.c.id == source.c.id)
+            .values(_telemetry_values(lambda name, type_: sa.cast(source.c[name], type_)))
+        )
+    else:
+        db.session.execute(_TELEMETRY_EXECUTEMANY, [
+            {'b_' + key: value for key, value in row.items()} for row in rows
+        ])
+
+
+def update_ride_progress(rows):
+    """Пробег и стоимость активных поездок. rows — словари id, distance_km, cost."""
+    if not rows:
+        return
+    if _is_postgres():
+        source = _values_table('v', RIDE_PROGRESS_COLUMNS, rows)
+        db.session.execute(
+            update(_ride)
+            .where(_ride.c.id == source.c.id, _ride.c.status == 'active')
+            .values({name: sa.cast(source.c[name], type_) for name, type_ in RIDE_PROGRESS_COLUMNS})
+        )
+    else:
+        db.session.execute(_RIDE_PROGRESS_EXECUTEMANY, [
+            {'b_' + key: value for key, value in row.items()} for row in rows
+        ])
+
+
+def scooter_ids(imeis=None):
+    """Пары (id, imei): все или только для переданных IMEI."""
+    query = select(_scooter.c.id, _scooter.c.imei)
+    if imeis is not None:
+        query = query.where(_scooter.c.imei.in_(list(imeis)))
+    return db.session.execute(query).all()
+
+
+def scooter_rows(fields):
+    """Все самокаты, только перечисленные колонки."""
+    return db.session.execute(select(*(_scooter.c[name] for name in fields))).all()
+
+
+def scooter_imei(scooter_id):
+    return db.session.execute(
+        select(_scooter.c.imei).where(_scooter.c.id == scooter_id)
+    ).scalar()
+
+
+def scooter_exists(scooter_id):
+    return scooter_imei(scooter_id) is not None
+
+
+def transition_scooter(scooter_id, from_status, to_status, user_id=None, holder_id=None):
+    """
+    Compare-and-set статуса: один UPDATE ... WHERE status = from_status
+    (и current_user_id = holder_id, если он задан) RETURNING imei, lat, lng.
+    None — самокат уже в другом состоянии или у другого пользователя.
+    """
+    conditions = [_scooter.c.id == scooter_id, _scooter.c.status == from_status]
+    if holder_id is not None:
+        conditions.append(_scooter.c.current_user_id == holder_id)
+    return db.session.execute(
+        update(_scooter)
+        .where(*conditions)
+        .values(status=to_status, current_user_id=user_id)
+        .returning(_scooter.c.imei, _scooter.c.lat, _scooter.c.lng)
+    ).first()
+
+
+def active_rides():
+    """(id, scooter_id, start_time, distance_km) всех незакрытых поездок."""
+    return db.session.execute(
+        select(_ride.c.id, _ride.c.scooter_id, _ride.c.start_time, _ride.c.distance_km)
+        .where(_ride.c.status == 'active')
+    ).all()
+
+
+def active_ride(scooter_id):
+    return Ride.query.filter_by(scooter_id=scooter_id, status='active') \
+        .order_by(Ride.id.desc()).first()
+
+
+def get_or_create_user(telegram_id):
+    user = User.query.filter_by(telegram_id=telegram_id).first()
+    if user is None:
+        user = User(telegram_id=telegram_id)
+        db.session.add(user)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Параллельный запрос уже создал пользователя
+            db.session.rollback()
+            user = User.query.filter_by(telegram_id=telegram_id).first()
+    return user
+
+
+def zone_rows():
+    """(id, name, kind, geometry, speed_limit) активных геозон."""
+    return db.session.execute(
+        select(_zone.c.id, _zone.c.name, _zone.c.kind, _zone.c.geometry, _zone.c.speed_limit)
+        .where(_zone.c.active.is_(True))
+        .order_by(_zone.c.id)
+    ).all()
+
+
+def zone_version():
+    """(число, время последнего изменения) активных геозон — дёшево сравнить с загруженными."""
+    return tuple(db.session.execute(
+        select(func.count(), func.max(_zone.c.updated_at)).where(_zone.c.active.is_(True))
+    ).one())
+
+
+def add_zones(rows, replace=False):
+    """
+    Добавляет геозоны (словари name, kind, geometry, speed_limit).
+    replace=True — прежние зоны удаляются. Коммит делает вызывающий.
+    """
+    if replace:
+        db.session.execute(sa.delete(_zone))
+    if rows:
+        now = datetime.utcnow()
+        db.session.execute(sa.insert(_zone), [dict(row, active=True, updated_at=now) for row in rows])
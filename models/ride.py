@@ -8,4 +8,6 @@ class Ride(db.Model):
     end_time = db.Column(db.DateTime)
     distance_km = db.Column(db.Float)
     cost = db.Column(db.Float)
-    status = db.Column(db.String(20), default='active')
\ No newline at end of file
+    status = db.Column(db.String(20), default='active')
+    start_lat = db.Column(db.Float)
+    start_lng = db.Column(db.Float)
\ No newline at end of file
@@ -10,4 +10,5 @@ class Scooter(db.Model):
     odometer = db.Column(db.BigInteger, default=0)
     status = db.Column(db.String(20), default='available')
     current_user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    last_seen = db.Column(db.DateTime)
\ No newline at end of file
+    last_seen = db.Column(db.DateTime)
+    remaining_mileage = db.Column(db.Float)   # км, predicted.remaining.mileage
\ No newline at end of file
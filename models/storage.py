@@ -0,0 +1,74 @@
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+from . import db
+
+# Настройки движка БД под конкретный бэкенд:
+# SQLite — WAL, busy_timeout и synchronous при каждом подключении;
+# PostgreSQL — пул нужного размера, pre-ping и statement_timeout.
+
+
+def backend(url):
+    """'sqlite' или 'postgresql' (по схеме URL)."""
+    return make_url(url).get_backend_name()
+
+
+def engine_options(url, config):
+    """SQLALCHEMY_ENGINE_OPTIONS для URL с учётом настроек из config."""
+    name = backend(url)
+    if name == 'sqlite':
+        return {
+            # Ожидание блокировки на уровне драйвера (сек) — дублирует busy_timeout
+            'connect_args': {
+                'timeout': config.get('SQLITE_BUSY_TIMEOUT_MS', 5000) / 1000,
+                'check_same_thread': False,
+            },
+        }
+    if name == 'postgresql':
+        statement_timeout = int(config.get('DB_STATEMENT_TIMEOUT_MS', 5000))
+        return {
+            'pool_size': config.get('DB_POOL_SIZE', 10),
+            'max_overflow': config.get('DB_MAX_OVERFLOW', 20),
+            'pool_timeout': config.get('DB_POOL_TIMEOUT', 10),
+            'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+            'pool_pre_ping': True,
+            'connect_args': {
+                'options': f"-c statement_timeout={statement_timeout}",
+                'application_name': 'scooter-rental-tma',
+                'connect_timeout': config.get('DB_CONNECT_TIMEOUT', 5),
+            },
+        }
+    return {}
+
+
+def _sqlite_pragmas(config):
+    busy_timeout = int(config.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    synchronous = str(config.get('SQLITE_SYNCHRONOUS', 'NORMAL')).upper()
+    if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+        raise ValueError(f"Invalid SQLITE_SYNCHRONOUS: {synchronous}")
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            # WAL: читатели не блокируют писателя и наоборот
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA busy_timeout={busy_timeout}")
+            # В WAL режим NORMAL надёжен и не делает fsync на каждый коммит
+            cursor.execute(f"PRAGMA synchronous={synchronous}")
+            cursor.execute("PRAGMA temp_store=MEMORY")
+        finally:
+            cursor.close()
+
+    return on_connect
+
+
+def init_app(app):
+    """
+    Вызывается после db.init_app(app): вешает настройку подключений SQLite.
+    Сам движок к БД не подключается.
+    """
+    url = app.config['SQLALCHEMY_DATABASE_URI']
+    if backend(url) != 'sqlite' or make_url(url).database in (None, '', ':memory:'):
+        return
+    with app.app_context():
+        event.listen(db.engine, 'connect', _sqlite_pragmas(app.config))
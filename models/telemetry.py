@@ -0,0 +1,468 @@
+import atexit
+import math
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+# История телеметрии хранится не в SQL-таблице, а в append-only сегментах:
+# на каждый IMEI и уровень детализации — файлы по отрезкам времени,
+# внутри — колонки array (ts, lat, lng, speed, battery, odometer), сжатые zlib.
+
+# Уровни: (имя, шаг усреднения в секундах, длина сегмента, срок хранения)
+TIERS = (
+    ('raw', 0, 900, 2 * 86400),
+    ('1m', 60, 86400, 30 * 86400),
+    ('15m', 900, 7 * 86400, 365 * 86400),
+)
+
+COLUMNS = (
+    ('ts', 'd'),
+    ('lat', 'd'),
+    ('lng', 'd'),
+    ('speed', 'f'),
+    ('battery', 'b'),     # -1 — нет данных
+    ('odometer', 'q'),    # -1 — нет данных
+)
+
+_MAGIC = b'TLM1'
+_HEADER = struct.Struct('<4sdI')
+_NAN = float('nan')
+
+
+# Допустимые значения целочисленных колонок; остальное хранится как «нет данных»
+_INT_RANGES = {
+    'battery': (0, 100),
+    'odometer': (0, 2 ** 63 - 1),
+}
+
+
+def _encode(column, value):
+    if column in _INT_RANGES:
+        if value is None:
+            return -1
+        low, high = _INT_RANGES[column]
+        value = int(value)
+        return value if low <= value <= high else -1
+    if column == 'ts':
+        return float(value)
+    return _NAN if value is None else float(value)
+
+
+def _encode_point(point):
+    """Все колонки точки сразу: ошибка не оставит колонки разной длины."""
+    return [_encode(name, point.get(name)) for name, _ in COLUMNS]
+
+
+def _decode(column, value):
+    if column in ('battery', 'odometer'):
+        return None if value < 0 else value
+    if column != 'ts' and math.isnan(value):
+        return None
+    return value
+
+
+class Segment:
+    """Отрезок истории одного IMEI: колонки array, отсортированные по ts."""
+
+    def __init__(self, start):
+        self.start = start
+        self.columns = {name: array(code) for name, code in COLUMNS}
+        self.dirty = False
+
+    def __len__(self):
+        return len(self.columns['ts'])
+
+    def append(self, point):
+        values = _encode_point(point)
+        ts = self.columns['ts']
+        if not ts or values[0] >= ts[-1]:
+            for (name, _), value in zip(COLUMNS, values):
+                self.columns[name].append(value)
+        else:
+            # Редкий случай: сообщение пришло не по порядку
+            i = bisect_right(ts, values[0])
+            for (name, _), value in zip(COLUMNS, values):
+                self.columns[name].insert(i, value)
+        self.dirty = True
+
+    def copy(self):
+        segment = Segment(self.start)
+        for name, _ in COLUMNS:
+            segment.columns[name] = array(self.columns[name].typecode, self.columns[name])
+        return segment
+
+    def read(self, start, end):
+        ts = self.columns['ts']
+        lo = bisect_left(ts, start)
+        hi = bisect_right(ts, end)
+        cols = [(name, self.columns[name]) for name, _ in COLUMNS]
+        return [
+            {name: _decode(name, col[i]) for name, col in cols}
+            for i in range(lo, hi)
+        ]
+
+    def to_bytes(self):
+        parts = [_HEADER.pack(_MAGIC, self.start, len(self))]
+        for name, _ in COLUMNS:
+            col = self.columns[name]
+            if sys.byteorder != 'little':
+                col = array(col.typecode, col)
+                col.byteswap()
+            parts.append(col.tobytes())
+        return zlib.compress(b''.join(parts), 1)
+
+    @classmethod
+    def from_bytes(cls, blob):
+        raw = zlib.decompress(blob)
+        magic, start, count = _HEADER.unpack_from(raw)
+        if magic != _MAGIC:
+            raise ValueError("Not a telemetry segment")
+        segment = cls(start)
+        offset = _HEADER.size
+        for name, code in COLUMNS:
+            col = segment.columns[name]
+            size = col.itemsize * count
+            col.frombytes(raw[offset:offset + size])
+            if sys.byteorder != 'little':
+                col.byteswap()
+            offset += size
+        return segment
+
+
+class _Bucket:
+    """Накопитель для уровня с усреднением: последняя позиция, средняя скорость."""
+
+    __slots__ = ('start', 'count', 'speed_sum', 'speed_count', 'last')
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.speed_sum = 0.0
+        self.speed_count = 0
+        self.last = {}
+
+    def add(self, point):
+        self.count += 1
+        if point.get('speed') is not None:
+            self.speed_sum += point['speed']
+            self.speed_count += 1
+        for name in ('lat', 'lng', 'battery', 'odometer'):
+            if point.get(name) is not None:
+                self.last[name] = point[name]
+
+    def point(self):
+        result = dict(self.last)
+        result['ts'] = self.start
+        result['speed'] = self.speed_sum / self.speed_count if self.speed_count else None
+        return result
+
+
+class TelemetryStore:
+    """
+    Append-only история телеметрии по IMEI.
+
+    Открытые сегменты держим в памяти и раз в maintain_interval сбрасываем
+    изменённые на диск (при остановке — все, вместе с незакрытыми интервалами
+    1m/15m), закрытые лежат на диске и при чтении попадают в небольшой
+    LRU-кэш. Уровни 1m и 15m заполняются на лету при записи сырых точек,
+    устаревшие сегменты удаляются по сроку хранения.
+    """
+
+    def __init__(self, root=None):
+        self.root = root
+        self.tiers = TIERS
+        self.cache_size = 64
+        self.maintain_interval = 60.0
+        self.retention_interval = 3600.0
+        self._open = {}       # (imei, tier) → Segment
+        self._buckets = {}    # (imei, tier) → _Bucket
+        self._emitted = {}    # (imei, tier) → начало последнего записанного интервала
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+        self._cache_lock = threading.Lock()
+        # Дописывание прошлых сегментов идёт без общей блокировки, но один
+        # сегмент за раз: блокировка из пула по хэшу ключа
+        self._merge_locks = [threading.Lock() for _ in range(64)]
+        self._last_maintain = 0.0
+        self._last_retention = 0.0
+
+    def init_app(self, app):
+        self.root = app.config.get('TELEMETRY_DIR') or os.path.join(app.instance_path, 'telemetry')
+        retention = app.config.get('TELEMETRY_RETENTION') or {}
+        self.tiers = tuple(
+            (name, step, span, retention.get(name, keep))
+            for name, step, span, keep in TIERS
+        )
+        app.extensions['telemetry_store'] = self
+        atexit.register(self.flush)
+
+    # ——— Запись ———
+
+    def append_many(self, points):
+        """Пачка точек (словари с imei, ts, lat, lng, speed, battery, odometer)."""
+        late = {}   # (imei, tier, начало сегмента) → опоздавшие точки
+        with self._lock:
+            for point in points:
+                imei = point['imei']
+                if not imei.isalnum():
+                    continue
+                for name, step, span, _ in self.tiers:
+                    if step == 0:
+                        self._append(imei, name, span, point, late)
+                        continue
+                    bucket_start = point['ts'] - point['ts'] % step
+                    key = (imei, name)
+                    emitted = self._emitted.get(key)
+                    if emitted is None:
+                        emitted = self._emitted[key] = self._last_ts(imei, name, span, point['ts'])
+                    if bucket_start <= emitted:
+                        # Точки из уже закрытых интервалов есть только в raw
+                        continue
+                    bucket = self._buckets.get(key)
+                    if bucket is None or bucket_start > bucket.start:
+                        if bucket is not None:
+                            self._emit(imei, name, span, bucket, late)
+                        bucket = self._buckets[key] = _Bucket(bucket_start)
+                    if bucket_start == bucket.start:
+                        bucket.add(point)
+
+        # Опоздавшие точки (Flespi досылает буфер после переподключения):
+        # каждый прошлый сегмент перечитывается и пишется один раз на пачку
+        for (imei, tier, seg_start), group in late.items():
+            self._merge(imei, tier, seg_start, group)
+
+        now = time.time()
+        if now - self._last_maintain >= self.maintain_interval:
+            self.maintain(now)
+
+    def _emit(self, imei, tier, span, bucket, late=None):
+        self._append(imei, tier, span, bucket.point(), late)
+        self._emitted[(imei, tier)] = bucket.start
+
+    def _last_ts(self, imei, tier, span, ts):
+        """Последняя записанная точка уровня (после перезапуска — с диска)."""
+        seg_start = ts - ts % span
+        segment = self._open.get((imei, tier))
+        if segment is None or segment.start != seg_start:
+            segment = self._load(imei, tier, seg_start)
+        return segment.columns['ts'][-1] if segment is not None and len(segment) else -1.0
+
+    def _append(self, imei, tier, span, point, late=None):
+        seg_start = point['ts'] - point['ts'] % span
+        key = (imei, tier)
+        segment = self._open.get(key)
+        if segment is not None and segment.start != seg_start:
+            if seg_start < segment.start:
+                # Опоздавшая точка из прошлого сегмента — допишем его на диске
+                if late is None:
+                    self._merge(imei, tier, seg_start, [point])
+                else:
+                    late.setdefault((imei, tier, seg_start), []).append(point)
+                return
+            self._write(imei, tier, segment)
+            segment = None
+        if segment is None:
+            segment = self._open[key] = self._load(imei, tier, seg_start) or Segment(seg_start)
+        segment.append(point)
+
+    def _merge(self, imei, tier, seg_start, points):
+        """
+        Дописывает точки в закрытый сегмент. Сегмент из кэша могут читать
+        параллельно, поэтому меняем копию и подменяем её целиком.
+        """
+        with self._merge_locks[hash((imei, tier, seg_start)) % len(self._merge_locks)]:
+            old = self._load(imei, tier, seg_start)
+            segment = old.copy() if old is not None else Segment(seg_start)
+            for point in sorted(points, key=lambda p: p['ts']):
+                segment.append(point)
+            self._write(imei, tier, segment)
+
+    # ——— Чтение ———
+
+    def query(self, imei, start, end, tier=None):
+        """
+        Точки IMEI за [start, end]. Без явного tier берётся самый подробный
+        уровень, у которого начало интервала ещё не вышло за срок хранения.
+        """
+        if tier is None:
+            age = time.time() - start
+            tier = next((name for name, _, _, keep in self.tiers if age <= keep), self.tiers[-1][0])
+        span = self._span(tier)
+
+        with self._lock:
+            current = self._open.get((imei, tier))
+            current_rows = current.read(start, end) if current is not None else []
+            current_start = current.start if current is not None else None
+
+        rows = []
+        for seg_start in self._segment_starts(imei, tier):
+            if seg_start == current_start or seg_start + span < start or seg_start > end:
+                continue
+            segment = self._load(imei, tier, seg_start)
+            if segment is not None:
+                rows.extend(segment.read(start, end))
+        if current_rows:
+            rows.extend(current_rows)
+            rows.sort(key=lambda r: r['ts'])
+        return rows
+
+    def columns(self, imei, start, end, tier='raw', names=None):
+        """
+        Колонки IMEI за [start, end] без разбора в словари — для пакетной
+        аналитики. Значения в кодировке хранения (battery/odometer -1, NaN —
+        нет данных); результат отсортирован по ts.
+        """
+        names = tuple(names or (name for name, _ in COLUMNS))
+        if 'ts' not in names:
+            names = ('ts',) + names
+        span = self._span(tier)
+        result = {name: array(dict(COLUMNS)[name]) for name in names}
+
+        def take(segment, into):
+            ts = segment.columns['ts']
+            lo = bisect_left(ts, start)
+            hi = bisect_right(ts, end)
+            for name in names:
+                into[name].extend(segment.columns[name][lo:hi])
+
+        # Открытый сегмент и список файлов — одним снимком под блокировкой,
+        # чтобы сегмент, сброшенный на диск в это время, не потерялся и не задвоился
+        tail = {name: array(dict(COLUMNS)[name]) for name in names}
+        with self._lock:
+            current = self._open.get((imei, tier))
+            current_start = current.start if current is not None else None
+            if current is not None:
+                take(current, tail)
+            starts = self._segment_starts(imei, tier)
+        for seg_start in starts:
+            if seg_start == current_start or seg_start + span < start or seg_start > end:
+                continue
+            segment = self._load(imei, tier, seg_start)
+            if segment is not None:
+                take(segment, result)
+        for name in names:
+            result[name].extend(tail[name])
+        return result
+
+    # ——— Обслуживание ———
+
+    def maintain(self, now=None):
+        """
+        Сбрасывает на диск изменённые открытые сегменты (простаивающие при
+        этом закрываются) и удаляет устаревшие.
+        """
+        now = now or time.time()
+        self._last_maintain = now
+        with self._lock:
+            for (imei, tier), bucket in list(self._buckets.items()):
+                step = self._step(tier)
+                if bucket.start + step * 2 < now:
+                    self._emit(imei, tier, self._span(tier), bucket)
+                    del self._buckets[(imei, tier)]
+            for (imei, tier), segment in list(self._open.items()):
+                if segment.dirty:
+                    self._write(imei, tier, segment)
+                if segment.start + self._span(tier) < now:
+                    del self._open[(imei, tier)]
+        if now - self._last_retention >= self.retention_interval:
+            self.enforce_retention(now)
+
+    def flush(self):
+        """
+        Пишет на диск незакрытые интервалы 1m/15m и все открытые сегменты —
+        при остановке процесса (atexit; SIGTERM переводится в обычный выход).
+        """
+        with self._lock:
+            for (imei, tier), bucket in list(self._buckets.items()):
+                self._emit(imei, tier, self._span(tier), bucket)
+            self._buckets.clear()
+            for (imei, tier), segment in self._open.items():
+                if segment.dirty:
+                    self._write(imei, tier, segment)
+
+    def enforce_retention(self, now=None):
+        now = now or time.time()
+        self._last_retention = now
+        if not self.root or not os.path.isdir(self.root):
+            return
+        for imei in os.listdir(self.root):
+            for name, _, span, keep in self.tiers:
+                for seg_start in self._segment_starts(imei, name):
+                    if seg_start + span < now - keep:
+                        try:
+                            os.remove(self._path(imei, name, seg_start))
+                        except OSError:
+                            pass
+                        with self._cache_lock:
+                            self._cache.pop((imei, name, seg_start), None)
+
+    # ——— Файлы ———
+
+    def _path(self, imei, tier, seg_start):
+        if not imei.isalnum():
+            raise ValueError(f"Invalid IMEI: {imei!r}")
+        return os.path.join(self.root, imei, tier, f"{int(seg_start)}.seg")
+
+    def _segment_starts(self, imei, tier):
+        if not imei.isalnum():
+            return []
+        directory = os.path.join(self.root, imei, tier)
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            return []
+        return sorted(float(n[:-4]) for n in names if n.endswith('.seg'))
+
+    def _load(self, imei, tier, seg_start):
+        key = (imei, tier, seg_start)
+        with self._cache_lock:
+            segment = self._cache.get(key)
+            if segment is not None:
+                self._cache.move_to_end(key)
+                return segment
+        try:
+            with open(self._path(imei, tier, seg_start), 'rb') as f:
+                segment = Segment.from_bytes(f.read())
+        except (OSError, ValueError, zlib.error):
+            return None
+        self._remember(key, segment)
+        return segment
+
+    def _write(self, imei, tier, segment):
+        path = self._path(imei, tier, segment.start)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Своё временное имя у каждого потока: чужой недописанный файл не подменит наш
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(segment.to_bytes())
+        os.replace(tmp, path)
+        segment.dirty = False
+        self._remember((imei, tier, segment.start), segment)
+
+    def _remember(self, key, segment):
+        with self._cache_lock:
+            self._cache[key] = segment
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _span(self, tier):
+        for name, _, span, _ in self.tiers:
+            if name == tier:
+                return span
+        raise ValueError(f"Unknown tier: {tier}")
+
+    def _step(self, tier):
+        for name, step, _, _ in self.tiers:
+            if name == tier:
+                return step
+        raise ValueError(f"Unknown tier: {tier}")
+
+
+telemetry_store = TelemetryStore()
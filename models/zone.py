@@ -0,0 +1,10 @@
+from . import db
+
+class Zone(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100))
+    kind = db.Column(db.String(20), nullable=False)       # parking | no_ride | slow
+    geometry = db.Column(db.Text, nullable=False)         # GeoJSON Polygon: координаты [[[lng, lat], ...], ...]
+    speed_limit = db.Column(db.Integer)                   # км/ч, для slow
+    active = db.Column(db.Boolean, default=True, nullable=False)
+    updated_at = db.Column(db.DateTime)
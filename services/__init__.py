@@ -0,0 +1 @@
+# Фоновые подсистемы приложения (приём телеметрии и т.д.)
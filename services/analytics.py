@@ -0,0 +1,439 @@
+import logging
+import threading
+import time
+from datetime import datetime
+
+import click
+import numpy as np
+import sqlalchemy as sa
+
+from models import analytics as agg
+from models import db
+from models.ride import Ride
+from models.scooter import Scooter
+from models.telemetry import telemetry_store
+
+logger = logging.getLogger(__name__)
+
+_EPOCH = np.datetime64('1970-01-01T00:00:00', 'us')
+
+
+def _epoch_seconds(values, default):
+    """Список naive-UTC datetime (None → default) → float64 unix-время."""
+    stamps = np.array([v if v is not None else datetime.utcfromtimestamp(default) for v in values],
+                      dtype='datetime64[us]')
+    return (stamps - _EPOCH).astype(np.int64) / 1e6
+
+
+class FleetAnalytics:
+    """
+    Пакетная аналитика парка с предрасчитанными агрегатами.
+
+    Данные читаются пачками в массивы NumPy (история телеметрии — прямо из
+    колонок сегментов, поездки — одним SELECT) и считаются векторно.
+    Каждое задание помнит отметку (watermark) в analytics_state и при
+    следующем запуске обрабатывает только новое: суммы прибавляются к уже
+    сохранённым агрегатам. Отметка сдвигается compare-and-set в той же
+    транзакции, что и агрегаты, так что параллельный запуск ничего не задвоит.
+
+    Запуск: flask --app app analytics-run (cron) или в процессе сервера
+    каждые ANALYTICS_INTERVAL секунд по приходу телеметрии.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.interval = 300.0
+        self.backfill = 86400.0          # глубина первого расчёта по телеметрии
+        self.lag = 60.0                  # опоздавшие точки телеметрии
+        self.max_gap = 1800.0            # между точками дольше — разрыв, не разряд
+        self.moving_kmh = 3.0
+        self.chunk = 200                 # самокатов на одну пачку телеметрии
+        self.cell_deg = 0.005
+        self.utc_offset = 5
+        self.mileage_bucket_km = 1
+        self._last_run = 0.0
+        self._running = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config.get('ANALYTICS_INTERVAL', self.interval)
+        self.backfill = app.config.get('ANALYTICS_BACKFILL', self.backfill)
+        self.cell_deg = app.config.get('ANALYTICS_CELL_DEG', self.cell_deg)
+        self.utc_offset = app.config.get('ANALYTICS_UTC_OFFSET_HOURS', self.utc_offset)
+        self._last_run = time.time()
+        app.extensions['fleet_analytics'] = self
+
+        @app.cli.command('analytics-run')
+        def analytics_run():
+            """Пересчитать агрегаты аналитики парка."""
+            # В отдельном процессе открытых сегментов телеметрии нет — ждём, пока
+            # сервер сбросит их на диск (длина raw-сегмента + обслуживание)
+            raw_span = next(span for name, _, span, _ in telemetry_store.tiers if name == 'raw')
+            lag = raw_span + 2 * telemetry_store.maintain_interval
+            for job, result in self.run(lag=lag).items():
+                click.echo(f"{job}: {result}")
+
+    # ——— Запуск ———
+
+    def on_telemetry(self, messages):
+        """Подписчик ingestor'а: запускает пересчёт в фоне раз в interval секунд."""
+        if not self.interval or time.time() - self._last_run < self.interval:
+            return
+        if not self._running.acquire(blocking=False):
+            return
+        self._last_run = time.time()
+        threading.Thread(target=self._run_in_context, name='fleet-analytics', daemon=True).start()
+
+    def _run_in_context(self):
+        try:
+            with self.app.app_context():
+                self.run(locked=True)
+        except Exception:
+            logger.exception("Ошибка расчёта аналитики")
+        finally:
+            self._running.release()
+
+    def run(self, now=None, lag=None, locked=False):
+        """Все задания по очереди; каждое — своя транзакция. Возвращает их итоги."""
+        if not locked and not self._running.acquire(blocking=False):
+            return {}
+        try:
+            now = now or time.time()
+            lag = self.lag if lag is None else lag
+            results = {}
+            for job, step in (
+                ('battery_drain', lambda: self.battery_drain(now - lag)),
+                ('utilization', lambda: self.utilization(now)),
+                ('demand', self.demand),
+                ('remaining_mileage', self.remaining_mileage),
+            ):
+                started = time.perf_counter()
+                try:
+                    results[job] = step()
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise
+                logger.info("Аналитика пересчитана", extra={
+                    'job': job, 'result': results[job],
+                    'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+                })
+            return results
+        finally:
+            if not locked:
+                self._running.release()
+
+    def _advance(self, job, old, new):
+        if not agg.advance_watermark(job, old, new, datetime.utcnow()):
+            db.session.rollback()
+            logger.warning("Задание аналитики уже выполнено другим процессом", extra={'job': job})
+            return False
+        return True
+
+    # ——— Разряд батареи ———
+
+    def battery_drain(self, end):
+        """
+        Скорость разряда (%/час) по сырой телеметрии: отдельно в движении и
+        на стоянке. Рост заряда (зарядка, замена батареи) и разрывы в данных
+        больше max_gap не учитываются.
+        """
+        watermark = agg.get_watermark('battery_drain')
+        start = watermark if watermark is not None else end - self.backfill
+        if end <= start:
+            return {'points': 0}
+
+        scooters = db.session.execute(sa.select(Scooter.id, Scooter.imei).order_by(Scooter.id)).all()
+        totals = []
+        points = 0
+        for offset in range(0, len(scooters), self.chunk):
+            chunk = scooters[offset:offset + self.chunk]
+            sums, count = self._drain_chunk(chunk, start, end)
+            totals.extend(sums)
+            points += count
+
+        agg.upsert(agg.agg_battery_drain, totals,
+                   add=('ride_drop', 'ride_hours', 'idle_drop', 'idle_hours'))
+        table = agg.agg_battery_drain
+        hours = table.c.ride_hours + table.c.idle_hours
+        db.session.execute(
+            table.update()
+            .where(table.c.scooter_id.in_([row['scooter_id'] for row in totals]), hours > 0)
+            .values(drain_per_hour=(table.c.ride_drop + table.c.idle_drop) / hours)
+        )
+        fleet = db.session.execute(sa.select(
+            sa.func.sum(table.c.ride_drop), sa.func.sum(table.c.ride_hours),
+            sa.func.sum(table.c.idle_drop), sa.func.sum(table.c.idle_hours),
+        )).one()
+        ride_drop, ride_hours, idle_drop, idle_hours = (value or 0.0 for value in fleet)
+        agg.upsert(agg.agg_summary, [
+            {'key': 'drain_ride_pct_per_hour', 'value': ride_drop / ride_hours if ride_hours else None},
+            {'key': 'drain_idle_pct_per_hour', 'value': idle_drop / idle_hours if idle_hours else None},
+        ], replace=('value',))
+
+        if not self._advance('battery_drain', watermark, end):
+            return {'skipped': True}
+        return {'points': points, 'scooters': len(totals)}
+
+    def _drain_chunk(self, scooters, start, end):
+        """Суммы разряда для пачки самокатов одним векторным проходом."""
+        ts_parts, battery_parts, speed_parts, owner_parts = [], [], [], []
+        for index, (_, imei) in enumerate(scooters):
+            # Точка до start нужна, чтобы посчитать первый отрезок после неё
+            columns = telemetry_store.columns(imei, start - self.max_gap, end, names=('battery', 'speed'))
+            if len(columns['ts']) < 2:
+                continue
+            ts_parts.append(np.frombuffer(columns['ts'], dtype=np.float64))
+            battery_parts.append(np.frombuffer(columns['battery'], dtype=np.int8))
+            speed_parts.append(np.frombuffer(columns['speed'], dtype=np.float32))
+            owner_parts.append(np.full(len(columns['ts']), index, dtype=np.int32))
+        if not ts_parts:
+            return [], 0
+
+        ts = np.concatenate(ts_parts)
+        battery = np.concatenate(battery_parts).astype(np.float64)
+        speed = np.nan_to_num(np.concatenate(speed_parts))
+        owner = np.concatenate(owner_parts)
+
+        known = battery >= 0
+        ts, battery, speed, owner = ts[known], battery[known], speed[known], owner[known]
+        dt = np.diff(ts)
+        drop = -np.diff(battery)
+        valid = (
+            (owner[1:] == owner[:-1])
+            & (dt > 0) & (dt <= self.max_gap)
+            & (drop >= 0)
+            & (ts[1:] > start) & (ts[1:] <= end)
+        )
+        moving = np.maximum(speed[1:], speed[:-1]) >= self.moving_kmh
+        hours = dt / 3600.0
+        segment_owner = owner[1:]
+        size = len(scooters)
+
+        def total(weights, mask):
+            return np.bincount(segment_owner[mask], weights=weights[mask], minlength=size)
+
+        ride_drop = total(drop, valid & moving)
+        ride_hours = total(hours, valid & moving)
+        idle_drop = total(drop, valid & ~moving)
+        idle_hours = total(hours, valid & ~moving)
+
+        rows = []
+        for index in np.flatnonzero(ride_hours + idle_hours):
+            rows.append({
+                'scooter_id': scooters[index][0],
+                'ride_drop': float(ride_drop[index]),
+                'ride_hours': float(ride_hours[index]),
+                'idle_drop': float(idle_drop[index]),
+                'idle_hours': float(idle_hours[index]),
+                'drain_per_hour': None,
+            })
+        return rows, int(valid.sum())
+
+    # ——— Загрузка парка по часам ———
+
+    def utilization(self, now):
+        """
+        Доля времени в аренде по часам: секунды поездок в часе / (парк × 3600).
+        Пересчитываются часы от отметки (начало часа) до текущего.
+        """
+        watermark = agg.get_watermark('utilization')
+        first = db.session.execute(sa.select(sa.func.min(Ride.start_time))).scalar()
+        if first is None:
+            return {'hours': 0}
+        window_start = watermark if watermark is not None else max(
+            (first - datetime(1970, 1, 1)).total_seconds(), now - 30 * 86400
+        )
+        window_start -= window_start % 3600
+        hours = int((now - window_start) // 3600) + 1
+
+        rides = db.session.execute(
+            sa.select(Ride.start_time, Ride.end_time)
+            .where(Ride.start_time < datetime.utcfromtimestamp(now))
+            .where(sa.or_(Ride.end_time.is_(None), Ride.end_time >= datetime.utcfromtimestamp(window_start)))
+        ).all()
+        fleet_size = db.session.execute(sa.select(sa.func.count()).select_from(Scooter)).scalar() or 0
+
+        ride_seconds = np.zeros(hours)
+        started = np.zeros(hours, dtype=np.int64)
+        if rides:
+            begin = _epoch_seconds([r[0] for r in rides], now)
+            finish = _epoch_seconds([r[1] for r in rides], now)
+            in_window = begin >= window_start
+            started += np.bincount(((begin[in_window] - window_start) // 3600).astype(np.int64),
+                                   minlength=hours)[:hours]
+
+            # Поездка делится на неполные первый и последний час и целые часы между ними
+            s = np.clip(begin, window_start, now)
+            e = np.clip(finish, window_start, now)
+            keep = e > s
+            s, e = s[keep], e[keep]
+            h0 = ((s - window_start) // 3600).astype(np.int64)
+            h1 = np.minimum(((e - window_start) // 3600).astype(np.int64), hours - 1)
+            same = h0 == h1
+            np.add.at(ride_seconds, h0[same], (e - s)[same])
+            split = ~same
+            np.add.at(ride_seconds, h0[split], (window_start + (h0[split] + 1) * 3600) - s[split])
+            np.add.at(ride_seconds, h1[split], e[split] - (window_start + h1[split] * 3600))
+            full = np.zeros(hours + 1)
+            np.add.at(full, h0[split] + 1, 1)
+            np.add.at(full, h1[split], -1)
+            ride_seconds += np.cumsum(full)[:hours] * 3600
+
+        capacity = fleet_size * 3600.0
+        agg.upsert(agg.agg_utilization_hourly, [
+            {
+                'hour_start': int(window_start + i * 3600),
+                'ride_seconds': float(ride_seconds[i]),
+                'rides_started': int(started[i]),
+                'fleet_size': fleet_size,
+                'utilization': float(ride_seconds[i] / capacity) if capacity else 0.0,
+            }
+            for i in range(hours)
+        ], replace=('ride_seconds', 'rides_started', 'fleet_size', 'utilization'))
+
+        # Текущий час ещё не закончился — следующий запуск пересчитает его
+        if not self._advance('utilization', watermark, window_start + (hours - 1) * 3600):
+            return {'skipped': True}
+        return {'hours': hours, 'rides': len(rides)}
+
+    # ——— Спрос ———
+
+    def demand(self):
+        """Теплокарта начал поездок по ячейкам сетки и по часам суток (местное время)."""
+        watermark = agg.get_watermark('demand')
+        last_id = int(watermark or 0)
+        rides = db.session.execute(
+            sa.select(Ride.id, Ride.start_time, Ride.start_lat, Ride.start_lng)
+            .where(Ride.id > last_id)
+            .order_by(Ride.id)
+        ).all()
+        if not rides:
+            return {'rides': 0}
+
+        ids = np.array([r[0] for r in rides], dtype=np.int64)
+        begin = _epoch_seconds([r[1] for r in rides], 0)
+        lat = np.array([r[2] if r[2] is not None else np.nan for r in rides], dtype=np.float64)
+        lng = np.array([r[3] if r[3] is not None else np.nan for r in rides], dtype=np.float64)
+
+        local_hour = ((begin // 3600 + self.utc_offset) % 24).astype(np.int64)
+        by_hour = np.bincount(local_hour, minlength=24)
+        agg.upsert(agg.agg_demand_hour, [
+            {'hour': hour, 'rides': int(count)} for hour, count in enumerate(by_hour) if count
+        ], add=('rides',))
+
+        located = ~(np.isnan(lat) | np.isnan(lng))
+        cells = np.stack([
+            np.floor(lng[located] / self.cell_deg),
+            np.floor(lat[located] / self.cell_deg),
+        ], axis=1).astype(np.int64)
+        if len(cells):
+            unique, counts = np.unique(cells, axis=0, return_counts=True)
+            agg.upsert(agg.agg_demand_cell, [
+                {'cell_x': int(x), 'cell_y': int(y), 'rides': int(count)}
+                for (x, y), count in zip(unique, counts)
+            ], add=('rides',))
+
+        if not self._advance('demand', watermark, float(ids.max())):
+            return {'skipped': True}
+        return {'rides': len(rides), 'located': int(located.sum())}
+
+    # ——— Остаток хода ———
+
+    def remaining_mileage(self):
+        """Распределение predicted.remaining.mileage по парку (текущий снимок)."""
+        values = np.array(
+            db.session.execute(
+                sa.select(Scooter.remaining_mileage).where(Scooter.remaining_mileage.isnot(None))
+            ).scalars().all(),
+            dtype=np.float64,
+        )
+        db.session.execute(agg.agg_remaining_mileage.delete())
+        summary = {'remaining_scooters': float(len(values))}
+        if len(values):
+            buckets = (values // self.mileage_bucket_km).astype(np.int64)
+            keys, counts = np.unique(buckets, return_counts=True)
+            db.session.execute(agg.agg_remaining_mileage.insert(), [
+                {'bucket_km': int(k) * self.mileage_bucket_km, 'scooters': int(c)}
+                for k, c in zip(keys, counts)
+            ])
+            p10, p50, p90 = np.percentile(values, (10, 50, 90))
+            summary.update({
+                'remaining_mean_km': float(values.mean()),
+                'remaining_p10_km': float(p10),
+                'remaining_p50_km': float(p50),
+                'remaining_p90_km': float(p90),
+            })
+        agg.upsert(agg.agg_summary, [{'key': k, 'value': v} for k, v in summary.items()],
+                   replace=('value',))
+        return {'scooters': len(values)}
+
+    # ——— Панель ———
+
+    def dashboard(self, now=None, hours=48, cells=500, worst=20):
+        """Готовые агрегаты для админки: только чтение небольших таблиц."""
+        now = now or time.time()
+        summary = dict(db.session.execute(sa.select(agg.agg_summary)).all())
+        drain = agg.agg_battery_drain
+        util = agg.agg_utilization_hourly
+        demand = agg.agg_demand_cell
+        half = self.cell_deg / 2
+        return {
+            'jobs': agg.job_states(),
+            'battery_drain': {
+                'ride_pct_per_hour': summary.get('drain_ride_pct_per_hour'),
+                'idle_pct_per_hour': summary.get('drain_idle_pct_per_hour'),
+                'worst': [
+                    {'scooter_id': scooter_id, 'pct_per_hour': round(rate, 3)}
+                    for scooter_id, rate in db.session.execute(
+                        sa.select(drain.c.scooter_id, drain.c.drain_per_hour)
+                        .where(drain.c.drain_per_hour.isnot(None))
+                        .order_by(drain.c.drain_per_hour.desc())
+                        .limit(worst)
+                    ).all()
+                ],
+            },
+            'remaining_mileage': {
+                'scooters': int(summary.get('remaining_scooters') or 0),
+                'mean_km': summary.get('remaining_mean_km'),
+                'p10_km': summary.get('remaining_p10_km'),
+                'p50_km': summary.get('remaining_p50_km'),
+                'p90_km': summary.get('remaining_p90_km'),
+                'histogram': [
+                    {'km': km, 'scooters': count}
+                    for km, count in db.session.execute(
+                        sa.select(agg.agg_remaining_mileage).order_by(agg.agg_remaining_mileage.c.bucket_km)
+                    ).all()
+                ],
+            },
+            'utilization': [
+                {'hour_start': hour, 'utilization': round(value, 4),
+                 'ride_seconds': round(seconds, 1), 'rides_started': count}
+                for hour, value, seconds, count in db.session.execute(
+                    sa.select(util.c.hour_start, util.c.utilization, util.c.ride_seconds, util.c.rides_started)
+                    .where(util.c.hour_start >= int(now - hours * 3600))
+                    .order_by(util.c.hour_start)
+                ).all()
+            ],
+            'demand': {
+                'cell_deg': self.cell_deg,
+                'by_hour': [
+                    {'hour': hour, 'rides': count}
+                    for hour, count in db.session.execute(
+                        sa.select(agg.agg_demand_hour).order_by(agg.agg_demand_hour.c.hour)
+                    ).all()
+                ],
+                'cells': [
+                    {'lat': round(y * self.cell_deg + half, 6), 'lng': round(x * self.cell_deg + half, 6),
+                     'rides': count}
+                    for x, y, count in db.session.execute(
+                        sa.select(demand.c.cell_x, demand.c.cell_y, demand.c.rides)
+                        .order_by(demand.c.rides.desc())
+                        .limit(cells)
+                    ).all()
+                ],
+            },
+        }
+
+
+fleet_analytics = FleetAnalytics()
@@ -0,0 +1,193 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:   # brotli необязателен: без него отдаём gzip
+    brotli = None
+
+# Текстовые типы сжимаем; картинки и шрифты уже сжаты
+_COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml', 'application/xml')
+# Файлы, в которых переписываются ссылки на другие ассеты
+_REWRITABLE = ('.html', '.css', '.js')
+_MIN_COMPRESS_SIZE = 256
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+
+class Asset:
+    """Файл из static/tma: содержимое, сжатые варианты и контентный хэш."""
+
+    __slots__ = ('path', 'hashed_path', 'mimetype', 'etag', 'last_modified', 'mtime', 'variants')
+
+    def __init__(self, path, body, mtime):
+        self.path = path
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        digest = hashlib.sha256(body).hexdigest()
+        self.etag = digest[:16]
+        stem, ext = os.path.splitext(path)
+        self.hashed_path = f"{stem}.{digest[:8]}{ext}"
+        self.mtime = int(mtime)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.variants = {'identity': body}
+        if len(body) >= _MIN_COMPRESS_SIZE and self.mimetype.startswith(_COMPRESSIBLE):
+            compressed = gzip.compress(body, compresslevel=9, mtime=0)
+            if len(compressed) < len(body):
+                self.variants['gzip'] = compressed
+            if brotli is not None:
+                compressed = brotli.compress(body, quality=11)
+                if len(compressed) < len(body):
+                    self.variants['br'] = compressed
+
+    def choose(self, accept_encodings):
+        """Лучший вариант, который принимает клиент: br → gzip → без сжатия."""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.variants and accept_encodings[encoding] > 0:
+                return encoding
+        return 'identity'
+
+
+class AssetCache:
+    """
+    Ассеты Mini App в памяти.
+
+    При первом обращении все файлы каталога читаются, хэшируются и сжимаются
+    (gzip и brotli, если он установлен). Ссылки на ассеты внутри html/css/js
+    заменяются на имена с хэшем (scooter-icon.3fa2c1d8.png) — такие URL
+    никогда не меняют содержимое и отдаются с immutable на год. Сами страницы
+    (index.html и т.п.) отдаются с no-cache и ETag: браузер переспрашивает
+    и получает 304, пока страница не поменялась.
+    """
+
+    def __init__(self, root=None, url_prefix='/tma'):
+        self.root = root
+        self.url_prefix = url_prefix
+        self.reload = False
+        self._assets = {}      # путь (обычный и с хэшем) → Asset
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app, root):
+        self.root = root
+        self.reload = app.config.get('ASSETS_RELOAD', self.reload)
+        self._assets = {}
+        self._signature = None
+        app.extensions['assets'] = self
+
+    # ——— Сборка ———
+
+    def _files(self):
+        files = []
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                full = os.path.join(directory, name)
+                stat = os.stat(full)
+                files.append((os.path.relpath(full, self.root).replace(os.sep, '/'), full, stat.st_mtime, stat.st_size))
+        return sorted(files)
+
+    def build(self):
+        files = self._files()
+        sources = {}
+        for path, full, mtime, _ in files:
+            with open(full, 'rb') as f:
+                sources[path] = (f.read(), mtime)
+
+        assets = {}
+        # Сначала файлы без ссылок (картинки), затем css/js, затем страницы —
+        # чтобы к моменту переписывания ссылок хэши целей уже были известны
+        order = sorted(sources, key=lambda p: (p.endswith(_REWRITABLE), p.endswith('.html'), p))
+        for path in order:
+            body, mtime = sources[path]
+            if path.endswith(_REWRITABLE):
+                rewritten = self._rewrite(body, assets)
+                if rewritten != body:
+                    # Страница меняется вместе с ассетами, на которые ссылается
+                    mtime = max([mtime] + [asset.mtime for asset in assets.values()])
+                    body = rewritten
+            asset = Asset(path, body, mtime)
+            assets[path] = asset
+            assets[asset.hashed_path] = asset
+        self._assets = assets
+        self._signature = [(p, m, s) for p, _, m, s in files]
+        return assets
+
+    def _rewrite(self, body, assets):
+        """/tma/<путь> → /tma/<путь с хэшем> для уже собранных ассетов."""
+        plain = {path: asset for path, asset in assets.items() if path == asset.path}
+        if not plain:
+            return body
+        try:
+            text = body.decode('utf-8')
+        except UnicodeDecodeError:
+            # Не UTF-8 (например, cp1251) — отдаём как есть, без подмены ссылок
+            return body
+        pattern = re.compile(
+            re.escape(self.url_prefix + '/') + '(' + '|'.join(re.escape(p) for p in sorted(plain, key=len, reverse=True)) + r')(?![\w.\-/])'
+        )
+        text = pattern.sub(lambda m: f"{self.url_prefix}/{plain[m.group(1)].hashed_path}", text)
+        return text.encode('utf-8')
+
+    def ensure_built(self):
+        if self._signature is not None and not self.reload:
+            return
+        with self._lock:
+            if self._signature is None:
+                self.build()
+            elif self.reload and [(p, m, s) for p, _, m, s in self._files()] != self._signature:
+                # Режим разработки: файлы поменялись — пересобираем
+                self.build()
+
+    def get(self, path):
+        self.ensure_built()
+        return self._assets.get(path)
+
+    def url(self, path):
+        """URL с хэшем для пути внутри static/tma."""
+        asset = self.get(path)
+        return f"{self.url_prefix}/{asset.hashed_path if asset else path}"
+
+    # ——— Ответ ———
+
+    def response(self, path):
+        """Response для ассета (200 или 304) или None, если файла нет."""
+        asset = self.get(path)
+        if asset is None:
+            return None
+        immutable = path == asset.hashed_path and path != asset.path
+        encoding = asset.choose(request.accept_encodings)
+        headers = {
+            'Cache-Control': IMMUTABLE if immutable else REVALIDATE,
+            'Last-Modified': asset.last_modified,
+            'Vary': 'Accept-Encoding',
+            # ETag одного представления: сжатые варианты отличаются суффиксом
+            'ETag': f'"{asset.etag}"' if encoding == 'identity' else f'"{asset.etag}-{encoding}"',
+        }
+
+        if request.if_none_match:
+            if request.if_none_match.contains_weak(asset.etag) or any(
+                request.if_none_match.contains_weak(f"{asset.etag}-{e}") for e in asset.variants
+            ):
+                return Response(status=304, headers=headers)
+        elif request.headers.get('If-Modified-Since'):
+            try:
+                since = parsedate_to_datetime(request.headers['If-Modified-Since']).timestamp()
+            except (TypeError, ValueError):
+                since = None
+            if since is not None and asset.mtime <= since:
+                return Response(status=304, headers=headers)
+
+        body = asset.variants[encoding]
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(body, mimetype=asset.mimetype, headers=headers)
+
+
+tma_assets = AssetCache()
@@ -0,0 +1,353 @@
+import atexit
+import itertools
+import logging
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict, deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from services.metrics import FLESPI_ERRORS, FLESPI_LATENCY
+
+logger = logging.getLogger(__name__)
+
+# Состояние замка (lock.status), которое трекер сообщит после выполнения команды
+EXPECTED_LOCK = {
+    'sclockctrl 0': False,   # разблокировать
+    'sclockctrl 1': True,    # заблокировать
+}
+
+# Состояния команды
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'            # Flespi принял команду
+ACKED = 'acked'          # трекер подтвердил выполнение телеметрией
+FAILED = 'failed'
+SUPERSEDED = 'superseded'
+
+
+class FlespiError(Exception):
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class FlespiClient:
+    """HTTP-клиент Flespi: один Session с пулом соединений и таймаутами."""
+
+    def __init__(self, token=None, base_url='https://flespi.io', timeout=(3.05, 10), pool_size=10):
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @property
+    def configured(self):
+        return bool(self.token) and self.token != 'YOUR_FLESPI_TOKEN_HERE'
+
+    def _request(self, operation, method, path, **kwargs):
+        headers = {
+            "Authorization": f"FlespiToken {self.token}",
+            "Content-Type": "application/json",
+        }
+        started = time.perf_counter()
+        try:
+            response = self.session.request(
+                method, self.base_url + path, headers=headers, timeout=self.timeout, **kwargs
+            )
+        except requests.RequestException as e:
+            FLESPI_LATENCY.labels(operation).observe(time.perf_counter() - started)
+            FLESPI_ERRORS.labels(operation, type(e).__name__).inc()
+            raise FlespiError(f"Flespi request failed: {e}")
+        FLESPI_LATENCY.labels(operation).observe(time.perf_counter() - started)
+        if response.status_code != 200:
+            FLESPI_ERRORS.labels(operation, f"http_{response.status_code}").inc()
+        if response.status_code == 429 or response.status_code >= 500:
+            raise FlespiError(f"Flespi {response.status_code}: {response.text[:200]}")
+        if response.status_code != 200:
+            raise FlespiError(f"Flespi {response.status_code}: {response.text[:200]}", retryable=False)
+        try:
+            return response.json()
+        except ValueError:
+            return {}
+
+    def send_commands(self, device_id, commands):
+        return self._request('send_commands', 'POST', f"/gw/devices/{device_id}/commands/send", json={"commands": commands})
+
+    def find_device_id(self, imei):
+        """ID устройства в Flespi по IMEI (configuration.ident) или None."""
+        data = self._request('find_device', 'GET', f"/gw/devices/configuration.ident={imei}", params={'fields': 'id'})
+        result = data.get('result') or []
+        return result[0]['id'] if result else None
+
+
+class DeviceRegistry:
+    """Кэш IMEI → ID устройства в Flespi с запросом к API при промахе."""
+
+    def __init__(self, client, static=None, ttl=3600.0, negative_ttl=60.0):
+        self.client = client
+        self.static = dict(static or {})
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = {}   # imei → (device_id | None, время)
+        self._lock = threading.Lock()
+
+    def resolve(self, imei):
+        if imei in self.static:
+            return self.static[imei]
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(imei)
+        if cached is not None:
+            device_id, at = cached
+            if now - at < (self.ttl if device_id is not None else self.negative_ttl):
+                return device_id
+        device_id = self.client.find_device_id(imei)
+        with self._lock:
+            self._cache[imei] = (device_id, now)
+        return device_id
+
+
+class CommandTicket:
+    """Команда на трекер и её состояние доставки."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, imei, command):
+        self.id = next(self._ids)
+        self.imei = imei
+        self.command = command
+        self.state = QUEUED
+        self.attempts = 0
+        self.error = None
+        self.device_id = None
+        self.superseded_by = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self._done = threading.Event()
+
+    @property
+    def family(self):
+        # 'sclockctrl 0' и 'sclockctrl 1' управляют одним и тем же
+        return self.command.split(' ', 1)[0]
+
+    def set_state(self, state, error=None):
+        self.state = state
+        self.error = error
+        self.updated_at = time.time()
+        if state != QUEUED and state != SENDING:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """Ждёт, пока команда будет отправлена (или не отправлена окончательно)."""
+        self._done.wait(timeout)
+        return self.state
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'imei': self.imei,
+            'command': self.command,
+            'state': self.state,
+            'attempts': self.attempts,
+            'error': self.error,
+            'superseded_by': self.superseded_by,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+        }
+
+
+class CommandDispatcher:
+    """
+    Асинхронная отправка команд на TST100 через Flespi.
+
+    Команды встают в очередь своего устройства; несколько рабочих потоков
+    обслуживают устройства по одному за раз, так что порядок команд для
+    одного самоката сохраняется. Повтор той же команды, пока первая ещё
+    ждёт отправки, склеивается с ней, а противоположная (unlock → lock)
+    вытесняет ожидающую. Сетевые ошибки и 5xx повторяются с backoff.
+    Подтверждение выполнения берётся из телеметрии (lock.status).
+    """
+
+    def __init__(self):
+        self.app = None
+        self.client = FlespiClient()
+        self.registry = DeviceRegistry(self.client)
+        self.workers = 4
+        self.max_attempts = 4
+        self.backoff = 0.5
+        self.max_tickets = 10000
+        self._pending = {}          # imei → deque(CommandTicket)
+        self._ready = queue.Queue()
+        self._scheduled = set()     # IMEI в _ready или в работе
+        self._awaiting_ack = {}     # imei → CommandTicket
+        self._tickets = OrderedDict()
+        self._lock = threading.RLock()
+        self._threads = []
+        self._stats = {'queued': 0, 'coalesced': 0, 'superseded': 0, 'sent': 0,
+                       'acked': 0, 'failed': 0, 'retries': 0}
+
+    def init_app(self, app):
+        self.app = app
+        self.client = FlespiClient(
+            token=app.config.get('FLESPI_TOKEN'),
+            base_url=app.config.get('FLESPI_URL', 'https://flespi.io'),
+            timeout=app.config.get('FLESPI_TIMEOUT', (3.05, 10)),
+            pool_size=app.config.get('FLESPI_POOL_SIZE', 10),
+        )
+        self.registry = DeviceRegistry(self.client, static=app.config.get('FLESPI_DEVICE_IDS'))
+        self.workers = app.config.get('COMMAND_WORKERS', self.workers)
+        self.max_attempts = app.config.get('COMMAND_MAX_ATTEMPTS', self.max_attempts)
+        self.backoff = app.config.get('COMMAND_BACKOFF', self.backoff)
+        app.extensions['command_dispatcher'] = self
+
+    # ——— Постановка в очередь ———
+
+    def submit(self, imei, command):
+        """Ставит команду в очередь и сразу возвращает CommandTicket."""
+        ticket = CommandTicket(imei, command)
+        if not self.client.configured:
+            ticket.set_state(FAILED, "FLESPI_TOKEN не установлен")
+            self._remember(ticket)
+            self._bump('failed')
+            return ticket
+
+        with self._lock:
+            pending = self._pending.setdefault(imei, deque())
+            for waiting in list(pending):
+                if waiting.command == command:
+                    # Та же команда ещё не ушла — вторая ничего не добавит
+                    self._stats['coalesced'] += 1
+                    return waiting
+                if waiting.family == ticket.family:
+                    pending.remove(waiting)
+                    waiting.superseded_by = ticket.id
+                    waiting.set_state(SUPERSEDED)
+                    self._stats['superseded'] += 1
+            pending.append(ticket)
+            self._stats['queued'] += 1
+            self._remember(ticket)
+            if imei not in self._scheduled:
+                self._scheduled.add(imei)
+                self._ready.put(imei)
+
+        self._ensure_started()
+        return ticket
+
+    def get(self, ticket_id):
+        return self._tickets.get(ticket_id)
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['pending'] = sum(len(p) for p in self._pending.values())
+            result['awaiting_ack'] = len(self._awaiting_ack)
+        result['workers_alive'] = sum(1 for t in self._threads if t.is_alive())
+        return result
+
+    # ——— Подтверждения из телеметрии ———
+
+    def on_telemetry(self, messages):
+        """Подписчик ingestor'а: lock.status в телеметрии подтверждает команду."""
+        if not self._awaiting_ack:
+            return
+        for message in messages:
+            locked = message.get('locked')
+            if locked is None:
+                continue
+            with self._lock:
+                ticket = self._awaiting_ack.get(message['imei'])
+                if ticket is None or EXPECTED_LOCK.get(ticket.command) != locked:
+                    continue
+                del self._awaiting_ack[message['imei']]
+                self._stats['acked'] += 1
+                ticket.set_state(ACKED)
+
+    # ——— Рабочие потоки ———
+
+    def _ensure_started(self):
+        if len([t for t in self._threads if t.is_alive()]) >= self.workers:
+            return
+        with self._lock:
+            self._threads = [t for t in self._threads if t.is_alive()]
+            first_start = not self._threads
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name='flespi-commands', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        if first_start:
+            atexit.register(self.stop)
+
+    def stop(self):
+        for _ in self._threads:
+            self._ready.put(None)
+
+    def _run(self):
+        while True:
+            imei = self._ready.get()
+            if imei is None:
+                return
+            with self._lock:
+                pending = self._pending.get(imei)
+                ticket = pending.popleft() if pending else None
+                if ticket is not None:
+                    ticket.set_state(SENDING)
+            if ticket is not None:
+                self._deliver(ticket)
+            with self._lock:
+                if self._pending.get(imei):
+                    self._ready.put(imei)
+                else:
+                    self._pending.pop(imei, None)
+                    self._scheduled.discard(imei)
+
+    def _deliver(self, ticket):
+        while True:
+            ticket.attempts += 1
+            try:
+                if ticket.device_id is None:
+                    ticket.device_id = self.registry.resolve(ticket.imei)
+                    if ticket.device_id is None:
+                        raise FlespiError(f"Устройство с IMEI {ticket.imei} не найдено в Flespi", retryable=False)
+                self.client.send_commands(ticket.device_id, [ticket.command])
+            except FlespiError as e:
+                if e.retryable and ticket.attempts < self.max_attempts:
+                    self._bump('retries')
+                    # Экспоненциальная задержка с джиттером
+                    time.sleep(self.backoff * (2 ** (ticket.attempts - 1)) * (0.5 + random.random()))
+                    continue
+                ticket.set_state(FAILED, str(e))
+                self._bump('failed')
+                logger.warning("Команда не отправлена", extra={
+                    'imei': ticket.imei, 'command': ticket.command,
+                    'attempts': ticket.attempts, 'error': str(e),
+                })
+                return
+
+            with self._lock:
+                # SENT — до публикации в _awaiting_ack: иначе подтверждение из
+                # телеметрии могло бы прийти раньше и быть перезаписано на SENT
+                ticket.set_state(SENT)
+                if ticket.command in EXPECTED_LOCK:
+                    self._awaiting_ack[ticket.imei] = ticket
+                self._stats['sent'] += 1
+            return
+
+    def _remember(self, ticket):
+        with self._lock:
+            self._tickets[ticket.id] = ticket
+            while len(self._tickets) > self.max_tickets:
+                self._tickets.popitem(last=False)
+
+    def _bump(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+
+command_dispatcher = CommandDispatcher()
@@ -0,0 +1,115 @@
+import json
+import threading
+import time
+
+
+def sse_event(event, data, event_id=None):
+    """Одно событие Server-Sent Events."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append("data: " + json.dumps(data, separators=(',', ':'), default=str))
+    return "\n".join(lines) + "\n\n"
+
+
+def stream_scooters(index, bbox=None, statuses=None, min_battery=None, since=None,
+                    heartbeat=15.0, min_interval=1.0, max_duration=600.0):
+    """
+    Генератор SSE для /api/scooters/stream.
+
+    Сначала отдаёт снапшот (или дельту от since, если клиент переподключился
+    с Last-Event-ID), потом только изменившиеся самокаты внутри bbox: upsert —
+    новые значения, remove — самокаты, которые ушли из области или под фильтр.
+    Изменения копятся не чаще раза в min_interval, через max_duration поток
+    закрывается, и EventSource переподключается сам.
+
+    since — версия из id последнего события ("<instance_id>-<version>").
+    """
+    filters = {'bbox': bbox, 'statuses': statuses, 'min_battery': min_battery}
+
+    def event_id(v):
+        return f"{index.instance_id}-{v}"
+
+    deadline = time.monotonic() + max_duration
+    visible = None
+    version = None
+    if since:
+        instance_id, _, since_version = since.rpartition('-')
+        # Версии из другого процесса (после рестарта) не сравнимы с нашими
+        if instance_id == index.instance_id and since_version.isdigit():
+            version = int(since_version)
+
+    if version is not None:
+        version, changed = index.changes_since(version)
+        if changed is not None:
+            # Клиент уже видел область — считаем видимыми все текущие в ней
+            _, records = index.search(**filters)
+            visible = {record['id'] for record in records}
+            upsert = [index.get(i) for i in changed if i in visible]
+            remove = [i for i in changed if i not in visible]
+            yield sse_event('delta', {'version': version, 'upsert': upsert, 'remove': remove}, event_id(version))
+
+    if visible is None:
+        version = index.version
+        _, records = index.search(**filters)
+        visible = {record['id'] for record in records}
+        yield sse_event('snapshot', {'version': version, 'scooters': records}, event_id(version))
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        current = index.wait_for_change(version, min(heartbeat, remaining))
+        if current == version:
+            # Комментарий держит соединение живым через прокси
+            yield ": ping\n\n"
+            continue
+
+        version, changed = index.changes_since(version)
+        if changed is None:
+            _, records = index.search(**filters)
+            visible = {record['id'] for record in records}
+            yield sse_event('snapshot', {'version': version, 'scooters': records}, event_id(version))
+            continue
+
+        upsert, remove = [], []
+        for scooter_id in changed:
+            record = index.get(scooter_id)
+            if record is not None and index.matches(record, **filters):
+                upsert.append(record)
+                visible.add(scooter_id)
+            elif scooter_id in visible:
+                remove.append(scooter_id)
+                visible.discard(scooter_id)
+        if upsert or remove:
+            yield sse_event('delta', {'version': version, 'upsert': upsert, 'remove': remove}, event_id(version))
+        if min_interval:
+            time.sleep(min_interval)
+
+
+class VersionedCache:
+    """
+    Кэш готовых ответов по ключу запроса, действительный для одной версии
+    индекса: одинаковые опросы одной области не сериализуются заново.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        return None
+
+    def put(self, key, version, value):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                # Оставляем только записи текущей версии
+                self._entries = {k: v for k, v in self._entries.items() if v[0] == version}
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[key] = (version, value)
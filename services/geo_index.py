@@ -0,0 +1,263 @@
+import math
+import threading
+import uuid
+from collections import deque
+
+from models import repository
+from utils.helpers import EARTH_RADIUS_M, haversine_m
+
+# Поля самоката, которые отдаёт /api/scooters
+PUBLIC_FIELDS = ('id', 'imei', 'lat', 'lng', 'battery', 'status', 'speed', 'odometer')
+
+_METERS_PER_DEG_LAT = math.pi * EARTH_RADIUS_M / 180
+
+
+class FleetIndex:
+    """
+    Индекс парка в памяти: сетка cell_deg × cell_deg градусов → id самокатов.
+
+    Записи самокатов неизменяемые: при обновлении подменяется весь словарь,
+    поэтому список, который уже отдаётся клиенту, не меняется под ним.
+    Загружается из БД один раз, дальше обновляется телеметрией и арендой.
+
+    Каждое реальное изменение увеличивает version и попадает в журнал
+    изменений — по нему считаются ETag и дельты для потока /api/scooters/stream.
+    """
+
+    def __init__(self, cell_deg=0.01, change_log_size=100000):
+        self.app = None
+        self.cell_deg = cell_deg
+        self._records = {}   # id → словарь PUBLIC_FIELDS
+        self._cell_of = {}   # id → ячейка
+        self._cells = {}     # ячейка → set(id)
+        self._sorted_ids = None
+        self._loaded = False
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        # Версии локальны для процесса, поэтому в ETag добавляем id экземпляра
+        self.instance_id = uuid.uuid4().hex[:8]
+        self.version = 0
+        self._reset_version = 0
+        self._changes = deque(maxlen=change_log_size)   # (version, id)
+
+    def init_app(self, app):
+        self.app = app
+        self.cell_deg = app.config.get('FLEET_INDEX_CELL_DEG', self.cell_deg)
+        app.extensions['fleet_index'] = self
+
+    # ——— Загрузка и обновление ———
+
+    def load(self):
+        """Полная загрузка из БД (нужен контекст приложения)."""
+        with self._lock:
+            rows = repository.scooter_rows(PUBLIC_FIELDS)
+            self._records.clear()
+            self._cell_of.clear()
+            self._cells.clear()
+            for row in rows:
+                self._put(dict(zip(PUBLIC_FIELDS, row)))
+            self._sorted_ids = None
+            self._loaded = True
+            # Полная перезагрузка: клиенты с более старой версией получат снапшот
+            self.version += 1
+            self._reset_version = self.version
+            self._changes.clear()
+            self._changed.notify_all()
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def upsert(self, scooter_id, **fields):
+        with self._lock:
+            if not self._loaded:
+                return
+            old = self._records.get(scooter_id)
+            record = dict(old) if old else dict.fromkeys(PUBLIC_FIELDS)
+            record.update(fields)
+            record['id'] = scooter_id
+            if record != old:
+                self._put(record)
+                self._touch(scooter_id)
+                self._changed.notify_all()
+
+    def remove(self, scooter_id):
+        with self._lock:
+            if self._records.pop(scooter_id, None) is not None:
+                self._unlink(scooter_id)
+                self._sorted_ids = None
+                self._touch(scooter_id)
+                self._changed.notify_all()
+
+    def on_telemetry(self, messages):
+        """Подписчик ingestor'а: переносит свежие значения в индекс."""
+        with self._lock:
+            if not self._loaded:
+                return
+            for message in messages:
+                fields = {
+                    name: message[name]
+                    for name in ('lat', 'lng', 'battery', 'speed', 'odometer', 'status')
+                    if message.get(name) is not None
+                }
+                current = self._records.get(message['scooter_id'])
+                if current is not None and current['status'] == 'in_use':
+                    # Как и в БД: статус арендованного самоката телеметрия не меняет
+                    fields.pop('status', None)
+                self.upsert(message['scooter_id'], imei=message['imei'], **fields)
+
+    def get(self, scooter_id):
+        return self._records.get(scooter_id)
+
+    # ——— Версии и изменения ———
+
+    def changes_since(self, version):
+        """
+        Возвращает (текущая версия, id изменившихся после version самокатов).
+        Вместо множества — None, если журнал уже не покрывает version
+        (была перезагрузка или журнал переполнен) и нужен полный снапшот.
+        """
+        with self._lock:
+            if version < self._reset_version:
+                return self.version, None
+            if version >= self.version:
+                return self.version, set()
+            if not self._changes or self._changes[0][0] > version + 1:
+                return self.version, None
+            changed = set()
+            for changed_version, scooter_id in reversed(self._changes):
+                if changed_version <= version:
+                    break
+                changed.add(scooter_id)
+            return self.version, changed
+
+    def wait_for_change(self, version, timeout=None):
+        """Ждёт, пока version не станет больше переданной. Возвращает текущую версию."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version > version, timeout)
+            return self.version
+
+    def __len__(self):
+        return len(self._records)
+
+    # ——— Поиск ———
+
+    def search(self, bbox=None, near=None, radius=1000.0, statuses=None,
+               min_battery=None, limit=None, offset=0):
+        """
+        Поиск самокатов.
+
+        bbox — (min_lng, min_lat, max_lng, max_lat), как L.LatLngBounds.toBBoxString();
+        near — (lat, lng) с radius в метрах, результат отсортирован по расстоянию.
+        Возвращает (общее число найденных, страница записей).
+        """
+        with self._lock:
+            records = self._records
+            if near is not None:
+                lat, lng = near
+                dlat = radius / _METERS_PER_DEG_LAT
+                dlng = dlat / max(math.cos(math.radians(lat)), 1e-6)
+                candidates = self._in_box(lng - dlng, lat - dlat, lng + dlng, lat + dlat)
+            elif bbox is not None:
+                candidates = self._in_box(*bbox)
+            else:
+                if self._sorted_ids is None:
+                    self._sorted_ids = sorted(records)
+                candidates = self._sorted_ids
+
+            found = []
+            for scooter_id in candidates:
+                record = records[scooter_id]
+                if statuses and record['status'] not in statuses:
+                    continue
+                if min_battery is not None and (record['battery'] or 0) < min_battery:
+                    continue
+                found.append(record)
+
+        if near is not None:
+            ranked = []
+            for record in found:
+                distance = haversine_m(lat, lng, record['lat'], record['lng'])
+                if distance <= radius:
+                    ranked.append((distance, record['id'], record))
+            ranked.sort(key=lambda item: (item[0], item[1]))
+            found = [dict(record, distance_m=round(distance, 1)) for distance, _, record in ranked]
+        elif bbox is not None:
+            found.sort(key=lambda record: record['id'])
+
+        total = len(found)
+        end = None if limit is None else offset + limit
+        return total, found[offset:end]
+
+    @staticmethod
+    def matches(record, bbox=None, statuses=None, min_battery=None):
+        """Проверка одной записи теми же фильтрами, что и в search (без near)."""
+        if statuses and record['status'] not in statuses:
+            return False
+        if min_battery is not None and (record['battery'] or 0) < min_battery:
+            return False
+        if bbox is not None:
+            min_lng, min_lat, max_lng, max_lat = bbox
+            if record['lat'] is None or record['lng'] is None:
+                return False
+            return min_lat <= record['lat'] <= max_lat and min_lng <= record['lng'] <= max_lng
+        return True
+
+    # ——— Сетка ———
+
+    def _touch(self, scooter_id):
+        self.version += 1
+        self._changes.append((self.version, scooter_id))
+
+    def _cell(self, lat, lng):
+        return (math.floor(lat / self.cell_deg), math.floor(lng / self.cell_deg))
+
+    def _put(self, record):
+        scooter_id = record['id']
+        if scooter_id not in self._records:
+            self._sorted_ids = None
+        self._records[scooter_id] = record
+        cell = None
+        if record['lat'] is not None and record['lng'] is not None:
+            cell = self._cell(record['lat'], record['lng'])
+        if self._cell_of.get(scooter_id) != cell:
+            self._unlink(scooter_id)
+            if cell is not None:
+                self._cells.setdefault(cell, set()).add(scooter_id)
+                self._cell_of[scooter_id] = cell
+
+    def _unlink(self, scooter_id):
+        cell = self._cell_of.pop(scooter_id, None)
+        if cell is not None:
+            members = self._cells.get(cell)
+            members.discard(scooter_id)
+            if not members:
+                del self._cells[cell]
+
+    def _in_box(self, min_lng, min_lat, max_lng, max_lat):
+        lo_y, lo_x = self._cell(min_lat, min_lng)
+        hi_y, hi_x = self._cell(max_lat, max_lng)
+        records = self._records
+        result = []
+
+        def collect(members):
+            for scooter_id in members:
+                record = records[scooter_id]
+                if min_lat <= record['lat'] <= max_lat and min_lng <= record['lng'] <= max_lng:
+                    result.append(scooter_id)
+
+        # Для больших областей дешевле пройти по занятым ячейкам, чем по всем в рамке
+        if (hi_y - lo_y + 1) * (hi_x - lo_x + 1) > len(self._cells):
+            for (y, x), members in self._cells.items():
+                if lo_y <= y <= hi_y and lo_x <= x <= hi_x:
+                    collect(members)
+        else:
+            for y in range(lo_y, hi_y + 1):
+                for x in range(lo_x, hi_x + 1):
+                    members = self._cells.get((y, x))
+                    if members:
+                        collect(members)
+        return result
+
+
+fleet_index = FleetIndex()
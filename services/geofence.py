@@ -0,0 +1,495 @@
+import itertools
+import json
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+import click
+import numpy as np
+
+from models import db, repository
+from services.metrics import registry
+from services.rides import ride_engine
+
+logger = logging.getLogger(__name__)
+
+PARKING = 'parking'
+NO_RIDE = 'no_ride'
+SLOW = 'slow'
+ZONE_KINDS = (PARKING, NO_RIDE, SLOW)
+
+GEOFENCE_EVENTS = registry.counter(
+    'geofence_events_total', "Входы и выходы самокатов из геозон", ('kind', 'event'))
+GEOFENCE_BATCH_TIME = registry.histogram(
+    'geofence_batch_duration_seconds', "Проверка пачки точек телеметрии по геозонам")
+GEOFENCE_POINTS = registry.counter(
+    'geofence_points_total', "Точки телеметрии, проверенные по геозонам")
+
+
+class Polygon:
+    """
+    Многоугольник GeoJSON (внешний контур и дыры) с предрасчётом для
+    быстрой проверки точки: рёбра разложены по горизонтальным полосам,
+    так что луч пересекает только рёбра своей полосы, а не весь контур.
+    """
+
+    __slots__ = ('bbox', '_min_lat', '_band_height', '_bands')
+
+    def __init__(self, rings):
+        edges = []
+        lngs, lats = [], []
+        for ring in rings:
+            points = [(float(lng), float(lat)) for lng, lat, *_ in ring]
+            if len(points) < 3:
+                raise ValueError("Polygon ring needs at least 3 points")
+            lngs.extend(p[0] for p in points)
+            lats.extend(p[1] for p in points)
+            for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1]):
+                if y1 == y2:
+                    continue   # горизонтальное ребро луч не пересекает
+                edges.append((min(y1, y2), max(y1, y2), x1, y1, (x2 - x1) / (y2 - y1)))
+        if not edges:
+            raise ValueError("Polygon is degenerate")
+
+        self.bbox = (min(lngs), min(lats), max(lngs), max(lats))
+        self._min_lat = self.bbox[1]
+        count = max(1, len(edges) // 4)
+        self._band_height = (self.bbox[3] - self.bbox[1]) / count or 1.0
+        self._bands = [[] for _ in range(count)]
+        for edge in edges:
+            first = self._band(edge[0])
+            last = self._band(edge[1])
+            for band in range(first, last + 1):
+                self._bands[band].append(edge)
+
+    def _band(self, lat):
+        return min(max(int((lat - self._min_lat) / self._band_height), 0), len(self._bands) - 1)
+
+    def contains(self, lng, lat):
+        min_lng, min_lat, max_lng, max_lat = self.bbox
+        if lng < min_lng or lng > max_lng or lat < min_lat or lat > max_lat:
+            return False
+        inside = False
+        # Луч вправо от точки, правило чёт-нечет (дыры учитываются сами)
+        for y_min, y_max, x1, y1, k in self._bands[self._band(lat)]:
+            if y_min <= lat < y_max and lng < x1 + (lat - y1) * k:
+                inside = not inside
+        return inside
+
+
+class Zone:
+    __slots__ = ('id', 'name', 'kind', 'speed_limit', 'polygon', 'geometry')
+
+    def __init__(self, zone_id, name, kind, geometry, speed_limit=None):
+        if kind not in ZONE_KINDS:
+            raise ValueError(f"Unknown zone kind: {kind!r}")
+        if isinstance(geometry, str):
+            geometry = json.loads(geometry)
+        # Допускаем и {"type": "Polygon", "coordinates": [...]}, и сами координаты
+        rings = geometry['coordinates'] if isinstance(geometry, dict) else geometry
+        self.id = zone_id
+        self.name = name
+        self.kind = kind
+        self.speed_limit = speed_limit
+        self.polygon = Polygon(rings)
+        self.geometry = rings
+
+    def to_feature(self):
+        return {
+            'type': 'Feature',
+            'id': self.id,
+            'geometry': {'type': 'Polygon', 'coordinates': self.geometry},
+            'properties': {'name': self.name, 'kind': self.kind, 'speed_limit': self.speed_limit},
+        }
+
+
+class ZoneIndex:
+    """
+    Неизменяемый индекс зон: сетка cell_deg → зоны, чей bbox задевает ячейку.
+
+    Для пачки точек (zones_many) полосы рёбер всех зон сложены в общие
+    массивы NumPy: пары точка × зона-кандидат разворачиваются в пары
+    точка × ребро своей полосы, и весь тест луча идёт одним векторным проходом.
+    """
+
+    def __init__(self, zones, cell_deg):
+        self.zones = {zone.id: zone for zone in zones}
+        self.cell_deg = cell_deg
+        self._cells = {}
+        for zone in zones:
+            min_lng, min_lat, max_lng, max_lat = zone.polygon.bbox
+            for cx in range(self._cell(min_lng), self._cell(max_lng) + 1):
+                for cy in range(self._cell(min_lat), self._cell(max_lat) + 1):
+                    self._cells.setdefault((cx, cy), []).append(zone)
+        self._cells = {cell: tuple(zones) for cell, zones in self._cells.items()}
+        self._build_arrays(zones)
+
+    def _build_arrays(self, zones):
+        self._ids = np.array([zone.id for zone in zones], dtype=np.int64)
+        number = {zone.id: i for i, zone in enumerate(zones)}
+        self._cell_numbers = {
+            cell: np.array([number[zone.id] for zone in candidates], dtype=np.int64)
+            for cell, candidates in self._cells.items()
+        }
+        self._bbox = np.array([zone.polygon.bbox for zone in zones], dtype=np.float64).reshape(-1, 4)
+        self._band_min = np.array([zone.polygon._min_lat for zone in zones], dtype=np.float64)
+        self._band_height = np.array([zone.polygon._band_height for zone in zones], dtype=np.float64)
+        self._band_count = np.array([len(zone.polygon._bands) for zone in zones], dtype=np.int64)
+        self._band_base = np.concatenate(([0], np.cumsum(self._band_count)[:-1])).astype(np.int64)
+        edges = [edge for zone in zones for band in zone.polygon._bands for edge in band]
+        sizes = [len(band) for zone in zones for band in zone.polygon._bands]
+        self._band_offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+        # y_min, y_max, x1, y1, k
+        self._edges = np.array(edges, dtype=np.float64).reshape(-1, 5).T
+
+    def _cell(self, value):
+        return math.floor(value / self.cell_deg)
+
+    def candidates(self, lat, lng):
+        return self._cells.get((self._cell(lng), self._cell(lat)), ())
+
+    def zones_at(self, lat, lng):
+        return [zone for zone in self.candidates(lat, lng) if zone.polygon.contains(lng, lat)]
+
+    def zones_many(self, lats, lngs):
+        """Зоны для пачки точек: список frozenset id зон в порядке точек."""
+        count = len(lats)
+        result = [frozenset()] * count
+        if not self.zones or not count:
+            return result
+        lats = np.asarray(lats, dtype=np.float64)
+        lngs = np.asarray(lngs, dtype=np.float64)
+
+        # Пары точка × зона-кандидат ячейки точки
+        cells = np.floor(np.stack((lngs, lats), axis=1) / self.cell_deg).astype(np.int64)
+        unique, inverse = np.unique(cells, axis=0, return_inverse=True)
+        empty = np.empty(0, dtype=np.int64)
+        per_cell = [self._cell_numbers.get(cell, empty) for cell in map(tuple, unique.tolist())]
+        cell_sizes = np.array([len(c) for c in per_cell], dtype=np.int64)
+        cell_starts = np.concatenate(([0], np.cumsum(cell_sizes)[:-1]))
+        flat = np.concatenate(per_cell) if per_cell else empty
+        inverse = inverse.reshape(-1)
+        sizes = cell_sizes[inverse]
+        point = np.repeat(np.arange(count), sizes)
+        zone = flat[np.repeat(cell_starts[inverse], sizes) + _ranges(sizes)]
+
+        # Отсев по bbox
+        lat, lng = lats[point], lngs[point]
+        box = self._bbox[zone]
+        keep = (lng >= box[:, 0]) & (lat >= box[:, 1]) & (lng <= box[:, 2]) & (lat <= box[:, 3])
+        point, zone, lat, lng = point[keep], zone[keep], lat[keep], lng[keep]
+        if not len(point):
+            return result
+
+        # Пары точка × ребро полосы, в которую попадает широта точки
+        band = ((lat - self._band_min[zone]) / self._band_height[zone]).astype(np.int64)
+        band = self._band_base[zone] + np.clip(band, 0, self._band_count[zone] - 1)
+        starts = self._band_offsets[band]
+        sizes = self._band_offsets[band + 1] - starts
+        pair = np.repeat(np.arange(len(point)), sizes)
+        y_min, y_max, x1, y1, k = self._edges[:, np.repeat(starts, sizes) + _ranges(sizes)]
+        plat, plng = lat[pair], lng[pair]
+        crossing = (y_min <= plat) & (plat < y_max) & (plng < x1 + (plat - y1) * k)
+        inside = np.bincount(pair[crossing], minlength=len(point)) % 2 == 1
+
+        hits = {}
+        for i, zone_id in zip(point[inside].tolist(), self._ids[zone[inside]].tolist()):
+            hits.setdefault(i, set()).add(zone_id)
+        for i, zone_ids in hits.items():
+            result[i] = frozenset(zone_ids)
+        return result
+
+
+def _ranges(sizes):
+    """[3, 2] → [0, 1, 2, 0, 1]: номера внутри групп после np.repeat."""
+    total = int(sizes.sum())
+    if not total:
+        return np.empty(0, dtype=np.int64)
+    starts = np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return np.arange(total) - starts
+
+
+class _ScooterState:
+    __slots__ = ('zones', 'ts', 'locked_by_zone', 'speed_limit')
+
+    def __init__(self, zones, ts):
+        self.zones = zones              # frozenset id зон, где самокат сейчас
+        self.ts = ts
+        self.locked_by_zone = False     # заблокирован нами в no_ride во время поездки
+        # Последнее отправленное ограничение скорости; None — неизвестно
+        # (после старта процесса), первая точка отправит его явно
+        self.speed_limit = None
+
+
+class GeofenceEngine:
+    """
+    Геозоны на потоке телеметрии.
+
+    Подписчик ingestor'а: получает каждую записанную пачку в фоновом потоке
+    записи, поэтому вебхук её не ждёт. Для точек пачки по сетке выбираются
+    зоны-кандидаты (их bbox задевает ячейку точки), и точный тест луча идёт
+    одним векторным проходом по всем парам точка × ребро (ZoneIndex.zones_many).
+    Изменение набора зон самоката даёт события enter/exit; первая точка
+    самоката после старта процесса только запоминает его зоны.
+
+    Для самокатов в поездке события применяются командами через
+    send_command: въезд в no_ride — блокировка, выезд — разблокировка,
+    в зонах slow — ограничение скорости (минимальное из перекрывающихся,
+    только если задана speed_command). По окончании поездки и на первой
+    точке после старта процесса отправляется default_speed, чтобы
+    забытое ограничение не осталось на самокате.
+
+    Зоны меняет flask zones-load из отдельного процесса, поэтому раз в
+    reload_interval сверяется версия зон в БД (число и updated_at) и при
+    расхождении индекс перезагружается.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.cell_deg = 0.005
+        self.enforce = True
+        self.default_speed = 25
+        self.lock_command = 'sclockctrl 1'
+        self.unlock_command = 'sclockctrl 0'
+        self.speed_command = ''           # пусто — ограничение скорости не отправляем
+        self.reload_interval = 60.0
+        self.send_command = None
+        self._index = ZoneIndex([], self.cell_deg)
+        self._loaded = False
+        self._version = None
+        self._checked_at = 0.0
+        self._states = {}              # scooter_id → _ScooterState
+        self._events = deque(maxlen=10000)
+        self._event_ids = itertools.count(1)
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._stats = {'points': 0, 'batches': 0, 'events': 0, 'commands': 0, 'last_batch_ms': 0.0}
+
+    def init_app(self, app, send_command=None):
+        self.app = app
+        self.cell_deg = app.config.get('GEOFENCE_CELL_DEG', self.cell_deg)
+        self.enforce = app.config.get('GEOFENCE_ENFORCE', self.enforce)
+        self.default_speed = app.config.get('GEOFENCE_DEFAULT_SPEED', self.default_speed)
+        self.speed_command = app.config.get('GEOFENCE_SPEED_COMMAND', self.speed_command)
+        self.reload_interval = app.config.get('GEOFENCE_RELOAD_INTERVAL', self.reload_interval)
+        self.send_command = send_command
+        self._index = ZoneIndex([], self.cell_deg)
+        self._loaded = False
+        self._version = None
+        self._states.clear()
+        self._listeners = []
+        app.extensions['geofence'] = self
+        self._register_cli(app)
+
+    def add_listener(self, listener):
+        """listener(events) вызывается с событиями каждой пачки."""
+        self._listeners.append(listener)
+
+    # ——— Зоны ———
+
+    def load(self):
+        """Зоны из БД (нужен контекст приложения). Индекс подменяется целиком."""
+        version = repository.zone_version()
+        zones = []
+        for zone_id, name, kind, geometry, speed_limit in repository.zone_rows():
+            try:
+                zones.append(Zone(zone_id, name, kind, geometry, speed_limit))
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error("Геозона пропущена", extra={'zone_id': zone_id, 'error': str(e)})
+        self._index = ZoneIndex(zones, self.cell_deg)
+        self._version = version
+        self._checked_at = time.monotonic()
+        self._loaded = True
+        logger.info("Геозоны загружены", extra={'zones': len(zones)})
+
+    def ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+            return
+        if self.reload_interval and time.monotonic() - self._checked_at >= self.reload_interval:
+            self._checked_at = time.monotonic()
+            if repository.zone_version() != self._version:
+                self.load()
+
+    def zones(self):
+        self.ensure_loaded()
+        return list(self._index.zones.values())
+
+    def zones_at(self, lat, lng):
+        self.ensure_loaded()
+        return self._index.zones_at(lat, lng)
+
+    # ——— Телеметрия ———
+
+    def on_telemetry(self, messages):
+        """Подписчик ingestor'а: события по пачке и команды для поездок."""
+        self.ensure_loaded()
+        index = self._index
+        if not index.zones and not self._states:
+            return
+        started = time.perf_counter()
+        located = [m for m in messages if m['lat'] is not None and m['lng'] is not None]
+        # Вся пачка проверяется векторно до блокировки
+        found = index.zones_many([m['lat'] for m in located], [m['lng'] for m in located])
+        checked = len(located)
+        events = []
+        commands = []
+        with self._lock:
+            # Сообщения пачки уже упорядочены по времени трекера
+            for message, zones in zip(located, found):
+                scooter_id = message['scooter_id']
+                state = self._states.get(scooter_id)
+                if state is None:
+                    self._states[scooter_id] = state = _ScooterState(zones, message['ts'])
+                elif message['ts'] < state.ts:
+                    continue   # опоздавшая точка
+                elif zones != state.zones:
+                    for zone_id in zones - state.zones:
+                        events.append(self._event('enter', index.zones[zone_id], message))
+                    for zone_id in state.zones - zones:
+                        zone = index.zones.get(zone_id)
+                        if zone is not None:
+                            events.append(self._event('exit', zone, message))
+                    state.zones = zones
+                state.ts = message['ts']
+                if self.enforce:
+                    commands.extend(self._reconcile(scooter_id, message['imei'], state, index))
+            self._events.extend(events)
+            self._stats['points'] += checked
+            self._stats['batches'] += 1
+            self._stats['events'] += len(events)
+
+        for event in events:
+            GEOFENCE_EVENTS.labels(event['kind'], event['event']).inc()
+        GEOFENCE_POINTS.inc(checked)
+
+        for imei, command in commands:
+            self._send(imei, command)
+        if events:
+            for listener in self._listeners:
+                try:
+                    listener(events)
+                except Exception:
+                    logger.exception("Ошибка обработчика геозон")
+
+        elapsed = time.perf_counter() - started
+        GEOFENCE_BATCH_TIME.observe(elapsed)
+        with self._lock:
+            self._stats['last_batch_ms'] = round(elapsed * 1000, 3)
+
+    def _event(self, name, zone, message):
+        return {
+            'id': next(self._event_ids),
+            'event': name,
+            'zone_id': zone.id,
+            'zone': zone.name,
+            'kind': zone.kind,
+            'scooter_id': message['scooter_id'],
+            'imei': message['imei'],
+            'lat': message['lat'],
+            'lng': message['lng'],
+            'ts': message['ts'],
+        }
+
+    def _reconcile(self, scooter_id, imei, state, index):
+        """
+        Сводит желаемое состояние самоката с уже отправленным: команды уходят
+        только при изменении, поэтому повторные точки в той же зоне ничего не шлют.
+        """
+        if not ride_engine.is_active(scooter_id):
+            # Поездка закончилась — блокировку уже сделало завершение аренды,
+            # а ограничение скорости из slow-зоны нужно снять
+            state.locked_by_zone = False
+            return self._speed(imei, state, self.default_speed)
+
+        commands = []
+        current = [index.zones[zone_id] for zone_id in state.zones if zone_id in index.zones]
+        in_no_ride = any(zone.kind == NO_RIDE for zone in current)
+        if in_no_ride and not state.locked_by_zone:
+            state.locked_by_zone = True
+            commands.append((imei, self.lock_command))
+        elif not in_no_ride and state.locked_by_zone:
+            state.locked_by_zone = False
+            commands.append((imei, self.unlock_command))
+
+        limits = [zone.speed_limit for zone in current if zone.kind == SLOW and zone.speed_limit]
+        commands.extend(self._speed(imei, state, min(limits) if limits else self.default_speed))
+        return commands
+
+    def _speed(self, imei, state, speed):
+        if not self.speed_command or speed == state.speed_limit:
+            return []
+        state.speed_limit = speed
+        return [(imei, self.speed_command.format(speed=speed))]
+
+    def _send(self, imei, command):
+        if self.send_command is None:
+            return
+        try:
+            self.send_command(imei, command)
+            with self._lock:
+                self._stats['commands'] += 1
+        except Exception:
+            logger.exception("Команда геозоны не поставлена в очередь", extra={'imei': imei, 'command': command})
+
+    # ——— События и статистика ———
+
+    def events_since(self, event_id=0, limit=500):
+        with self._lock:
+            return [event for event in self._events if event['id'] > event_id][:limit]
+
+    def state_of(self, scooter_id):
+        state = self._states.get(scooter_id)
+        return sorted(state.zones) if state is not None else []
+
+    def stats(self):
+        result = dict(self._stats)
+        result['zones'] = len(self._index.zones)
+        result['tracked_scooters'] = len(self._states)
+        return result
+
+    # ——— Загрузка зон из GeoJSON ———
+
+    def import_geojson(self, data, replace=False):
+        """
+        FeatureCollection с Polygon/MultiPolygon и properties kind, name,
+        speed_limit → строки таблицы zone. Возвращает число добавленных зон.
+        """
+        rows = []
+        for feature in data.get('features', []):
+            geometry = feature.get('geometry') or {}
+            properties = feature.get('properties') or {}
+            if geometry.get('type') == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry.get('type') == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                raise ValueError(f"Unsupported geometry: {geometry.get('type')!r}")
+            for rings in polygons:
+                zone = Zone(None, properties.get('name'), properties.get('kind'), rings,
+                            properties.get('speed_limit'))
+                rows.append({
+                    'name': zone.name,
+                    'kind': zone.kind,
+                    'geometry': json.dumps(rings),
+                    'speed_limit': zone.speed_limit,
+                })
+        repository.add_zones(rows, replace=replace)
+        db.session.commit()
+        self.load()
+        return len(rows)
+
+    def _register_cli(self, app):
+        @app.cli.command('zones-load')
+        @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+        @click.option('--replace', is_flag=True, help="Удалить прежние зоны")
+        def zones_load(path, replace):
+            """Загрузить геозоны из GeoJSON (properties: kind, name, speed_limit)."""
+            with open(path, encoding='utf-8') as f:
+                count = self.import_geojson(json.load(f), replace=replace)
+            click.echo(f"Загружено геозон: {count}")
+
+
+geofence = GeofenceEngine()
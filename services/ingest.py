@@ -0,0 +1,373 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+
+from models import db, repository
+from services.metrics import INGEST_BATCH_TIME
+
+logger = logging.getLogger(__name__)
+
+# Поля самоката, которые обновляются из телеметрии
+TELEMETRY_FIELDS = ('lat', 'lng', 'battery', 'speed', 'odometer', 'status', 'remaining_mileage')
+
+
+def _number(value, cast):
+    if value is None:
+        return None
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid numeric value: {value!r}")
+
+
+def parse_tst100_message(data):
+    """
+    Разбирает одно сообщение Flespi от TST100 в плоский словарь.
+    Бросает ValueError, если сообщение некорректно.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Message must be a JSON object")
+
+    # IMEI (в TST100 это поле 'ident')
+    imei = data.get('ident')
+    if not imei:
+        raise ValueError("IMEI not found")
+
+    # Flespi присылает координаты либо вложенным объектом, либо плоскими ключами
+    position = data.get('position') or {}
+    lat = position.get('latitude', data.get('position.latitude'))
+    lng = position.get('longitude', data.get('position.longitude'))
+    speed = position.get('speed', data.get('position.speed'))
+
+    battery_level = data.get('scooter.battery.level') or data.get('battery.level')
+    odometer = data.get('vehicle.mileage')  # в км
+    lock_status = data.get('lock.status')
+    ignition_status = data.get('engine.ignition.status')
+
+    # Замок — не статус самоката: запертый на стоянке свободен для аренды
+    # (его запирает само завершение аренды). Состояние замка идёт отдельным
+    # полем locked — по нему подтверждаются команды sclockctrl
+    status = None
+    if lock_status is not None:
+        status = 'available'
+    elif ignition_status is not None and not ignition_status:
+        status = 'offline'
+
+    battery_level = _number(battery_level, int)
+    if battery_level is not None and not 0 <= battery_level <= 100:
+        raise ValueError(f"Invalid battery level: {battery_level}")
+
+    odometer = _number(odometer, float)
+    return {
+        'imei': str(imei),
+        'ts': _number(data.get('timestamp'), float) or time.time(),
+        'lat': _number(lat, float),
+        'lng': _number(lng, float),
+        'speed': _number(speed, float),
+        'battery': battery_level,
+        'odometer': int(odometer * 1000) if odometer is not None else None,  # км → метры
+        'status': status,
+        'locked': bool(lock_status) if lock_status is not None else None,
+        'remaining_mileage': _number(data.get('predicted.remaining.mileage'), float),
+    }
+
+
+def parse_tst100_payload(payload):
+    """Flespi присылает либо одно сообщение, либо массив сообщений."""
+    items = payload if isinstance(payload, list) else [payload]
+    if not items:
+        raise ValueError("Empty payload")
+    return [parse_tst100_message(item) for item in items]
+
+
+class TelemetryIngestor:
+    """
+    Очередь приёма телеметрии TST100.
+
+    Вебхук только валидирует сообщение и кладёт его в ограниченную очередь,
+    а фоновый поток забирает всё накопившееся и пишет пачкой: одним UPDATE
+    по индексу IMEI → id самоката, который держится в памяти.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.mode = 'queue'
+        self.batch_size = 500
+        self.idle_timeout = 0.5
+        self.overflow = 'reject'
+        self.unknown_ttl = 60.0
+        self.retry_attempts = 5
+        self.retry_backoff = 0.5
+        self._queue = queue.Queue()
+        self._thread = None
+        self._stop = threading.Event()
+        self._start_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._index = {}
+        self._index_loaded = False
+        self._unknown = {}
+        self._listeners = []
+        self._stats = {
+            'accepted': 0,
+            'rejected': 0,
+            'dropped': 0,
+            'batches': 0,
+            'written': 0,
+            'unknown_imei': 0,
+            'errors': 0,
+            'retries': 0,
+            'lost': 0,
+            'listener_errors': 0,
+            'last_batch_size': 0,
+            'last_batch_ms': 0.0,
+        }
+
+    def init_app(self, app):
+        self.app = app
+        self.mode = app.config.get('INGEST_MODE', self.mode)
+        self.batch_size = app.config.get('INGEST_BATCH_SIZE', self.batch_size)
+        self.idle_timeout = app.config.get('INGEST_IDLE_TIMEOUT', self.idle_timeout)
+        self.overflow = app.config.get('INGEST_OVERFLOW', self.overflow)
+        self.retry_attempts = app.config.get('INGEST_RETRY_ATTEMPTS', self.retry_attempts)
+        self.retry_backoff = app.config.get('INGEST_RETRY_BACKOFF', self.retry_backoff)
+        self._queue = queue.Queue(maxsize=app.config.get('INGEST_QUEUE_SIZE', 10000))
+        self._listeners = []
+        app.extensions['telemetry_ingestor'] = self
+
+    def add_listener(self, listener):
+        """
+        Подписчик получает список записанных сообщений (с полем scooter_id)
+        после каждого коммита пачки.
+        """
+        self._listeners.append(listener)
+
+    # ——— Приём ———
+
+    def submit(self, messages):
+        """
+        Кладёт сообщения в очередь. Возвращает False, если очередь переполнена
+        и сообщения не приняты (вебхук отвечает 503, Flespi повторит позже).
+        """
+        self._ensure_started()
+
+        if self.overflow == 'drop_oldest':
+            for message in messages:
+                while True:
+                    try:
+                        self._queue.put_nowait(message)
+                        break
+                    except queue.Full:
+                        try:
+                            self._queue.get_nowait()
+                            self._bump('dropped')
+                        except queue.Empty:
+                            pass
+            self._bump('accepted', len(messages))
+            return True
+
+        # Пачку от Flespi принимаем целиком или не принимаем вовсе,
+        # чтобы повтор не создал дубликатов
+        if self._queue.maxsize and self._queue.qsize() + len(messages) > self._queue.maxsize:
+            self._bump('rejected', len(messages))
+            return False
+        for message in messages:
+            try:
+                self._queue.put_nowait(message)
+            except queue.Full:
+                self._bump('rejected')
+                return False
+            self._bump('accepted')
+        return True
+
+    def stats(self):
+        with self._stats_lock:
+            result = dict(self._stats)
+        result.update({
+            'mode': self.mode,
+            'queue_depth': self._queue.qsize(),
+            'queue_capacity': self._queue.maxsize,
+            'overflow': self.overflow,
+            'indexed_scooters': len(self._index),
+            'writer_alive': bool(self._thread and self._thread.is_alive()),
+        })
+        return result
+
+    # ——— Запись ———
+
+    def write_batch(self, messages):
+        """
+        Записывает пачку сообщений одним массовым UPDATE.
+        Возвращает словарь IMEI → id самоката для найденных самокатов.
+        """
+        started = time.perf_counter()
+        ids = self.resolve_ids({m['imei'] for m in messages})
+
+        rows = {}
+        known = []
+        # Внутри пачки применяем сообщения в порядке времени трекера
+        for message in sorted(messages, key=lambda m: m['ts']):
+            scooter_id = ids.get(message['imei'])
+            if scooter_id is None:
+                self._bump('unknown_imei')
+                continue
+            message['scooter_id'] = scooter_id
+            known.append(message)
+            row = rows.get(scooter_id)
+            if row is None:
+                row = rows[scooter_id] = dict.fromkeys(TELEMETRY_FIELDS)
+                row['id'] = scooter_id
+            for field in TELEMETRY_FIELDS:
+                if message[field] is not None:
+                    row[field] = message[field]
+            row['last_seen'] = datetime.utcfromtimestamp(message['ts'])
+
+        if rows:
+            with self._write_lock:
+                try:
+                    repository.bulk_update_telemetry(list(rows.values()))
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    self._bump('errors')
+                    raise
+
+        for listener in self._listeners:
+            try:
+                listener(known)
+            except Exception:
+                self._bump('listener_errors')
+                logger.exception("Ошибка обработчика телеметрии",
+                                 extra={'listener': getattr(listener, '__qualname__', repr(listener))})
+
+        elapsed = time.perf_counter() - started
+        INGEST_BATCH_TIME.observe(elapsed)
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['written'] += len(rows)
+            self._stats['last_batch_size'] = len(messages)
+            self._stats['last_batch_ms'] = round(elapsed * 1000, 3)
+        return {imei: scooter_id for imei, scooter_id in ids.items() if scooter_id is not None}
+
+    def resolve_ids(self, imeis):
+        """IMEI → id самоката из индекса в памяти; в БД ходим только за новыми IMEI."""
+        if not self._index_loaded:
+            for scooter_id, imei in repository.scooter_ids():
+                self._index[imei] = scooter_id
+            self._index_loaded = True
+
+        now = time.monotonic()
+        missing = [
+            imei for imei in imeis
+            if imei not in self._index and now - self._unknown.get(imei, -self.unknown_ttl) >= self.unknown_ttl
+        ]
+        if missing:
+            for scooter_id, imei in repository.scooter_ids(missing):
+                self._index[imei] = scooter_id
+                self._unknown.pop(imei, None)
+            for imei in missing:
+                if imei not in self._index:
+                    self._unknown[imei] = now
+        return {imei: self._index.get(imei) for imei in imeis}
+
+    def forget(self, imei=None):
+        """Сбрасывает индекс (например, после добавления самокатов)."""
+        if imei is None:
+            self._index.clear()
+            self._unknown.clear()
+            self._index_loaded = False
+        else:
+            self._index.pop(imei, None)
+            self._unknown.pop(imei, None)
+
+    def flush(self):
+        """Синхронно пишет всё, что лежит в очереди."""
+        while True:
+            batch = self._drain(block=False)
+            if not batch:
+                return
+            self._write_in_context(batch)
+
+    # ——— Фоновый поток ———
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='tst100-ingest', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._drain(block=True)
+            if batch:
+                self._write_in_context(batch)
+
+    def _drain(self, block):
+        try:
+            first = self._queue.get(timeout=self.idle_timeout) if block else self._queue.get_nowait()
+        except queue.Empty:
+            return []
+        # Забираем всё, что уже накопилось, — естественная микропачка под нагрузкой
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write_in_context(self, batch):
+        """
+        Пишет пачку; временные ошибки БД ("database is locked", обрыв
+        соединения) повторяет с нарастающей паузой. Flespi уже получил 200
+        за эти сообщения, поэтому пачка теряется только после retry_attempts
+        попыток или на ошибке, которую повтор не исправит. Пока поток ждёт,
+        очередь наполняется и вебхук начинает отвечать 503.
+        """
+        attempt = 1
+        while True:
+            try:
+                with self.app.app_context():
+                    self.write_batch(batch)
+                return
+            except OperationalError:
+                if attempt >= self.retry_attempts:
+                    self._lost(batch)
+                    return
+                delay = self.retry_backoff * 2 ** (attempt - 1)
+                self._bump('retries')
+                logger.warning("Временная ошибка записи телеметрии, повтор",
+                               extra={'messages': len(batch), 'attempt': attempt, 'delay_s': delay})
+                time.sleep(delay)
+                attempt += 1
+            except Exception:
+                self._lost(batch)
+                return
+
+    def _lost(self, batch):
+        self._bump('lost', len(batch))
+        logger.exception("Пачка телеметрии не записана", extra={'messages': len(batch)})
+
+    def _bump(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+
+telemetry_ingestor = TelemetryIngestor()
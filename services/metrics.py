@@ -0,0 +1,268 @@
+import bisect
+import logging
+import math
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+from models import db
+
+# Метрики в текстовом формате Prometheus (exposition format 0.0.4) без
+# внешних зависимостей: счётчики, гистограммы и значения, снимаемые в
+# момент опроса /metrics (очереди, статистика ingestor'а и т.п.).
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Секунды: от долей миллисекунды (индекс в памяти) до таймаутов Flespi
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in sorted(self._children.items()):
+            lines.extend(self._render_child(key, child))
+        return lines
+
+
+class _Value:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, key, child):
+        yield f"{self.name}{_labels(self.label_names, key)} {_number(child.value)}"
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, key, child):
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            le = 'le="' + _number(float(bound)) + '"'
+            yield f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}"
+        yield f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}"
+        yield f"{self.name}_count{_labels(self.label_names, key)} {cumulative}"
+
+
+class Registry:
+    """
+    Набор метрик приложения. Кроме собственных метрик держит коллекторы —
+    функции, которые при опросе возвращают [(имя, тип, описание, {метки: значение})]
+    из уже существующей статистики сервисов, чтобы не считать одно и то же дважды.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def add_collector(self, name, collector):
+        """Коллектор с тем же именем заменяет прежний (повторный create_app)."""
+        self._collectors[name] = collector
+
+    def render(self):
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        for collector in list(self._collectors.values()):
+            for name, kind, help, samples in collector():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples.items():
+                    names = tuple(k for k, _ in labels)
+                    values = tuple(v for _, v in labels)
+                    lines.append(f"{name}{_labels(names, values)} {_number(float(value))}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+HTTP_LATENCY = registry.histogram(
+    'http_request_duration_seconds', "Время обработки запроса", ('method', 'route', 'status'))
+HTTP_DB_QUERIES = registry.histogram(
+    'http_request_db_queries', "SQL-запросов на один HTTP-запрос", ('route',), buckets=COUNT_BUCKETS)
+HTTP_DB_TIME = registry.histogram(
+    'http_request_db_seconds', "Время в БД на один HTTP-запрос", ('route',))
+DB_QUERIES = registry.counter(
+    'db_queries_total', "SQL-запросы", ('context',))
+DB_QUERY_TIME = registry.histogram(
+    'db_query_duration_seconds', "Время одного SQL-запроса", ('context',))
+INGEST_BATCH_TIME = registry.histogram(
+    'ingest_batch_duration_seconds', "Запись пачки телеметрии в БД с подписчиками")
+FLESPI_LATENCY = registry.histogram(
+    'flespi_request_duration_seconds', "Время запроса к Flespi API", ('operation',))
+FLESPI_ERRORS = registry.counter(
+    'flespi_errors_total', "Ошибки запросов к Flespi API", ('operation', 'kind'))
+
+
+def samples(stats, label, keys):
+    """Значения из словаря статистики сервиса — сэмплы коллектора с меткой label."""
+    return {((label, key),): stats.get(key, 0) for key in keys}
+
+
+class Metrics:
+    """
+    Инструментирование приложения: время каждого маршрута, число и время
+    SQL-запросов на запрос и в фоновых потоках, медленные запросы — в лог.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.slow_request_ms = 1000.0
+        self.logger = None
+
+    def init_app(self, app):
+        self.app = app
+        self.slow_request_ms = app.config.get('LOG_SLOW_REQUEST_MS', self.slow_request_ms)
+        self.logger = logging.getLogger('app.requests')
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        with app.app_context():
+            # Движок создаётся лениво и без подключения к БД
+            event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+        app.extensions['metrics'] = self
+
+    def _before_request(self):
+        g._metrics_started = time.perf_counter()
+        g._db_queries = 0
+        g._db_seconds = 0.0
+
+    def _after_request(self, response):
+        started = g.pop('_metrics_started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        HTTP_LATENCY.labels(request.method, route, response.status_code).observe(elapsed)
+        HTTP_DB_QUERIES.labels(route).observe(g._db_queries)
+        HTTP_DB_TIME.labels(route).observe(g._db_seconds)
+        if elapsed * 1000 >= self.slow_request_ms:
+            self.logger.warning("Медленный запрос", extra={
+                'method': request.method, 'route': route, 'status': response.status_code,
+                'duration_ms': round(elapsed * 1000, 1), 'db_queries': g._db_queries,
+                'db_ms': round(g._db_seconds * 1000, 1),
+            })
+        return response
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('_query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stack = conn.info.get('_query_started')
+    if not stack:
+        return
+    elapsed = time.perf_counter() - stack.pop()
+    in_request = has_request_context()
+    context_label = 'request' if in_request else 'background'
+    DB_QUERIES.labels(context_label).inc()
+    DB_QUERY_TIME.labels(context_label).observe(elapsed)
+    if in_request and '_db_queries' in g:
+        g._db_queries += 1
+        g._db_seconds += elapsed
+
+
+metrics = Metrics()
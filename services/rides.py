@@ -0,0 +1,195 @@
+import math
+import threading
+from datetime import datetime
+
+from models import db, repository
+from models.ride import Ride
+from utils.helpers import haversine_m
+
+
+class RideConflict(Exception):
+    """Самокат не в том состоянии (уже арендован / не в аренде)."""
+
+
+class _ActiveRide:
+    __slots__ = ('ride_id', 'started_at', 'distance_m', 'last_lat', 'last_lng', 'last_ts')
+
+    def __init__(self, ride_id, started_at, distance_m=0.0, lat=None, lng=None):
+        self.ride_id = ride_id
+        self.started_at = started_at
+        self.distance_m = distance_m
+        self.last_lat = lat
+        self.last_lng = lng
+        self.last_ts = started_at
+
+
+class RideEngine:
+    """
+    Жизненный цикл поездки.
+
+    Аренда и завершение — один условный UPDATE самоката (compare-and-set по
+    status), поэтому два одновременных нажатия не займут самокат дважды.
+    Пробег считается по телеметрии: каждая новая точка добавляет отрезок
+    haversine к накопленному в памяти расстоянию, а пробег и стоимость
+    сохраняются одним UPDATE на пачку.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.start_fee = 50.0
+        self.price_per_minute = 7.0
+        self.min_step_m = 3.0        # дрожание GPS на стоянке не считаем
+        self.max_speed_kmh = 60.0    # скачки координат быстрее этого не считаем
+        self._active = {}            # scooter_id → _ActiveRide
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.start_fee = app.config.get('RIDE_START_FEE', self.start_fee)
+        self.price_per_minute = app.config.get('RIDE_PRICE_PER_MINUTE', self.price_per_minute)
+        self.min_step_m = app.config.get('RIDE_MIN_STEP_M', self.min_step_m)
+        self.max_speed_kmh = app.config.get('RIDE_MAX_SPEED_KMH', self.max_speed_kmh)
+        app.extensions['ride_engine'] = self
+
+    def cost(self, seconds):
+        """Старт + поминутная оплата (неполная минута считается целой)."""
+        minutes = max(math.ceil(seconds / 60), 0)
+        return round(self.start_fee + self.price_per_minute * minutes, 2)
+
+    # ——— Аренда ———
+
+    def start(self, scooter_id, user_id):
+        """
+        Занимает самокат и создаёт Ride в одной транзакции.
+        Возвращает (ride, imei). RideConflict — самокат недоступен.
+        """
+        self._ensure_loaded()
+        now = datetime.utcnow()
+        row = repository.transition_scooter(scooter_id, 'available', 'in_use', user_id=user_id)
+        if row is None:
+            db.session.rollback()
+            raise RideConflict("Самокат недоступен для аренды")
+
+        ride = Ride(
+            user_id=user_id,
+            scooter_id=scooter_id,
+            start_time=now,
+            distance_km=0.0,
+            cost=self.cost(0),
+            status='active',
+            start_lat=row.lat,
+            start_lng=row.lng,
+        )
+        db.session.add(ride)
+        db.session.commit()
+
+        with self._lock:
+            self._active[scooter_id] = _ActiveRide(
+                ride.id, _epoch(now), lat=row.lat, lng=row.lng
+            )
+        return ride, row.imei
+
+    def finish(self, scooter_id, user_id):
+        """
+        Освобождает самокат и закрывает поездку — только арендовавшему его
+        пользователю (проверка в том же условном UPDATE).
+        Возвращает (ride | None, imei). RideConflict — самокат не в аренде у user_id.
+        """
+        self._ensure_loaded()
+        now = datetime.utcnow()
+        row = repository.transition_scooter(scooter_id, 'in_use', 'available', holder_id=user_id)
+        if row is None:
+            db.session.rollback()
+            raise RideConflict("Самокат не находится в вашей аренде")
+
+        with self._lock:
+            state = self._active.pop(scooter_id, None)
+
+        if state is not None:
+            ride = db.session.get(Ride, state.ride_id)
+        else:
+            # Поездка началась до запуска процесса или без движка
+            ride = repository.active_ride(scooter_id)
+
+        if ride is not None:
+            started = ride.start_time or now
+            ride.end_time = now
+            if state is not None:
+                ride.distance_km = round(state.distance_m / 1000, 3)
+            ride.cost = self.cost((now - started).total_seconds())
+            ride.status = 'finished'
+        db.session.commit()
+        return ride, row.imei
+
+    def is_active(self, scooter_id):
+        return scooter_id in self._active
+
+    # ——— Телеметрия ———
+
+    def on_telemetry(self, messages):
+        """Подписчик ingestor'а: прибавляет пробег активным поездкам."""
+        self._ensure_loaded()
+        if not self._active:
+            return
+
+        progress = {}
+        with self._lock:
+            for message in messages:
+                state = self._active.get(message['scooter_id'])
+                if state is None or message['lat'] is None or message['lng'] is None:
+                    continue
+                if self._advance(state, message['lat'], message['lng'], message['ts']):
+                    progress[state.ride_id] = {
+                        'id': state.ride_id,
+                        'distance_km': round(state.distance_m / 1000, 3),
+                        'cost': self.cost(message['ts'] - state.started_at),
+                    }
+
+        if progress:
+            try:
+                repository.update_ride_progress(list(progress.values()))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def _advance(self, state, lat, lng, ts):
+        if state.last_lat is None or state.last_lng is None:
+            state.last_lat, state.last_lng, state.last_ts = lat, lng, ts
+            return False
+        if ts < state.last_ts:
+            # Опоздавшая точка — в пробег не добавляем, порядок уже нарушен
+            return False
+        step = haversine_m(state.last_lat, state.last_lng, lat, lng)
+        if step < self.min_step_m:
+            return False
+        elapsed = ts - state.last_ts
+        state.last_lat, state.last_lng, state.last_ts = lat, lng, ts
+        if elapsed > 0 and step / elapsed * 3.6 > self.max_speed_kmh:
+            return False
+        state.distance_m += step
+        return True
+
+    def _ensure_loaded(self):
+        """Активные поездки из БД — один раз при первом обращении после старта."""
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            for ride_id, scooter_id, start_time, distance_km in repository.active_rides():
+                self._active[scooter_id] = _ActiveRide(
+                    ride_id,
+                    _epoch(start_time) if start_time else 0.0,
+                    distance_m=(distance_km or 0.0) * 1000,
+                )
+            self._loaded = True
+
+
+def _epoch(value):
+    """naive UTC datetime → unix-время."""
+    return (value - datetime(1970, 1, 1)).total_seconds()
+
+
+ride_engine = RideEngine()
@@ -1,2 +1,717 @@
+import json
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+import sqlalchemy as sa
+
 from models import db
-print("db imported successfully!")
\ No newline at end of file
+from utils.flespi_stub import FlespiStub
+print("db imported successfully!")
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Бюджеты холодного старта (секунды) — с большим запасом для медленных CI
+IMPORT_BUDGET = 5.0
+CREATE_APP_BUDGET = 1.0
+
+
+def _measure_startup(database_url):
+    """Импорт app и create_app() в чистом процессе: время и число SQL-запросов."""
+    script = f"""
+import json, time
+t0 = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+queries = []
+event.listen(Engine, 'before_cursor_execute', lambda *a, **k: queries.append(a[2]))
+import app
+t1 = time.perf_counter()
+app.create_app({{'SQLALCHEMY_DATABASE_URI': {database_url!r}}})
+t2 = time.perf_counter()
+print(json.dumps({{'import_s': t1 - t0, 'create_app_s': t2 - t1, 'queries': len(queries)}}))
+"""
+    result = subprocess.run(
+        [sys.executable, '-c', script], cwd=BASE_DIR, capture_output=True, text=True, timeout=60
+    )
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def _run_with_app(tmp_path, body, **overrides):
+    """
+    Скрипт в чистом процессе с приложением на временной SQLite после миграций
+    (сервисы — синглтоны с потоками, поэтому каждому тесту свой процесс).
+    Скрипт сообщает итог через result(...); он и возвращается.
+    """
+    config = {
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'app.db'}",
+        'TELEMETRY_DIR': str(tmp_path / 'telemetry'),
+        'LOG_LEVEL': 'WARNING',
+        'FLESPI_TOKEN': '',
+    }
+    config.update(overrides)
+    script = f"""
+import json
+import app as application
+import migrations
+from models import db
+app = application.create_app({config!r})
+with app.app_context():
+    migrations.upgrade(db.engine, log=lambda message: None)
+def result(value):
+    print('RESULT ' + json.dumps(value), flush=True)
+""" + textwrap.dedent(body)
+    completed = subprocess.run(
+        [sys.executable, '-c', script], cwd=BASE_DIR, capture_output=True, text=True, timeout=120
+    )
+    assert completed.returncode == 0, completed.stderr
+    lines = [line for line in completed.stdout.splitlines() if line.startswith('RESULT ')]
+    assert lines, completed.stdout + completed.stderr
+    return json.loads(lines[-1][len('RESULT '):])
+
+
+def test_cold_start_is_fast_and_makes_no_queries(tmp_path):
+    stats = _measure_startup(f"sqlite:///{tmp_path / 'cold.db'}")
+    print(f"import app: {stats['import_s'] * 1000:.1f} ms, "
+          f"create_app: {stats['create_app_s'] * 1000:.1f} ms, SQL: {stats['queries']}")
+    assert stats['queries'] == 0
+    assert stats['import_s'] < IMPORT_BUDGET
+    assert stats['create_app_s'] < CREATE_APP_BUDGET
+
+
+def test_migrations_fresh_database_and_idempotent(tmp_path):
+    import migrations
+
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    applied = migrations.upgrade(engine, log=lambda message: None)
+    assert applied == [version for version, _, _ in migrations.discover()]
+    assert migrations.upgrade(engine, log=lambda message: None) == []
+
+    with engine.connect() as conn:
+        columns = {c['name'] for c in sa.inspect(conn).get_columns('scooter')}
+        seeded = conn.execute(sa.text("SELECT COUNT(*) FROM scooter")).scalar()
+    assert {'speed', 'odometer', 'last_seen'} <= columns
+    assert seeded == 1
+
+
+def test_migrations_upgrade_legacy_schema(tmp_path):
+    import migrations
+
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        # Схема до появления телеметрии и без schema_version
+        conn.execute(sa.text('CREATE TABLE "user" (id INTEGER PRIMARY KEY, telegram_id BIGINT NOT NULL UNIQUE)'))
+        conn.execute(sa.text(
+            "CREATE TABLE scooter (id INTEGER PRIMARY KEY, imei VARCHAR(15) NOT NULL UNIQUE, "
+            "lat FLOAT, lng FLOAT, battery INTEGER, status VARCHAR(20), current_user_id INTEGER)"
+        ))
+        conn.execute(sa.text("INSERT INTO scooter (imei, status) VALUES ('350544507678012', 'available')"))
+
+    migrations.upgrade(engine, log=lambda message: None)
+    with engine.connect() as conn:
+        columns = {c['name'] for c in sa.inspect(conn).get_columns('scooter')}
+        count = conn.execute(sa.text("SELECT COUNT(*) FROM scooter")).scalar()
+    assert {'speed', 'odometer', 'last_seen'} <= columns
+    assert count == 1
+
+
+def test_concurrent_rents_take_scooter_once(tmp_path):
+    stats = _run_with_app(tmp_path, """
+        from concurrent.futures import ThreadPoolExecutor
+        import sqlalchemy as sa
+
+        def rent(telegram_id):
+            return app.test_client().post('/api/rent/1', json={'telegram_id': telegram_id}).status_code
+
+        with ThreadPoolExecutor(50) as pool:
+            statuses = list(pool.map(rent, range(1, 201)))
+        with app.app_context():
+            holder = db.session.execute(sa.text(
+                'SELECT u.telegram_id FROM scooter s JOIN "user" u ON u.id = s.current_user_id')).scalar()
+            rides = db.session.execute(sa.text("SELECT COUNT(*) FROM ride WHERE status = 'active'")).scalar()
+
+        client = app.test_client()
+        stranger = client.post('/api/end_rent/1', json={'telegram_id': 10 ** 6}).status_code
+        invalid = client.post('/api/end_rent/1', json={'telegram_id': 'abc'}).status_code
+        owner = client.post('/api/end_rent/1', json={'telegram_id': holder}).status_code
+        result({'ok': statuses.count(200), 'conflict': statuses.count(400), 'rides': rides,
+                'stranger': stranger, 'invalid': invalid, 'owner': owner})
+    """)
+    assert stats['ok'] == 1
+    assert stats['conflict'] == 199
+    assert stats['rides'] == 1
+    assert stats['stranger'] == 400
+    assert stats['invalid'] == 400
+    assert stats['owner'] == 200
+
+
+def test_command_dispatcher_against_flespi_stub(tmp_path):
+    devices = {'100000000000001': 1, '100000000000002': 2, '100000000000003': 3}
+    stub = FlespiStub(latency=0.05).start()
+    # Первые два запроса (это отправка на устройство 1) получат 503
+    stub.fail_next = 2
+    try:
+        stats = _run_with_app(tmp_path, """
+            import time
+            from services.commands import command_dispatcher as dispatcher
+
+            retried = dispatcher.submit('100000000000001', 'sclockctrl 1')
+            retried.wait(5)
+
+            # Единственный рабочий поток занят устройством 2 — команды для 3 ждут в очереди
+            busy = dispatcher.submit('100000000000002', 'sclockctrl 0')
+            while busy.state == 'queued':
+                time.sleep(0.005)
+            first = dispatcher.submit('100000000000003', 'sclockctrl 1')
+            repeat = dispatcher.submit('100000000000003', 'sclockctrl 1')
+            last = dispatcher.submit('100000000000003', 'sclockctrl 0')
+            last.wait(5)
+
+            dispatcher.on_telemetry([{'imei': '100000000000001', 'locked': False}])
+            unacked = retried.state
+            dispatcher.on_telemetry([{'imei': '100000000000001', 'locked': True}])
+            result({
+                'retried': [retried.state, retried.attempts, unacked],
+                'coalesced': repeat is first,
+                'superseded': [first.state, first.superseded_by == last.id],
+                'last': last.state,
+                'stats': dispatcher.stats(),
+            })
+        """, FLESPI_URL=stub.url, FLESPI_TOKEN='test', FLESPI_DEVICE_IDS=devices,
+            COMMAND_WORKERS=1, COMMAND_BACKOFF=0.01)
+    finally:
+        stub.stop()
+
+    assert stats['retried'] == ['acked', 3, 'sent']
+    assert stats['coalesced'] is True
+    assert stats['superseded'] == ['superseded', True]
+    assert stats['last'] == 'sent'
+    assert stats['stats']['retries'] == 2
+    assert stats['stats']['coalesced'] == 1
+    assert stats['stats']['superseded'] == 1
+    assert [(device, commands) for device, commands, _ in stub.commands] == [
+        (1, ['sclockctrl 1']), (2, ['sclockctrl 0']), (3, ['sclockctrl 0']),
+    ]
+
+
+def test_queue_ingest_overflow_reject_and_drop_oldest(tmp_path):
+    stats = _run_with_app(tmp_path, """
+        import time
+        import sqlalchemy as sa
+        from models.telemetry import telemetry_store
+        from services.ingest import telemetry_ingestor as ingestor
+
+        # Без фонового потока очередь разбирает только flush()
+        ingestor._ensure_started = lambda: None
+        client = app.test_client()
+        imei = '350544507678012'
+        start = time.time() - 60
+
+        def post(batteries):
+            messages = [{'ident': imei, 'timestamp': start + b, 'battery.level': b,
+                         'position.latitude': 55.0, 'position.longitude': 49.0} for b in batteries]
+            return client.post('/api/tst100/webhook', json=messages).status_code
+
+        def battery():
+            with app.app_context():
+                return db.session.execute(sa.text('SELECT battery FROM scooter')).scalar()
+
+        accepted = post([1, 2, 3])
+        rejected = post([4, 5, 6])
+        ingestor.flush()
+        after_reject = battery()
+
+        ingestor.overflow = 'drop_oldest'
+        overflowed = post(range(10, 17))
+        depth = ingestor.stats()['queue_depth']
+        ingestor.flush()
+        history = [p['battery'] for p in telemetry_store.query(imei, start, start + 60, tier='raw')]
+        result({'statuses': [accepted, rejected, overflowed], 'after_reject': after_reject,
+                'depth': depth, 'battery': battery(), 'history': history, 'stats': ingestor.stats()})
+    """, INGEST_MODE='queue', INGEST_QUEUE_SIZE=5, INGEST_OVERFLOW='reject')
+
+    assert stats['statuses'] == [200, 503, 200]
+    assert stats['after_reject'] == 3
+    assert stats['depth'] == 5
+    assert stats['battery'] == 16
+    assert stats['history'] == [1, 2, 3, 12, 13, 14, 15, 16]
+    assert stats['stats']['rejected'] == 3
+    assert stats['stats']['dropped'] == 2
+    assert stats['stats']['lost'] == 0
+
+
+def _point(ts, **values):
+    point = {'imei': '350544507678012', 'ts': ts, 'lat': 55.0, 'lng': 49.0, 'speed': 10.0,
+             'battery': 50, 'odometer': 1000}
+    point.update(values)
+    return point
+
+
+def test_telemetry_segment_round_trip_with_out_of_range_values():
+    from models.telemetry import Segment
+
+    segment = Segment(1000.0)
+    for point in (_point(1003.0), _point(1001.0, battery=200, odometer=-5),
+                  _point(1002.0, lat=None, speed=None, battery=None)):
+        segment.append(point)
+    columns = {name: list(values) for name, values in segment.columns.items()}
+    assert {len(values) for values in columns.values()} == {3}
+
+    restored = Segment.from_bytes(segment.to_bytes())
+    assert restored.start == 1000.0
+    rows = restored.read(0, 2000)
+    assert [row['ts'] for row in rows] == [1001.0, 1002.0, 1003.0]
+    assert [row['battery'] for row in rows] == [None, None, 50]
+    assert [row['odometer'] for row in rows] == [None, 1000, 1000]
+    assert rows[1]['lat'] is None and rows[1]['speed'] is None
+    assert rows[2] == {'ts': 1003.0, 'lat': 55.0, 'lng': 49.0, 'speed': 10.0, 'battery': 50, 'odometer': 1000}
+
+
+def test_telemetry_store_downsampling_and_restart(tmp_path):
+    from models.telemetry import TelemetryStore
+
+    now = time.time()
+    base = now - now % 900 - 3600
+    store = TelemetryStore(str(tmp_path))
+    # 20 минут точек раз в 10 секунд, скорость растёт с каждой минутой
+    store.append_many([_point(base + i * 10, speed=float(i // 6), battery=100 - i // 6) for i in range(120)])
+    store.flush()
+
+    reopened = TelemetryStore(str(tmp_path))
+    imei = '350544507678012'
+    minutes = reopened.query(imei, base, base + 1200, tier='1m')
+    assert [p['ts'] for p in minutes] == [base + 60 * m for m in range(20)]
+    assert [p['speed'] for p in minutes] == [float(m) for m in range(20)]
+    assert minutes[-1]['battery'] == 81
+    quarters = reopened.query(imei, base, base + 1200, tier='15m')
+    assert [p['ts'] for p in quarters] == [base, base + 900]
+    assert len(reopened.query(imei, base, base + 1200, tier='raw')) == 120
+
+    # После перезапуска интервал, уже записанный при остановке, не дублируется
+    reopened.append_many([_point(base + 1195)])
+    reopened.flush()
+    minutes = TelemetryStore(str(tmp_path)).query(imei, base, base + 1200, tier='1m')
+    assert [p['ts'] for p in minutes] == [base + 60 * m for m in range(20)]
+
+
+def test_telemetry_store_merges_late_points_and_enforces_retention(tmp_path):
+    from models.telemetry import TelemetryStore
+
+    now = time.time()
+    imei = '350544507678012'
+    store = TelemetryStore(str(tmp_path))
+    store.append_many([_point(now - 10)])
+    past = now - now % 900 - 7200
+    store.append_many([_point(past + 30), _point(past + 10)])
+    store.append_many([_point(past + 20)])
+
+    reopened = TelemetryStore(str(tmp_path))
+    assert [p['ts'] for p in reopened.query(imei, past, past + 900, tier='raw')] == [past + 10, past + 20, past + 30]
+
+    store.flush()
+    store.tiers = tuple((name, step, span, 3600 if name == 'raw' else keep)
+                        for name, step, span, keep in store.tiers)
+    store.enforce_retention(now)
+    remaining = [p['ts'] for p in TelemetryStore(str(tmp_path)).query(imei, past, now, tier='raw')]
+    assert remaining == [now - 10]
+
+
+def test_scooters_etag_ignores_changes_outside_viewport(tmp_path):
+    stats = _run_with_app(tmp_path, """
+        import sqlalchemy as sa
+        with app.app_context():
+            db.session.execute(sa.text(
+                "INSERT INTO scooter (imei, lat, lng, battery, status) VALUES ('860000000000001', 10.0, 10.0, 90, 'available')"))
+            db.session.execute(sa.text("UPDATE scooter SET lat = 55.0, lng = 49.0 WHERE imei = '350544507678012'"))
+            db.session.commit()
+        client = app.test_client()
+        url = '/api/scooters?bbox=48.9,54.9,49.1,55.1'
+
+        def poll(etag):
+            response = client.get(url, headers={'If-None-Match': etag} if etag else {})
+            return response.status_code, response.headers.get('ETag')
+
+        def report(imei, battery, lat, lng):
+            client.post('/api/tst100/webhook', json={
+                'ident': imei, 'battery.level': battery, 'position.latitude': lat, 'position.longitude': lng})
+
+        first, etag = poll(None)
+        report('860000000000001', 80, 10.0, 10.0)     # вне области
+        outside, _ = poll(etag)
+        report('350544507678012', 70, 55.0, 49.0)     # в области
+        inside, new_etag = poll(etag)
+        result({'statuses': [first, outside, inside], 'changed': new_etag != etag})
+    """, INGEST_MODE='sync')
+    assert stats['statuses'] == [200, 304, 200]
+    assert stats['changed'] is True
+
+
+def test_scooter_locked_after_ride_can_be_rented_again(tmp_path):
+    stats = _run_with_app(tmp_path, """
+        import sqlalchemy as sa
+        client = app.test_client()
+        imei = '350544507678012'
+        rented = client.post('/api/rent/1', json={'telegram_id': 7}).status_code
+        ended = client.post('/api/end_rent/1', json={'telegram_id': 7}).status_code
+        # Трекер выполнил sclockctrl 1 и сообщает запертый замок
+        client.post('/api/tst100/webhook', json={'ident': imei, 'lock.status': True})
+        with app.app_context():
+            status = db.session.execute(sa.text('SELECT status FROM scooter WHERE id = 1')).scalar()
+        again = client.post('/api/rent/1', json={'telegram_id': 8}).status_code
+        result({'statuses': [rented, ended, again], 'parked': status})
+    """, INGEST_MODE='sync')
+    assert stats['statuses'] == [200, 200, 200]
+    assert stats['parked'] == 'available'
+
+
+def _star(cx, cy, radius, count, rng, scale=1.0):
+    """Звёздчатый контур вокруг (cx, cy): радиусы от 0.5 до 1.5 × radius."""
+    return [[cx + radius * scale * (0.5 + rng.random()) * math.cos(2 * math.pi * i / count),
+             cy + radius * scale * (0.5 + rng.random()) * math.sin(2 * math.pi * i / count)]
+            for i in range(count)]
+
+
+def test_zone_index_vectorized_matches_scalar_with_holes():
+    from services.geofence import Zone, ZoneIndex
+
+    rng = random.Random(42)
+    zones = []
+    for zone_id in range(1, 201):
+        cx, cy = 49.0 + rng.random() * 0.2, 55.0 + rng.random() * 0.2
+        radius = 0.002 + rng.random() * 0.01
+        rings = [_star(cx, cy, radius, rng.randint(3, 40), rng)]
+        if zone_id % 3 == 0:
+            # Дыра целиком внутри: её радиус меньше минимального радиуса контура
+            rings.append(_star(cx, cy, radius, rng.randint(3, 12), rng, scale=0.3))
+        zones.append(Zone(zone_id, str(zone_id), rng.choice(('parking', 'no_ride', 'slow')), rings, 15))
+    index = ZoneIndex(zones, 0.005)
+
+    lats = [55.0 + rng.random() * 0.2 for _ in range(5000)]
+    lngs = [49.0 + rng.random() * 0.2 for _ in range(5000)]
+    vectorized = index.zones_many(lats, lngs)
+    scalar = [frozenset(zone.id for zone in index.zones_at(lat, lng)) for lat, lng in zip(lats, lngs)]
+    assert vectorized == scalar
+    assert sum(1 for zones in vectorized if zones) > 500
+
+    holed = Zone(1, 'holed', 'parking', [[[0, 0], [4, 0], [4, 4], [0, 4]], [[1, 1], [3, 1], [3, 3], [1, 3]]])
+    index = ZoneIndex([holed], 0.5)
+    assert index.zones_many([0.5, 2.0, 5.0], [0.5, 2.0, 5.0]) == [frozenset({1}), frozenset(), frozenset()]
+    assert index.zones_many([], []) == []
+
+
+def test_geofence_no_ride_lock_unlock_and_events(monkeypatch):
+    from services import geofence as module
+
+    engine = module.GeofenceEngine()
+    engine._index = module.ZoneIndex([
+        module.Zone(1, 'park', module.NO_RIDE, [[[49.0, 55.0], [49.01, 55.0], [49.01, 55.01], [49.0, 55.01]]]),
+    ], 0.005)
+    engine._loaded = True
+    engine.reload_interval = 0
+    sent = []
+    engine.send_command = lambda imei, command: sent.append(command)
+    active = {5}
+    monkeypatch.setattr(module.ride_engine, 'is_active', lambda scooter_id: scooter_id in active)
+
+    def point(ts, lat, lng):
+        return {'scooter_id': 5, 'imei': '350544507678012', 'ts': ts, 'lat': lat, 'lng': lng}
+
+    engine.on_telemetry([point(1, 54.99, 49.005)])            # первая точка — только запоминаем
+    engine.on_telemetry([point(2, 55.005, 49.005), point(3, 55.006, 49.005)])
+    assert sent == ['sclockctrl 1']
+    engine.on_telemetry([point(4, 55.02, 49.005)])
+    assert sent == ['sclockctrl 1', 'sclockctrl 0']
+    engine.on_telemetry([point(3.5, 55.005, 49.005)])         # опоздавшая точка не в счёт
+    assert [(e['event'], e['zone_id']) for e in engine.events_since(0)] == [('enter', 1), ('exit', 1)]
+
+    # Вне поездки — только события, команд нет (скорость не настроена)
+    active.clear()
+    engine.on_telemetry([point(5, 55.005, 49.005)])
+    assert sent == ['sclockctrl 1', 'sclockctrl 0']
+    assert engine.events_since(0)[-1]['event'] == 'enter'
+
+
+def test_fleet_analytics_incremental_runs_and_lost_race(tmp_path):
+    stats = _run_with_app(tmp_path, """
+        import time
+        from datetime import datetime
+        import sqlalchemy as sa
+        from models import analytics as agg, repository
+        from models.ride import Ride
+        from models.telemetry import telemetry_store
+        from services.analytics import fleet_analytics
+
+        hour = int(time.time() // 3600) * 3600 - 3 * 3600
+        first, second = hour + 3 * 3600 + 600, hour + 3 * 3600 + 1200
+        at = datetime.utcfromtimestamp
+        # 10 минут стоянки до first, потом 10 минут езды; −1% в минуту
+        telemetry_store.append_many([
+            {'imei': '350544507678012', 'ts': first - 600 + 60 * i, 'lat': 55.0, 'lng': 49.0,
+             'speed': 15.0 if i > 10 else 0.0, 'battery': 100 - i, 'odometer': 1000}
+            for i in range(21)
+        ])
+
+        def ride(start, end, status='finished'):
+            db.session.add(Ride(user_id=user_id, scooter_id=1, start_time=at(start),
+                                end_time=at(end) if end else None, status=status,
+                                start_lat=55.0, start_lng=49.0))
+            db.session.commit()
+
+        def snapshot():
+            drain = db.session.execute(sa.select(
+                agg.agg_battery_drain.c.ride_drop, agg.agg_battery_drain.c.ride_hours,
+                agg.agg_battery_drain.c.idle_drop, agg.agg_battery_drain.c.idle_hours)).one()
+            util = agg.agg_utilization_hourly
+            return {
+                'drain': [round(value, 4) for value in drain],
+                'utilization': [list(row) for row in db.session.execute(
+                    sa.select(util.c.hour_start - hour, util.c.ride_seconds, util.c.rides_started)
+                    .order_by(util.c.hour_start)).all()],
+                'demand': db.session.execute(sa.select(sa.func.sum(agg.agg_demand_hour.c.rides))).scalar(),
+            }
+
+        with app.app_context():
+            user_id = repository.get_or_create_user(7).id
+            # Поездки через границы часов: 600 + 600 с и 1800 + 3600 + 3600 + 300 с
+            ride(hour + 3000, hour + 4200)
+            ride(hour + 1800, hour + 3 * 3600 + 300)
+            fleet_analytics.run(now=first, lag=0)
+            runs = [snapshot()]
+
+            ride(first + 100, None, status='active')
+            fleet_analytics.run(now=second, lag=0)
+            runs.append(snapshot())
+            fleet_analytics.run(now=second, lag=0)
+            runs.append(snapshot())
+
+            # Параллельный запуск уже сдвинул отметку — свои суммы откатываются
+            stale = agg.get_watermark
+            agg.get_watermark = lambda job: None if job == 'demand' else stale(job)
+            skipped = fleet_analytics.run(now=second, lag=0)['demand']
+            agg.get_watermark = stale
+            runs.append(snapshot())
+
+            watermark = agg.get_watermark('demand')
+            race = [
+                agg.advance_watermark('demand', watermark - 1, watermark + 1, datetime.utcnow()),
+                agg.advance_watermark('demand', watermark, watermark + 1, datetime.utcnow()),
+            ]
+        result({'runs': runs, 'skipped': skipped, 'race': race})
+    """, ANALYTICS_INTERVAL=0)
+    first, second, third, after_race = stats['runs']
+    assert first['drain'] == [0.0, 0.0, 10.0, round(10 / 60, 4)]
+    assert first['utilization'] == [[0, 2400.0, 2], [3600, 4200.0, 0], [7200, 3600.0, 0], [10800, 300.0, 0]]
+    assert first['demand'] == 2
+    # Второй запуск учитывает только новое: езда, текущий час и третья поездка
+    assert second['drain'] == [10.0, round(10 / 60, 4), 10.0, round(10 / 60, 4)]
+    assert second['utilization'][:3] == first['utilization'][:3]
+    assert second['utilization'][3] == [10800, 300.0 + 500.0, 1]
+    assert second['demand'] == 3
+    assert third == second
+    assert stats['skipped'] == {'skipped': True}
+    assert after_race == second
+    assert stats['race'] == [False, True]
+
+
+def test_admin_analytics_requires_token(tmp_path):
+    def statuses(**overrides):
+        return _run_with_app(tmp_path, """
+            client = app.test_client()
+            result([client.get('/api/admin/analytics', headers=headers).status_code for headers in (
+                {}, {'Authorization': 'Bearer wrong'}, {'Authorization': 'Bearer s3cret'})])
+        """, **overrides)
+
+    assert statuses() == [403, 403, 403]
+    assert statuses(ADMIN_TOKEN='s3cret') == [401, 401, 200]
+
+
+def test_asset_cache_hashed_urls_encodings_and_revalidation(tmp_path):
+    from email.utils import formatdate
+
+    from flask import Flask
+    from services import assets as module
+
+    (tmp_path / 'icon.png').write_bytes(b'\x89PNG' + bytes(range(256)))
+    (tmp_path / 'style.css').write_text('body { background: url(/tma/icon.png); }\n' * 20)
+    (tmp_path / 'index.html').write_text(
+        '<link href="/tma/style.css"><img src="/tma/icon.png"><a href="/tma/icon.png.bak">\n' * 10)
+    legacy = 'document.title = "Самокаты"; // /tma/icon.png\n'.encode('cp1251')
+    (tmp_path / 'legacy.js').write_bytes(legacy)
+
+    cache = module.AssetCache(str(tmp_path))
+    icon, css = cache.get('icon.png'), cache.get('style.css')
+    page = cache.get('index.html').variants['identity'].decode()
+    assert f'href="/tma/{css.hashed_path}"' in page and f'src="/tma/{icon.hashed_path}"' in page
+    assert 'href="/tma/icon.png.bak"' in page
+    assert f'/tma/{icon.hashed_path}' in css.variants['identity'].decode()
+    # Не UTF-8 — отдаётся без переписывания, сборка не падает
+    assert cache.get('legacy.js').variants['identity'] == legacy
+    assert cache.url('style.css') == f'/tma/{css.hashed_path}'
+
+    app = Flask(__name__)
+
+    def get(path, **headers):
+        with app.test_request_context(headers=headers):
+            return cache.response(path)
+
+    assert get(icon.hashed_path).headers['Cache-Control'] == module.IMMUTABLE
+    assert get('icon.png').headers['Cache-Control'] == module.REVALIDATE
+    assert get('index.html').headers['Cache-Control'] == module.REVALIDATE
+    assert get('missing.js') is None
+
+    plain = get(css.hashed_path)
+    assert plain.headers['ETag'] == f'"{css.etag}"' and 'Content-Encoding' not in plain.headers
+    zipped = get(css.hashed_path, **{'Accept-Encoding': 'gzip'})
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert zipped.headers['ETag'] == f'"{css.etag}-gzip"'
+    assert zipped.headers['Vary'] == 'Accept-Encoding'
+    best = get(css.hashed_path, **{'Accept-Encoding': 'gzip, br'})
+    expected = 'br' if module.brotli is not None else 'gzip'
+    assert best.headers['Content-Encoding'] == expected
+    assert best.headers['ETag'] == f'"{css.etag}-{expected}"'
+    assert get('icon.png', **{'Accept-Encoding': 'gzip'}).headers.get('Content-Encoding') is None
+
+    assert get('style.css', **{'If-None-Match': zipped.headers['ETag']}).status_code == 304
+    assert get('style.css', **{'If-None-Match': '"other"'}).status_code == 200
+    assert get('style.css', **{'If-Modified-Since': formatdate(css.mtime, usegmt=True)}).status_code == 304
+    assert get('style.css', **{'If-Modified-Since': formatdate(css.mtime - 60, usegmt=True)}).status_code == 200
+
+
+def test_fleet_index_search_bbox_near_filters_and_pages():
+    from services.geo_index import FleetIndex
+
+    index = FleetIndex(cell_deg=0.01)
+    index._loaded = True
+    for scooter_id, lat, lng, status, battery in (
+        (1, 55.0, 49.0, 'available', 80),
+        (2, 55.001, 49.001, 'available', 20),
+        (3, 55.02, 49.0, 'in_use', 90),
+        (4, 10.0, 10.0, 'available', 50),
+        (5, None, None, 'available', 100),
+    ):
+        index.upsert(scooter_id, lat=lat, lng=lng, status=status, battery=battery)
+
+    def ids(found):
+        return [record['id'] for record in found[1]]
+
+    assert ids(index.search(bbox=(48.99, 54.99, 49.01, 55.01))) == [1, 2]
+    # Рамка шире числа занятых ячеек — обход по ячейкам, самокат без координат не попадает
+    assert ids(index.search(bbox=(-180.0, -90.0, 180.0, 90.0))) == [1, 2, 3, 4]
+
+    total, near = index.search(near=(55.0, 49.0), radius=500)
+    assert total == 2 and [r['id'] for r in near] == [1, 2]
+    assert near[0]['distance_m'] == 0.0 and 100 < near[1]['distance_m'] < 200
+    assert ids(index.search(near=(55.0, 49.0), radius=3000)) == [1, 2, 3]
+    assert ids(index.search(near=(55.021, 49.0), radius=3000)) == [3, 2, 1]
+
+    assert ids(index.search(statuses={'available'}, min_battery=50)) == [1, 4, 5]
+    assert ids(index.search(bbox=(48.99, 54.99, 49.01, 55.03), statuses={'in_use'})) == [3]
+
+    assert index.search(limit=2, offset=1)[0] == 5
+    assert ids(index.search(limit=2, offset=1)) == [2, 3]
+    assert index.search(near=(55.0, 49.0), radius=3000, limit=1, offset=1)[0] == 3
+    assert ids(index.search(near=(55.0, 49.0), radius=3000, limit=1, offset=1)) == [2]
+
+
+def test_scooters_rejects_non_finite_and_out_of_range_coordinates(tmp_path):
+    statuses = _run_with_app(tmp_path, """
+        client = app.test_client()
+        queries = [
+            'bbox=nan,54.9,49.1,55.1', 'bbox=48.9,54.9,inf,55.1', 'bbox=48.9,-91,49.1,55.1',
+            'bbox=48.9,54.9,181,55.1', 'near=nan,49.0', 'near=55.0,-inf', 'near=95.0,49.0',
+            'near=55.0,49.0&radius=nan', 'near=55.0,49.0&radius=-1', 'bbox=48.9,54.9,49.1,55.1',
+        ]
+        result([client.get('/api/scooters?' + query).status_code for query in queries]
+               + [client.get('/api/scooters/stream?bbox=nan,1,2,3').status_code])
+    """)
+    assert statuses == [400] * 9 + [200, 400]
+
+
+def test_sqlite_connections_get_wal_busy_timeout_and_synchronous(tmp_path):
+    from models import storage
+
+    def pragmas(**overrides):
+        return _run_with_app(tmp_path, """
+            import sqlalchemy as sa
+            with app.app_context():
+                with db.engine.connect() as connection:
+                    result([connection.execute(sa.text(f"PRAGMA {name}")).scalar()
+                            for name in ('journal_mode', 'busy_timeout', 'synchronous')])
+        """, **overrides)
+
+    # synchronous: 1 — NORMAL, 2 — FULL
+    assert pragmas() == ['wal', 5000, 1]
+    assert pragmas(SQLITE_BUSY_TIMEOUT_MS=1234, SQLITE_SYNCHRONOUS='full') == ['wal', 1234, 2]
+    with pytest.raises(ValueError, match='SOMETIMES'):
+        storage._sqlite_pragmas({'SQLITE_SYNCHRONOUS': 'sometimes'})
+
+
+def test_metrics_exposition_after_webhook(tmp_path):
+    text = _run_with_app(tmp_path, """
+        client = app.test_client()
+        client.post('/api/tst100/webhook', json={'ident': '350544507678012', 'battery.level': 70})
+        response = client.get('/metrics')
+        result(response.headers['Content-Type'] + '\\n' + response.get_data(as_text=True))
+    """, INGEST_MODE='sync')
+    content_type, _, text = text.partition('\n')
+    assert content_type == 'text/plain; version=0.0.4; charset=utf-8'
+
+    sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_]\w*="(?:[^"\\]|\\.)*",?)*\})? (\S+)$')
+    families, values = {}, {}
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            continue
+        if line.startswith('# TYPE '):
+            _, _, name, kind = line.split(' ')
+            families[name] = kind
+            continue
+        match = sample.match(line)
+        assert match, line
+        name, labels, value = match.groups()
+        float(value)
+        base = re.sub(r'_(bucket|sum|count)$', '', name)
+        assert name in families or families.get(base) == 'histogram', line
+        values[name + (labels or '')] = float(value)
+
+    assert families['http_request_duration_seconds'] == 'histogram'
+    webhook = 'method="POST",route="/api/tst100/webhook",status="200"'
+    buckets = [value for key, value in values.items()
+               if key.startswith('http_request_duration_seconds_bucket{' + webhook)]
+    assert buckets == sorted(buckets) and buckets[-1] == 1
+    assert values['http_request_duration_seconds_bucket{' + webhook + ',le="+Inf"}'] == 1
+    assert values['http_request_duration_seconds_count{' + webhook + '}'] == 1
+    assert values['http_request_duration_seconds_sum{' + webhook + '}'] > 0
+    assert values['ingest_events_total{event="written"}'] == 1
+    assert families['fleet_index_scooters'] == 'gauge' and 'fleet_index_scooters' in values
+    assert values['log_records_dropped_total'] == 0
+    assert families['flespi_commands_pending'] == 'gauge'
+
+
+def test_dropping_queue_handler_counts_instead_of_blocking():
+    import logging
+    import queue
+
+    from utils.logs import DroppingQueueHandler
+
+    handler = DroppingQueueHandler(queue.Queue(maxsize=2))
+    logger = logging.getLogger('test.dropping')
+    logger.propagate = False
+    logger.addHandler(handler)
+    try:
+        started = time.perf_counter()
+        for i in range(5):
+            logger.warning("запись %d", i, extra={'n': i})
+        assert time.perf_counter() - started < 1.0
+    finally:
+        logger.removeHandler(handler)
+    assert handler.dropped == 3
+    kept = [handler.queue.get_nowait() for _ in range(2)]
+    assert [record.msg for record in kept] == ["запись 0", "запись 1"]
+    assert kept[0].args is None and kept[0].n == 0
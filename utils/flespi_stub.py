@@ -0,0 +1,123 @@
+"""
+Локальная заглушка Flespi для разработки и нагрузочных тестов.
+
+    python -m utils.flespi_stub --port 9000 --latency 0.05 --error-rate 0.1
+    FLESPI_URL=http://127.0.0.1:9000 FLESPI_TOKEN=test python app.py
+
+Понимает POST /gw/devices/<id>/commands/send и GET /gw/devices/configuration.ident=<imei>.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_SEND = re.compile(r'^/gw/devices/(\d+)/commands/send$')
+_LOOKUP = re.compile(r'^/gw/devices/configuration\.ident=(\w+)$')
+
+
+class FlespiStub:
+    """
+    Сервер-заглушка; хранит полученные команды в self.commands.
+    fail_next = N — следующие N запросов получат 503 (для проверки повторов).
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, devices=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.devices = dict(devices or {})   # imei → device_id
+        self.fail_next = 0
+        self.commands = []
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def device_id(self, imei):
+        with self._lock:
+            if imei not in self.devices:
+                self.devices[imei] = 1000000 + len(self.devices)
+            return self.devices[imei]
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _delay_or_fail(self):
+                if stub.latency:
+                    time.sleep(stub.latency)
+                with stub._lock:
+                    forced = stub.fail_next > 0
+                    stub.fail_next -= forced
+                if forced or stub.error_rate and random.random() < stub.error_rate:
+                    self._reply(503, {"errors": [{"reason": "stub failure"}]})
+                    return True
+                return False
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                match = _SEND.match(self.path)
+                if not match:
+                    return self._reply(404, {"errors": [{"reason": "not found"}]})
+                if self._delay_or_fail():
+                    return
+                commands = (json.loads(body or b'{}').get('commands') or [])
+                with stub._lock:
+                    stub.commands.append((int(match.group(1)), commands, time.time()))
+                self._reply(200, {"result": [{"id": len(stub.commands)}]})
+
+            def do_GET(self):
+                match = _LOOKUP.match(self.path.split('?', 1)[0])
+                if not match:
+                    return self._reply(404, {"errors": [{"reason": "not found"}]})
+                if self._delay_or_fail():
+                    return
+                self._reply(200, {"result": [{"id": stub.device_id(match.group(1))}]})
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Заглушка Flespi")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа, сек")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="доля ответов 503")
+    args = parser.parse_args()
+    stub = FlespiStub(args.host, args.port, args.latency, args.error_rate)
+    print(f"Flespi stub: {stub.url}")
+    stub.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
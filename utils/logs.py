@@ -0,0 +1,114 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Атрибуты LogRecord, которые не считаются пользовательскими полями (extra=...)
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна строка JSON на запись: время, уровень, логгер, сообщение и поля из extra."""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Для разработки: «время уровень логгер: сообщение key=value ...»."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        extra = [f"{k}={v}" for k, v in record.__dict__.items()
+                 if k not in _RESERVED and not k.startswith('_')]
+        return line + (' ' + ' '.join(extra) if extra else '')
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Кладёт запись в ограниченную очередь и никогда не ждёт: если поток
+    вывода не успевает, запись отбрасывается и учитывается в dropped.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def prepare(self, record):
+        # Форматирование (и сериализация extra) — в потоке вывода, не в запросе;
+        # здесь только фиксируем сообщение и исключение, пока они ещё живы
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_state = {'handler': None, 'listener': None}
+
+
+def setup_logging(level='INFO', fmt='json', queue_size=10000, stream=None):
+    """
+    Корневой логгер пишет в очередь, а в stdout — отдельный поток.
+    Повторный вызов только меняет уровень. Возвращает обработчик-очередь.
+    """
+    root = logging.getLogger()
+    root.setLevel(level)
+    if _state['handler'] is not None:
+        return _state['handler']
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    listener = QueueListener(handler.queue, output, respect_handler_level=False)
+    listener.start()
+    root.addHandler(handler)
+    _state['handler'], _state['listener'] = handler, listener
+
+    atexit.register(shutdown_logging)
+    return handler
+
+
+def shutdown_logging():
+    """Дописывает очередь и останавливает поток вывода."""
+    listener, handler = _state['listener'], _state['handler']
+    if listener is None:
+        return
+    listener.stop()
+    logging.getLogger().removeHandler(handler)
+    _state['handler'] = _state['listener'] = None
+
+
+def dropped():
+    handler = _state['handler']
+    return handler.dropped if handler is not None else 0
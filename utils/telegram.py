@@ -0,0 +1,37 @@
+import hashlib
+import hmac
+import json
+import time
+from urllib.parse import parse_qsl
+
+
+def verify_init_data(init_data, bot_token, max_age=86400, now=None):
+    """
+    Проверяет подпись initData Telegram Mini App и возвращает словарь user.
+
+    Подпись — HMAC-SHA256 от отсортированных пар key=value (кроме hash),
+    ключ — HMAC-SHA256("WebAppData", токен бота). ValueError — данные
+    не от Telegram, подделаны или старше max_age секунд.
+    """
+    if not init_data:
+        raise ValueError("initData is required")
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received = fields.pop('hash', None)
+    if not received:
+        raise ValueError("initData has no hash")
+
+    data_check = '\n'.join(f"{key}={value}" for key, value in sorted(fields.items()))
+    secret = hmac.new(b'WebAppData', bot_token.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, data_check.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received):
+        raise ValueError("initData signature is invalid")
+
+    try:
+        auth_date = int(fields['auth_date'])
+        user = json.loads(fields['user'])
+        int(user['id'])
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("initData has no user")
+    if max_age and (now or time.time()) - auth_date > max_age:
+        raise ValueError("initData is expired")
+    return user